@@ -0,0 +1,310 @@
+"""
+Backfill of many days, see loader.py --until_yesterday.
+Days are loaded by a pool of --backfill_workers processes, every day and
+station is a pipeline of three stages in threads joined by bounded queues:
+    read .- Chunks of rows from the source (mysql server side cursor)
+    transform .- Normalize the chunks and aggregate them in the windows
+    write .- Stage raw rows and closed windows in parquet files, and
+             replace the day in the tables (big_query.BulkLoad)
+All the stages of all the days in flight are busy at the same time,
+a backfill takes the time of the slowest resource.
+A day loaded is added to a manifest file, a backfill run again skips
+the days of the manifest.
+Use:
+    run_backfill(lst_days, workers, manifest_file, local, feed_file, chunk_rows,
+                 stations=[6, 7])
+"""
+
+import concurrent.futures
+import datetime
+import os
+import queue
+import tempfile
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+import big_query as bq
+import feed
+import mysql
+import normalize
+import storage
+import window
+
+# Days loaded at the same time, a process by day
+DAY_WORKERS = 2
+# Chunks waiting between two stages
+MAX_QUEUE = 4
+# Source of the worker process
+worker_source = None
+
+
+def read_manifest(manifest_file):
+    """
+    :param manifest_file:
+    :return: set of days loaded, String YYYY-MM-DD
+    """
+    if not os.path.exists(manifest_file):
+        return set()
+    with open(manifest_file) as file_read:
+        return set(line.strip() for line in file_read if line.strip() != "")
+
+
+def add_manifest(manifest_file, date_load):
+    """
+    Add a day loaded to the manifest, written to disk
+    :param manifest_file:
+    :param date_load: day, String YYYY-MM-DD
+    :return:
+    """
+    directory = os.path.dirname(manifest_file)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(manifest_file, "a") as file_write:
+        file_write.write(date_load + "\n")
+        file_write.flush()
+        os.fsync(file_write.fileno())
+
+
+def produce(generator, queue_out, lst_errors):
+    """
+    Put the items of a generator in a queue, and None at the end
+    :param generator:
+    :param queue_out:
+    :param lst_errors: list, error of the generator is added
+    :return:
+    """
+    try:
+        for item in generator:
+            queue_out.put(item)
+    except Exception as error:
+        lst_errors.append(error)
+    finally:
+        queue_out.put(None)
+
+
+def pipe(generator, max_queue=MAX_QUEUE):
+    """
+    Run a generator in a thread, a pipeline stage, the thread starts now.
+    Its items wait in a queue of max_queue items, if the queue is full
+    the stage waits.
+    :param generator: items, not None
+    :param max_queue:
+    :return: generator, items of the stage. An error of the stage is raised.
+    """
+    queue_out = queue.Queue(maxsize=max_queue)
+    lst_errors = []
+    thread = threading.Thread(target=produce, args=(generator, queue_out, lst_errors),
+                              daemon=True)
+    thread.start()
+    return get_items(queue_out, thread, lst_errors)
+
+
+def get_items(queue_out, thread, lst_errors):
+    """
+    Items of a pipeline stage, see pipe
+    :param queue_out: queue of the stage, None at the end
+    :param thread: thread of the stage
+    :param lst_errors: errors of the stage
+    :return: generator of items
+    """
+    while True:
+        item = queue_out.get()
+        if item is None:
+            break
+        yield item
+    thread.join()
+    if len(lst_errors) > 0:
+        raise lst_errors[0]
+
+
+def transform_chunks(chunks):
+    """
+    Normalize mysql chunks and aggregate them. The last minute of a chunk
+    is closed with the next chunk, data is ordered by time.
+    :param chunks: mysql dataframes
+    :return: generator of tuples (raw dataframe or None,
+        aggr dataframe or None, dictionary of rollup dataframes)
+    """
+    for data in chunks:
+        data = normalize.normalize_mysql(data.drop(columns=mysql.INDEX_COLUMN))
+        window.window_add_dataframe(data)
+        df_aggr = window.window_get_windows_ready(1)
+        yield data, df_aggr, bq.get_rollups_ready(df_aggr)
+    df_aggr = window.window_get_windows_ready(0)
+    yield None, df_aggr, bq.get_rollups_ready(df_aggr)
+
+
+def load_day_pipeline(date_load, source, dataset=bq.DEFAULT_DATASET,
+                      max_queue=MAX_QUEUE, stations=None):
+    """
+    Load a day, read, transform and write stages at the same time.
+    Stations are read at the same time, every station has its windows.
+    The day is replaced in the tables with the rows of all the stations.
+    :param date_load: day, String YYYY-MM-DD
+    :param source: change-feed source, see feed.py
+    :param dataset:
+    :param max_queue: chunks waiting between two stages
+    :param stations: list of toll stations, None for the default station
+    :return: dictionary, table, load duration in seconds
+    """
+    bulk = bq.BulkLoad(dataset)
+    lst_chunks = [pipe(source.read(date_load, 0, station), max_queue)
+                  for station in stations or [mysql.STATION]]
+    for chunks in lst_chunks:
+        window.window_init()
+        for df, df_aggr, dict_rollups in pipe(transform_chunks(chunks), max_queue):
+            bulk.add(df, bq.TABLE_RAW)
+            bulk.add_windows(df_aggr, dict_rollups)
+    return bulk.commit(date_load)
+
+
+def get_source(feed_file, chunk_rows, stations=None):
+    """
+    :param feed_file: None or csv file of feed.FileSource
+    :param chunk_rows: rows by chunk
+    :param stations: list of toll stations, None for the default station
+    :return: feed.FileSource or feed.PollSource with a new connection pool,
+        a connection by station
+    """
+    if feed_file is not None:
+        return feed.FileSource(feed_file)
+    return feed.PollSource(mysql.ConnectionPool(size=max(mysql.POOL_SIZE,
+                                                         len(stations or []))),
+                           chunk_rows)
+
+
+def init_worker(local, feed_file, chunk_rows, stations):
+    """
+    Init a worker process, its own storage and source
+    :param local: None or local storage directory
+    :param feed_file: None or csv file of feed.FileSource
+    :param chunk_rows: rows by chunk
+    :param stations: list of toll stations, None for the default station
+    :return:
+    """
+    global worker_source
+    bq.set_storage(storage.LocalStorage(local) if local is not None else None)
+    worker_source = get_source(feed_file, chunk_rows, stations)
+
+
+def load_day_worker(date_load, dataset, max_queue, stations):
+    """
+    Load a day in a worker process
+    :param date_load: day, String YYYY-MM-DD
+    :param dataset:
+    :param max_queue: chunks waiting between two stages
+    :param stations: list of toll stations, None for the default station
+    :return: dictionary, table, load duration in seconds
+    """
+    return load_day_pipeline(date_load, worker_source, dataset, max_queue, stations)
+
+
+def run_backfill(lst_days, workers, manifest_file, local=None, feed_file=None,
+                 chunk_rows=mysql.CHUNK_ROWS, dataset=bq.DEFAULT_DATASET,
+                 max_queue=MAX_QUEUE, restart=False, stations=None):
+    """
+    Load days, workers days at the same time, skip the days of the manifest
+    :param lst_days: list of days, String YYYY-MM-DD
+    :param workers: worker processes, 1 to load the days in this process
+    :param manifest_file:
+    :param local: None or local storage directory
+    :param feed_file: None to read mysql, or csv file of feed.FileSource
+    :param chunk_rows: rows by chunk
+    :param dataset:
+    :param max_queue: chunks waiting between two stages
+    :param restart: do not skip the days of the manifest
+    :param stations: list of toll stations, None for the default station
+    :return: list of days not loaded, with an error
+    """
+    set_done = set() if restart else read_manifest(manifest_file)
+    lst_load = [day for day in lst_days if day not in set_done]
+    print("Backfill " + str(len(lst_load)) + " days, skip " +
+          str(len(lst_days) - len(lst_load)) + " days loaded")
+    lst_failed = []
+    if workers <= 1:
+        source = get_source(feed_file, chunk_rows, stations)
+        for day in lst_load:
+            try:
+                bq.print_jobs(load_day_pipeline(day, source, dataset, max_queue, stations))
+                add_manifest(manifest_file, day)
+                print("Day loaded " + day)
+            except Exception as error:
+                print("Day " + day + " failed: " + str(error))
+                lst_failed.append(day)
+        return lst_failed
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=init_worker,
+                                                initargs=(local, feed_file, chunk_rows,
+                                                          stations)) \
+            as executor:
+        futures = {executor.submit(load_day_worker, day, dataset, max_queue, stations): day
+                   for day in lst_load}
+        for future in concurrent.futures.as_completed(futures):
+            day = futures[future]
+            try:
+                bq.print_jobs(future.result())
+                add_manifest(manifest_file, day)
+                print("Day loaded " + day)
+            except Exception as error:
+                print("Day " + day + " failed: " + str(error))
+                lst_failed.append(day)
+    return lst_failed
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        bq.set_storage(storage.LocalStorage(os.path.join(self.directory, "storage")))
+        bq.create_tables(bq.get_storage(), dataset=bq.TEST_DATASET)
+        self.manifest_file = os.path.join(self.directory, "manifest.txt")
+        self.feed_file = os.path.join(self.directory, "feed.csv")
+        self.lst_days = ["2018-01-02", "2018-01-03", "2018-01-04"]
+        for n_day, day in enumerate(self.lst_days):
+            lst_rows = [(0, 6, 2, datetime.datetime.strptime(day, "%Y-%m-%d").date(),
+                         datetime.timedelta(minutes=minute), "55555", 6, 7, 8, 0, 5, 8,
+                         None, datetime.timedelta(0), 13, n_day * 100 + minute + 1)
+                        for minute in range(n_day + 2)]
+            # A car in station 7, same route and minute than a car of station 6
+            lst_rows.append((0, 7, 2, lst_rows[0][3], datetime.timedelta(0), "55555",
+                             6, 7, 8, 0, 5, 8, None, datetime.timedelta(0), 13,
+                             n_day * 100 + 99))
+            feed.write_file(pd.DataFrame(lst_rows), self.feed_file)
+
+    def tearDown(self):
+        bq.get_storage().close()
+        bq.set_storage(None)
+
+    def get_aht(self):
+        return [int(bq.read_df_from_aggr(day, dataset=bq.TEST_DATASET)["AHT"].sum())
+                for day in self.lst_days]
+
+    def test_pipe(self):
+        assert list(pipe(iter(range(1, 20)), max_queue=2)) == list(range(1, 20))
+
+        def fail():
+            yield 1
+            raise ValueError("Stage error")
+        with self.assertRaises(ValueError):
+            list(pipe(fail()))
+
+    def test_backfill(self):
+        add_manifest(self.manifest_file, "2018-01-03")
+        assert run_backfill(self.lst_days, 1, self.manifest_file, feed_file=self.feed_file,
+                            dataset=bq.TEST_DATASET) == []
+        assert self.get_aht() == [2, 0, 4]
+        assert read_manifest(self.manifest_file) == set(self.lst_days)
+        # Worker processes, all the days again, two stations
+        assert run_backfill(self.lst_days, 2, self.manifest_file,
+                            local=bq.get_storage().directory, feed_file=self.feed_file,
+                            dataset=bq.TEST_DATASET, restart=True, stations=[6, 7]) == []
+        assert self.get_aht() == [3, 4, 5]
+        raw = bq.read_df_from_raw("2018-01-03", dataset=bq.TEST_DATASET)
+        assert raw.shape[0] == 4 and np.all(raw["D_Date"] == "2018-01-03")
+        assert sorted(raw["N_Station"].unique().tolist()) == [6, 7]
+        # A row by minute, station and route, the stations do not mix
+        for table_id in [bq.TABLE_AGGR, bq.get_table_rollup(5)]:
+            df_aggr = bq.get_storage().read_sql("select * from " + bq.TEST_DATASET + "." +
+                                                table_id + " where Date = '2018-01-03'")
+            assert not df_aggr.duplicated(bq.AGGR_KEY).any()
+            assert df_aggr.groupby("Station")["AHT"].sum().to_dict() == {6: 3, 7: 1}
@@ -0,0 +1,470 @@
+"""
+Benchmark the window engine with a day of car data.
+Compare the minute window aggregation of window.py with the
+previous engine (dictionary of dataframes, row by row time filter,
+a groupby and a merge by minute).
+Use:
+    benchmark.py .- Benchmark with a day of 2000000 cars
+    benchmark.py --rows N --batch_rows M .- N cars, added in batches of M cars
+    benchmark.py --skip_legacy .- Do not run the previous engine
+    benchmark.py --drain_minutes N .- Drain N minute windows one by one
+    benchmark.py --partitions N .- Aggregate in N worker processes too
+    benchmark.py --normalize .- Normalize mysql data, compare with the
+                                previous row by row normalization
+    benchmark.py --write .- Serialize raw data to upload, parquet file with
+                            schema and csv (pandas_gbq)
+    benchmark.py --suite --days D --rows N .- End to end ingest of D days of
+        synthetic transits (generator.py, N cars a monday): generate,
+        process_dataframe, add_travel_time, window engine (--batch_rows
+        chunks closed by watermark, rollups) and write (staged parquet files
+        committed to local storage). Rows/s and peak memory by stage.
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import big_query as bq
+import generator
+import mysql
+import normalize
+import storage
+import window
+
+
+def create_day_dataframe(n_rows, date="2018-01-02", seed=0):
+    """
+    Create a dataframe with random car data for a day,
+    ordered by time, TABLE_RAW_SCHEMA columns
+    :param n_rows: number of cars
+    :param date: day of the cars
+    :param seed: random seed
+    :return: dataframe
+    """
+    rnd = np.random.RandomState(seed)
+    seconds = np.sort(rnd.randint(0, 24 * 3600, n_rows))
+    times = pd.Series(pd.to_timedelta(seconds, unit="s")).\
+        astype(str).str.slice(-8)
+    return pd.DataFrame({
+        "N_Message": np.arange(n_rows),
+        "N_Station": 6,
+        "N_Lane": rnd.randint(1, 20, n_rows),
+        "D_Date": date,
+        "T_Time": times.values,
+        "Sz_Key": "55555",
+        "N_Source": rnd.choice([13, 12, 11, 8], n_rows),
+        "N_Destination": rnd.choice([1, 5], n_rows),
+        "N_Payment": 8,
+        "N_Obu_Entry_Ok": 0,
+        "N_Obu_Payment": rnd.randint(0, 2, n_rows),
+        "N_Obu_Entry_Station": 8,
+        "D_Obu_Entry_Date": date,
+        "T_Obu_Entry_Time": "00:00:00",
+        "N_Obu_Entry_Lane": 13,
+        "Travel_Time_Second": rnd.randint(0, 3600, n_rows)
+    }, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+
+
+def create_mysql_dataframe(n_rows, seed=0):
+    """
+    Create a dataframe like mysql.get_data, without index column:
+    columns by position, dates as datetime.date, times as datetime.timedelta,
+    1 of 10 obu entry dates are None.
+    :param n_rows: number of cars
+    :param seed: random seed
+    :return: dataframe
+    """
+    rnd = np.random.RandomState(seed)
+    df = create_day_dataframe(n_rows, seed=seed)
+    day = datetime.date(2018, 1, 2)
+    seconds = np.sort(rnd.randint(0, 24 * 3600, n_rows))
+    travel_time = rnd.randint(0, 3600, n_rows)
+    df["D_Date"] = [day] * n_rows
+    df["T_Time"] = [datetime.timedelta(seconds=int(second)) for second in seconds]
+    df["D_Obu_Entry_Date"] = [None if travel_time[i] % 10 == 0 else day
+                              for i in range(n_rows)]
+    df["T_Obu_Entry_Time"] = [datetime.timedelta(seconds=int(second))
+                              for second in np.maximum(seconds - travel_time, 0)]
+    df = df.drop(columns="Travel_Time_Second")
+    df.columns = range(len(df.columns))
+    return df
+
+
+def legacy_normalize(df):
+    """
+    Normalize a mysql dataframe row by row, as the previous
+    loader.process_daraframe and big_query.add_travel_time,
+    without printing the not valid dates.
+    :param df: mysql dataframe
+    :return: TABLE_RAW_SCHEMA dataframe
+    """
+    def lambda_timedelta(x):
+        hours, rem = divmod(x.seconds, 3600)
+        minutes, seconds = divmod(rem, 60)
+        return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+    def lambda_date2string(x):
+        return x.strftime('%Y-%m-%d') if type(x) == datetime.date else x
+
+    def get_time(row):
+        seconds_travel = 0
+        try:
+            timestamp = datetime.datetime.strptime(row['D_Date'] + " @ " + row['T_Time'],
+                                                   "%Y-%m-%d @ %H:%M:%S")
+            if row["N_Obu_Payment"] != 0 and row["N_Obu_Entry_Ok"] == 0:
+                timestamp_in = datetime.datetime.strptime(row['D_Obu_Entry_Date'] + " @ " +
+                                                          row["T_Obu_Entry_Time"],
+                                                          "%Y-%m-%d @ %H:%M:%S")
+                seconds_travel = (timestamp - timestamp_in).total_seconds()
+        except Exception:
+            pass
+        return int(seconds_travel)
+
+    df[4] = df[4].apply(lambda_timedelta)
+    df[12] = df[12].apply(lambda x: "0000-00-00" if x is None else x)
+    df[13] = df[13].apply(lambda_timedelta)
+    df[3] = df[3].apply(lambda_date2string)
+    df[12] = df[12].apply(lambda_date2string)
+    df["Travel_Time_Second"] = 0
+    df.columns = bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA)
+    df["Travel_Time_Second"] = df.apply(get_time, axis=1)
+    return df
+
+
+def legacy_window_aggregate(df):
+    """
+    Aggregate a dataframe with the previous window engine.
+    Dictionary date, time with a dataframe by minute.
+    :param df: car data
+    :return: list of aggregate dataframes, one by minute
+    """
+    window_data = {}
+    for date in df.D_Date.unique():
+        df_date = df.loc[df["D_Date"] == date].copy()
+        df_date["T_Time"] = df_date.apply(lambda row: row["T_Time"][:5],
+                                          axis=1)
+        for time_window in df_date.T_Time.unique():
+            window_data.setdefault(date, {})
+            window_data[date][time_window] = pd.concat(
+                [window_data[date].get(time_window, pd.DataFrame()),
+                 df_date.loc[df_date["T_Time"] == time_window]])
+    lst_aggr = []
+    for date in sorted(window_data.keys()):
+        for time_window in sorted(window_data[date].keys()):
+            df_window = window_data[date][time_window]
+            df_aggr_imh = df_window.\
+                groupby(["N_Source", "N_Destination"])["N_Message"].count().\
+                to_frame().rename(columns={"N_Message": "AHT"}).reset_index()
+            df_aggr_travel_time = df_window[df_window["Travel_Time_Second"] > 0].\
+                groupby(["N_Source", "N_Destination"])["Travel_Time_Second"].min().\
+                to_frame().rename(columns={"Travel_Time_Second": "Travel_Time"}).\
+                reset_index()
+            df_aggr = pd.merge(df_aggr_imh, df_aggr_travel_time, how='left',
+                               on=["N_Source", "N_Destination"]).fillna(0)
+            df_aggr["Date"] = date
+            df_aggr["Time"] = time_window
+            lst_aggr.append(df_aggr)
+    return lst_aggr
+
+
+def window_aggregate(df, batch_rows, n_partition=0):
+    """
+    Aggregate a dataframe with window.py, adding the data in batches
+    :param df: car data
+    :param batch_rows: cars by batch
+    :param n_partition: worker processes, 0 for no workers
+    :return: aggregate dataframe
+    """
+    window.window_init(n_partition=n_partition)
+    for start in range(0, len(df), batch_rows):
+        window.window_add_dataframe(df.iloc[start:start + batch_rows])
+    df_aggr = window.window_get_windows_ready(0)
+    window.window_init()
+    return df_aggr
+
+
+def create_minutes_dataframe(n_minutes, date="2018-01-02"):
+    """
+    Create a dataframe with a car by minute, TABLE_RAW_SCHEMA columns
+    :param n_minutes: number of minutes, from date at 00:00
+    :param date: first day
+    :return: dataframe
+    """
+    timestamps = pd.Timestamp(date) + pd.to_timedelta(np.arange(n_minutes),
+                                                      unit="m")
+    df = create_day_dataframe(n_minutes, date=date)
+    df["D_Date"] = timestamps.strftime("%Y-%m-%d")
+    df["T_Time"] = timestamps.strftime("%H:%M:%S")
+    return df
+
+
+def legacy_drain(df):
+    """
+    Drain the minute windows of a dataframe one by one with the index
+    of the previous engine: count all the windows for every check and
+    sort dates and times for every pop. Aggregation is not included.
+    :param df: car data
+    :return: number of windows drained, seconds draining
+    """
+    window_data = {}
+    for date, time_window in zip(df["D_Date"], df["T_Time"].str.slice(0, 5)):
+        window_data.setdefault(date, {})[time_window] = None
+    start_time = time.time()
+    n_drained = 0
+    while sum(len(window_data[date]) for date in window_data) > 0:
+        date = sorted(window_data.keys())[0]
+        time_window = sorted(window_data[date].keys())[0]
+        window_data[date].pop(time_window)
+        if len(window_data[date]) == 0:
+            window_data.pop(date)
+        n_drained += 1
+    return n_drained, time.time() - start_time
+
+
+def window_drain(df):
+    """
+    Drain the minute windows of a dataframe one by one with the
+    window.py index. Aggregation is not included.
+    :param df: car data
+    :return: number of windows drained, seconds draining
+    """
+    window.window_init()
+    window.window_add_dataframe(df)
+    start_time = time.time()
+    n_drained = 0
+    while window.window_is_window_ready(0):
+        window.window_data.pop_minutes(1)
+        n_drained += 1
+    return n_drained, time.time() - start_time
+
+
+def write_serialize(df):
+    """
+    Serialize a raw dataframe to upload: compressed parquet file with the
+    table schema (storage.write_parquet) and csv as pandas_gbq.to_gbq.
+    :param df: car data
+    :return: list of tuples (name, seconds, bytes)
+    """
+    directory = tempfile.mkdtemp()
+    file_parquet = os.path.join(directory, "raw.parquet")
+    file_csv = os.path.join(directory, "raw.csv")
+    start_time = time.time()
+    storage.write_parquet(df, file_parquet, bq.TABLE_RAW_SCHEMA)
+    seconds_parquet = time.time() - start_time
+    start_time = time.time()
+    df.to_csv(file_csv, index=False, header=False, encoding="utf-8")
+    seconds_csv = time.time() - start_time
+    lst_result = [("parquet", seconds_parquet, os.path.getsize(file_parquet)),
+                  ("csv", seconds_csv, os.path.getsize(file_csv))]
+    os.remove(file_parquet)
+    os.remove(file_csv)
+    os.rmdir(directory)
+    return lst_result
+
+
+def print_result(name, n_rows, seconds, unit="rows"):
+    """ Print a benchmark line"""
+    print("{:<10} {:>10} {} {:>8.2f} s {:>12.0f} {}/s {:>8.2f} s/million".format(
+        name, n_rows, unit, seconds, n_rows / seconds, unit,
+        seconds * 1000000 / n_rows))
+
+
+def measure(stage, get_input):
+    """
+    Run a stage twice with a new input: timed, and traced (tracemalloc)
+    for the peak memory, tracing slows the stage down.
+    Input creation is not measured.
+    :param stage: function, input: result
+    :param get_input: function, (): input of the stage
+    :return: result of the timed run, seconds, peak bytes
+    """
+    df_input = get_input()
+    start_time = time.time()
+    result = stage(df_input)
+    seconds = time.time() - start_time
+    df_input = get_input()
+    tracemalloc.start()
+    stage(df_input)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def stage_window(df, batch_rows, lateness=5):
+    """
+    Window engine as the online loader: chunks added, windows closed by
+    the watermark and their rollups, all the windows at the end
+    :param df: car data, TABLE_RAW_SCHEMA columns
+    :param batch_rows: cars by chunk
+    :param lateness: minutes to wait for late data
+    :return: list of tuples (aggr dataframe or None, dictionary of rollup dataframes)
+    """
+    window.window_init()
+    lst_windows = []
+    for start in range(0, len(df), batch_rows):
+        window.window_add_dataframe(df.iloc[start:start + batch_rows])
+        df_aggr = window.window_get_windows_closed(lateness)
+        lst_windows.append((df_aggr, bq.get_rollups_ready(df_aggr)))
+    df_aggr = window.window_get_windows_ready(0)
+    lst_windows.append((df_aggr, bq.get_rollups_ready(df_aggr)))
+    window.window_init()
+    return lst_windows
+
+
+def stage_write(date, df, lst_windows):
+    """
+    Write path of a day: raw rows and windows staged in parquet files
+    and committed (big_query.BulkLoad) to the storage
+    :param date: day, String YYYY-MM-DD
+    :param df: car data, TABLE_RAW_SCHEMA columns
+    :param lst_windows: see stage_window
+    :return: dictionary, table, load duration in seconds
+    """
+    bulk = bq.BulkLoad()
+    bulk.add(df, bq.TABLE_RAW)
+    for df_aggr, dict_rollups in lst_windows:
+        bulk.add_windows(df_aggr, dict_rollups)
+    return bulk.commit(date)
+
+
+def run_suite(first_day, n_days, rows_day, batch_rows):
+    """
+    End to end ingest of synthetic days, local storage in a temporary
+    directory. Print rows/s and peak memory by stage.
+    :param first_day: day, String YYYY-MM-DD
+    :param n_days: number of days
+    :param rows_day: cars of a monday, see generator.create_days
+    :param batch_rows: cars by chunk of the window engine
+    :return: dictionary, stage: [rows, seconds, peak bytes]
+    """
+    bq.set_storage(storage.LocalStorage(tempfile.mkdtemp()))
+    bq.create_tables(bq.get_storage())
+    start = datetime.datetime.strptime(first_day, "%Y-%m-%d").date()
+    dict_result = {}
+
+    def add_result(stage, n_rows, seconds, peak):
+        result = dict_result.setdefault(stage, [0, 0.0, 0])
+        result[0] += n_rows
+        result[1] += seconds
+        result[2] = max(result[2], peak)
+
+    first_index = 1
+    for n_day in range(n_days):
+        day = (start + datetime.timedelta(days=n_day)).strftime("%Y-%m-%d")
+        n_rows = generator.get_day_rows(day, rows_day)
+        df_mysql, seconds, peak = measure(
+            lambda _: generator.create_mysql_transits(day, n_rows, n_day, first_index),
+            lambda: None)
+        add_result("generate", n_rows, seconds, peak)
+        df_mysql = df_mysql.drop(columns=mysql.INDEX_COLUMN)
+        # Previous loader.process_daraframe
+        df_processed, seconds, peak = measure(normalize.process_dataframe,
+                                              lambda: df_mysql.copy())
+        add_result("process", n_rows, seconds, peak)
+        df_processed["Travel_Time_Second"] = 0
+        df_processed.columns = bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA)
+        df_raw, seconds, peak = measure(normalize.add_travel_time,
+                                        lambda: df_processed.copy())
+        add_result("travel", n_rows, seconds, peak)
+        df_raw = normalize.downcast_integers(df_raw)
+        lst_windows, seconds, peak = measure(lambda df: stage_window(df, batch_rows),
+                                             lambda: df_raw)
+        add_result("window", n_rows, seconds, peak)
+        _, seconds, peak = measure(lambda df: stage_write(day, df, lst_windows),
+                                   lambda: df_raw)
+        add_result("write", n_rows, seconds, peak)
+        first_index += n_rows
+    bq.get_storage().close()
+    bq.set_storage(None)
+    for stage, (n_rows, seconds, peak) in dict_result.items():
+        print_result(stage, n_rows, seconds)
+        print("{:<10} {:>10.1f} MB peak".format(stage, peak / 1000000))
+    n_rows = dict_result["write"][0]
+    print_result("total", n_rows, sum(seconds for _, seconds, _ in dict_result.values()))
+    return dict_result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000,
+                        help='Cars in the day')
+    parser.add_argument('--batch_rows', type=int, default=None,
+                        help='Cars by batch, default all the day')
+    parser.add_argument('--skip_legacy', action='store_true', default=False,
+                        help='Do not run the previous engine')
+    parser.add_argument('--drain_minutes', type=int, default=None,
+                        help='Only drain this number of minute windows')
+    parser.add_argument('--partitions', type=int, default=0,
+                        help='Aggregate in worker processes too')
+    parser.add_argument('--normalize', action='store_true', default=False,
+                        help='Only normalize mysql data')
+    parser.add_argument('--write', action='store_true', default=False,
+                        help='Only serialize raw data to upload')
+    parser.add_argument('--suite', action='store_true', default=False,
+                        help='End to end ingest of synthetic days')
+    parser.add_argument('--days', type=int, default=1,
+                        help='Suite, number of days')
+    parser.add_argument('--day', default="2018-01-01",
+                        help='Suite, first day')
+    args = parser.parse_args()
+
+    if args.suite:
+        run_suite(args.day, args.days, args.rows, args.batch_rows or 100000)
+        exit(0)
+
+    if args.write:
+        for name, seconds, n_bytes in write_serialize(create_day_dataframe(args.rows)):
+            print_result(name, args.rows, seconds)
+            print("{:<10} {:>10.1f} MB".format(name, n_bytes / 1000000))
+        exit(0)
+
+    if args.normalize:
+        df_mysql = create_mysql_dataframe(args.rows)
+        start_time = time.time()
+        df_normalized = normalize.normalize_mysql(df_mysql.copy())
+        print_result("normalize", args.rows, time.time() - start_time)
+        if not args.skip_legacy:
+            start_time = time.time()
+            df_legacy = legacy_normalize(df_mysql.copy())
+            print_result("legacy", args.rows, time.time() - start_time)
+            for column in df_legacy.columns:
+                assert list(df_legacy[column]) == list(df_normalized[column])
+        exit(0)
+
+    if args.drain_minutes is not None:
+        df_minutes = create_minutes_dataframe(args.drain_minutes)
+        n_windows, seconds = window_drain(df_minutes)
+        assert n_windows == args.drain_minutes
+        print_result("drain", n_windows, seconds, unit="windows")
+        if not args.skip_legacy:
+            n_windows, seconds = legacy_drain(df_minutes)
+            assert n_windows == args.drain_minutes
+            print_result("legacy", n_windows, seconds, unit="windows")
+        exit(0)
+
+    df_day = create_day_dataframe(args.rows)
+    batch = args.batch_rows or args.rows
+    start_time = time.time()
+    df_result = window_aggregate(df_day, batch)
+    print_result("window", args.rows, time.time() - start_time)
+    if args.partitions > 1:
+        start_time = time.time()
+        df_partitioned = window_aggregate(df_day, batch, args.partitions)
+        print_result("partition", args.rows, time.time() - start_time)
+        assert df_partitioned.equals(df_result)
+    if not args.skip_legacy:
+        start_time = time.time()
+        lst_legacy = legacy_window_aggregate(df_day)
+        print_result("legacy", args.rows, time.time() - start_time)
+        # Both engines must get the same aggregate data
+        df_legacy = pd.concat(lst_legacy)
+        assert np.array_equal(df_legacy["AHT"].values,
+                              df_result["AHT"].values)
+        assert np.array_equal(df_legacy["Travel_Time"].values,
+                              df_result["Travel_Time"].values)
+        assert np.array_equal(df_legacy["Time"].values,
+                              df_result["Time"].values)
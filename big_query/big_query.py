@@ -1,22 +1,47 @@
 """
 Lib to manage raw and aggr table in bigquery dataset.
 RAW table : Car info
-AGGR  Aggregate info for a time window with IMH and travel time for all posible routes
+AGGR  Aggregate info for a time window with IMH and travel time for all posible routes,
+    and a sketch of the travel times to get its quantiles, see sketch.py.
+    A row by minute, toll station and route, stations loaded together do not mix
+AGGR_5, AGGR_15, AGGR_60 .- Aggregate info for 5, 15 and 60 minutes windows
+Dates and times are DATE and TIME columns, tables are partitioned by
+date and clustered by route, a day query only read the day.
+Dataframes use strings YYYY-MM-DD and HH:MM:SS, see get_typed_columns
+and get_string_columns. Tables with STRING dates, see migrate.py
+Operations on independent tables (create, delete day, replace day, merge)
+run concurrently, see run_jobs.
+Rows written and job durations by table are counted in metrics.py.
+Travel time quantiles (P50, P85, P95) of any minutes and days merge the
+sketches of the aggr or rollup rows, see read_travel_time_quantiles.
 Options:
     -f filename .- Load a csv file.
+    -f filename --chunk_rows N .- Load a csv file in chunks of N rows,
+                                  flat memory use.
+    --local directory .- Use local storage in directory, not big query.
+Csv files are staged in parquet files and loaded together at the end,
+see BulkLoad.
 You can create dataset, tables, fill the table and get date.
-Based on  pandas_gbq
+Tables are in a storage backend, see storage.py:
+    big query, based on  pandas_gbq. Default
+    local, sqlite files in directory STORAGE_DIR. If STORAGE_DIR environment
+        variable is set, or set_storage is called
 """
 
-import pandas_gbq as pd_gbq
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
 import pandas as pd
 from google.cloud import bigquery
-from google.api_core import exceptions
-import datetime
 import argparse
+import metrics
+import normalize
+import sketch
+import storage
 import window
 import unittest
-import time
 from env import PROJECT_ID
 
 
@@ -27,8 +52,8 @@ TEST_DATASET = "test_bigquery"
 TABLE_RAW_SCHEMA = ("N_Message:INTEGER," 
                     "N_Station:INTEGER,"
                     "N_Lane:INTEGER,"
-                    "D_Date:STRING,"
-                    "T_Time:STRING,"
+                    "D_Date:DATE,"
+                    "T_Time:TIME,"
                     "Sz_Key:STRING,"
                     "N_Source:INTEGER,"
                     "N_Destination:INTEGER,"
@@ -42,24 +67,179 @@ TABLE_RAW_SCHEMA = ("N_Message:INTEGER,"
                     "Travel_Time_Second:INTEGER")
 TABLE_AGGR_SCHEMA = ("Source:INTEGER,"
                      "Destination:INTEGER,"
-                     "Date:STRING,"
-                     "Time:STRING," 
+                     "Date:DATE,"
+                     "Time:TIME,"
                      "AHT:INTEGER,"
-                     "Travel_Time:INTEGER")
+                     "Travel_Time:INTEGER,"
+                     "Travel_Time_Sketch:STRING,"
+                     "Station:INTEGER")
+# Tables are partitioned by day and clustered by route
+TABLE_RAW_PARTITION = "D_Date"
+TABLE_RAW_CLUSTER = ["N_Source", "N_Destination"]
+TABLE_AGGR_PARTITION = "Date"
+TABLE_AGGR_CLUSTER = ["Source", "Destination"]
+# Key of aggr and rollup rows, a row by minute, toll station and route
+AGGR_KEY = ["Date", "Time", "Station", "Source", "Destination"]
+# Toll station of the aggr rows and windows saved before the Station
+# column, the station of the loader (mysql.STATION), see migrate.py
+LEGACY_STATION = 6
+# Merge of a correction row in an aggr row, t aggr row, s correction row.
+# AHT is added, travel time is the min not 0, sketches are joined.
+# Not idempotent, a batch merged twice is added twice: see merge_df_aggr
+AGGR_MERGE_UPDATE = {"AHT": "t.AHT + s.AHT",
+                     "Travel_Time": "case when s.Travel_Time > 0 and "
+                                    "(t.Travel_Time = 0 or s.Travel_Time < t.Travel_Time) "
+                                    "then s.Travel_Time else t.Travel_Time end",
+                     "Travel_Time_Sketch": "case when coalesce(t.Travel_Time_Sketch, '') = '' "
+                                           "then s.Travel_Time_Sketch "
+                                           "when coalesce(s.Travel_Time_Sketch, '') = '' "
+                                           "then t.Travel_Time_Sketch "
+                                           "else t.Travel_Time_Sketch || ',' || "
+                                           "s.Travel_Time_Sketch end"}
+# Concurrent jobs, max jobs running and seconds to wait all the jobs
+JOB_WORKERS = 8
+JOB_TIMEOUT = 600
+# Environment variable with the local storage directory
+STORAGE_DIR = "STORAGE_DIR"
+# Storage backend in use, see get_storage
+storage_backend = None
+
+
+def set_storage(storage_used):
+    """
+    Set the storage backend used by this module
+    :param storage_used: storage.BigQueryStorage or storage.LocalStorage
+    :return:
+    """
+    global storage_backend
+    storage_backend = storage_used
+
+
+def get_storage():
+    """
+    Storage backend in use, created the first time:
+    local storage if STORAGE_DIR environment variable is set,
+    big query other case
+    :return: storage.BigQueryStorage or storage.LocalStorage
+    """
+    if storage_backend is None:
+        if os.environ.get(STORAGE_DIR):
+            set_storage(storage.LocalStorage(os.environ[STORAGE_DIR]))
+        else:
+            set_storage(storage.BigQueryStorage(PROJECT_ID))
+    return storage_backend
+
+
+def run_job(function, args_job):
+    """
+    :param function: job function
+    :param args_job: list of arguments
+    :return: job duration in seconds
+    """
+    start_time = time.time()
+    function(*args_job)
+    return time.time() - start_time
+
+
+def observe_jobs(durations):
+    """
+    Add jobs duration to metrics, histogram by job
+    :param durations: dictionary, job name, duration in seconds
+    :return: durations
+    """
+    for name, seconds in durations.items():
+        metrics.observe("job_seconds", seconds, job=name)
+    return durations
+
+
+def run_jobs(jobs, timeout=JOB_TIMEOUT, max_workers=JOB_WORKERS):
+    """
+    Run independent jobs concurrently, in threads, and wait until all finish.
+    If a job fails, its exception is raised when all jobs finish.
+    :param jobs: list of tuples (name, function, list of arguments)
+    :param timeout: seconds to wait all the jobs
+    :param max_workers: max number of jobs running
+    :return: dictionary, key job name, value job duration in seconds
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = [(name, executor.submit(run_job, function, args_job))
+               for name, function, args_job in jobs]
+    done, not_done = concurrent.futures.wait([future for name, future in futures],
+                                             timeout=timeout)
+    executor.shutdown(wait=False)
+    if len(not_done) > 0:
+        raise TimeoutError("Jobs not finished in " + str(timeout) + " s: " +
+                           ", ".join([name for name, future in futures
+                                      if future in not_done]))
+    return observe_jobs({name: future.result() for name, future in futures})
+
+
+def print_jobs(durations):
+    """
+    Print jobs duration
+    :param durations: dictionary, job name, duration in seconds
+    :return:
+    """
+    print(", ".join(["{} {:.2f} s".format(name, seconds)
+                     for name, seconds in durations.items()]))
 
 
-def write_df(df, table_id, dataset=DEFAULT_DATASET):
+def get_table_schema(table_id):
+    """
+    :param table_id: raw, aggr or rollup table
+    :return: schema list of the table
+    """
+    if table_id == TABLE_RAW:
+        return TABLE_RAW_SCHEMA
+    return TABLE_AGGR_SCHEMA
+
+
+def get_typed_columns(df, schema_list):
+    """
+    Format DATE and TIME columns for the tables, times HH:MM to HH:MM:SS.
+    Dataframe is not changed.
+    :param df: dataframe with string dates and times
+    :param schema_list: table schema
+    :return: dataframe
+    """
+    for column_def in schema_list.split(','):
+        column_name, column_type = column_def.split(':')
+        if column_type == "TIME" and column_name in df.columns:
+            serie = df[column_name].astype(str)
+            df = df.assign(**{column_name: serie.where(serie.str.len() != 5,
+                                                       serie + ":00")})
+    return df
+
+
+def get_string_columns(df, schema_list):
+    """
+    DATE and TIME columns read from a table to strings,
+    YYYY-MM-DD and HH:MM:SS, the same for all the storage backends
+    :param df: dataframe read
+    :param schema_list: table schema
+    :return: dataframe
+    """
+    for column_def in schema_list.split(','):
+        column_name, column_type = column_def.split(':')
+        if column_type in ("DATE", "TIME") and column_name in df.columns:
+            df[column_name] = df[column_name].astype(str)
+    return df
+
+
+def write_df(df, table_id, dataset=DEFAULT_DATASET, batch_id=None):
     """
     Write a dataframe to a table in a dataset.
     :param df:  dataframe to write
     :param table_id:  big query table id
     :param dataset: bigquery dataset.
+    :param batch_id: None or id of the batch, a batch is written once,
+        see storage.py
     :return:
     """
-    pd_gbq.to_gbq(df,
-                  dataset + '.' + table_id,
-                  PROJECT_ID,
-                  if_exists='append')
+    schema_list = get_table_schema(table_id)
+    get_storage().write_df(get_typed_columns(df, schema_list), dataset,
+                           table_id, schema_list, batch_id=batch_id)
+    metrics.count("rows_out", len(df), table=table_id)
 
 
 def write_df_raw(df):
@@ -80,6 +260,27 @@ def write_df_aggr(df):
     write_df(df, TABLE_AGGR)
 
 
+def get_table_rollup(resolution):
+    """
+    :param resolution: window size in minutes
+    :return: table id with aggregate info for the window size
+    """
+    return TABLE_AGGR + "_" + str(resolution)
+
+
+def write_df_rollups(dict_df, dataset=DEFAULT_DATASET):
+    """
+    Write rollup dataframes to its tables
+    :param dict_df: Dictionary, key window size in minutes,
+        value dataframe or None
+    :param dataset:
+    :return:
+    """
+    for resolution, df in dict_df.items():
+        if df is not None:
+            write_df(df, get_table_rollup(resolution), dataset=dataset)
+
+
 def read_df_from_raw(date,  dataset=DEFAULT_DATASET):
     """
     Read data from the raw table for a date and a dataset
@@ -88,9 +289,9 @@ def read_df_from_raw(date,  dataset=DEFAULT_DATASET):
     :return: Dataframe with data
     """
     sql = ("select * from " + dataset + ".raw "
-           "where D_Date=\"" + date + "\" order "
+           "where D_Date='" + date + "' order "
            "by D_Date,T_Time")
-    return pd_gbq.read_gbq(sql, PROJECT_ID, dialect='standard')
+    return get_string_columns(get_storage().read_sql(sql), TABLE_RAW_SCHEMA)
 
 
 def read_df_from_aggr(date,  dataset=DEFAULT_DATASET):
@@ -101,60 +302,192 @@ def read_df_from_aggr(date,  dataset=DEFAULT_DATASET):
     :return: Dataframe with data
     """
     sql = ("select * from " + dataset + ".aggr"
-           " where Date=\"" + date + "\" order "
+           " where Date='" + date + "' order "
            "by Date,Time")
-    return pd_gbq.read_gbq(sql, PROJECT_ID, dialect='standard')
+    return get_string_columns(get_storage().read_sql(sql), TABLE_AGGR_SCHEMA)
+
+
+def get_time_sql(time):
+    """
+    :param time: String HH:MM or HH:MM:SS
+    :return: sql literal of the time, HH:MM:SS
+    """
+    return "'" + (time + ":00" if len(time) == 5 else time) + "'"
+
+
+def read_travel_time_quantiles(date_from, date_to=None, time_from=None, time_to=None,
+                               table_id=TABLE_AGGR, quantiles=sketch.QUANTILES,
+                               dataset=DEFAULT_DATASET):
+    """
+    Travel time quantiles by route, from date_from time_from until date_to
+    time_to (a minute, a rolling window or some days). The sketches of the
+    rows are merged, of all the toll stations, raw table is not read. Rollup tables read less rows
+    for long ranges, their times are the first minute of the windows.
+    :param date_from: first day, String YYYY-MM-DD
+    :param date_to: last day, None for date_from
+    :param time_from: first minute of date_from, HH:MM, None for all the day
+    :param time_to: last minute of date_to, HH:MM, None for all the day
+    :param table_id: aggr or rollup table
+    :param quantiles: list of quantiles, 0 - 1
+    :param dataset:
+    :return: Dataframe with a row by route, ordered by source and destination
+        Columns: Source, Destination, AHT and a column by quantile
+                 in seconds (P50, P85, P95), 0 is no travel time
+    """
+    date_to = date_to or date_from
+    sql = ("select Source, Destination, AHT, Travel_Time_Sketch from " +
+           dataset + "." + table_id +
+           " where Date >= '" + date_from + "' and Date <= '" + date_to + "'")
+    if time_from is not None:
+        sql += " and (Date > '" + date_from + "' or Time >= " + get_time_sql(time_from) + ")"
+    if time_to is not None:
+        sql += " and (Date < '" + date_to + "' or Time <= " + get_time_sql(time_to) + ")"
+    df = get_storage().read_sql(sql)
+    rows = []
+    for (source, destination), df_route in df.groupby(["Source", "Destination"]):
+        route_sketch = sketch.get_sketch_from_string(
+            ",".join(df_route["Travel_Time_Sketch"].fillna("").tolist()))
+        rows.append([source, destination, int(df_route["AHT"].sum())] +
+                    sketch.get_quantiles(route_sketch, quantiles))
+    return pd.DataFrame(rows, columns=["Source", "Destination", "AHT"] +
+                        ["P" + format(quantile * 100, "g") for quantile in quantiles])
 
 
 def delete_day_table(date,
-                     client_bq,
+                     storage_used,
                      table,
                      date_column,
                      dataset=DEFAULT_DATASET):
     """
-    Deleta day info from a table
+    Deleta day info from a table, only the day partition is read
     :param date: String format YYYY-MM-DD
-    :param client_bq:
+    :param storage_used: storage backend
     :param table:
     :param date_column: column with data info in the fable
     :param dataset:
     :return:
     """
     sql = "delete FROM " + dataset + "." + table + " where " \
-          " " + date_column + " = \"" + date + "\""
-    query_result = client_bq.query(sql)
-    while query_result.running():
-        time.sleep(0.1)
+          " " + date_column + " = '" + date + "'"
+    storage_used.query(sql)
 
 
-def delete_day(date, client_bq, dataset=DEFAULT_DATASET):
+def delete_day(date, storage_used, dataset=DEFAULT_DATASET):
     """
-    Delete day info from raw and aggr table
+    Delete day info from raw, aggr and rollup tables, concurrently
     :param date:
-    :param client_bq:
+    :param storage_used: storage backend
+    :param dataset:
+    :return: dictionary, table, delete duration in seconds
+    """
+    return run_jobs([(table_id, delete_day_table,
+                      [date, storage_used, table_id, partition_column, dataset])
+                     for table_id, schema_list, partition_column, cluster_columns
+                     in get_tables()])
+
+
+def get_table_partition(table_id):
+    """
+    :param table_id: raw, aggr or rollup table
+    :return: partition column of the table
+    """
+    if table_id == TABLE_RAW:
+        return TABLE_RAW_PARTITION
+    return TABLE_AGGR_PARTITION
+
+
+def replace_day_table(date, df, table_id, dataset=DEFAULT_DATASET):
+    """
+    Replace day info of a table with a dataframe, atomic:
+    the table never has the day empty or half loaded.
+    Rows of other days in the dataframe are added to the table.
+    :param date: String format YYYY-MM-DD
+    :param df: None or dataframe, None to remove the day info
+    :param table_id:
     :param dataset:
     :return:
     """
-    delete_day_table(date, client_bq, "raw", "D_Date", dataset=dataset)
-    delete_day_table(date, client_bq, "aggr", "Date", dataset=dataset)
+    schema_list = get_table_schema(table_id)
+    partition_column = get_table_partition(table_id)
+    if df is None:
+        df = pd.DataFrame(columns=get_columns_from_list(schema_list))
+    df = get_typed_columns(df, schema_list)
+    df_day = df[df[partition_column] == date]
+    get_storage().replace_partition(df_day, dataset, table_id, schema_list,
+                                    partition_column, date)
+    if len(df_day) < len(df):
+        df_other = df[df[partition_column] != date]
+        if table_id == TABLE_RAW:
+            write_df(df_other, table_id, dataset=dataset)
+        else:
+            merge_df_aggr(df_other, table_id, dataset=dataset)
+
+
+def replace_day(date, df_raw, df_aggr, dict_rollups, dataset=DEFAULT_DATASET):
+    """
+    Replace day info in raw, aggr and rollup tables, the tables concurrently.
+    Idempotent, load again a day do not duplicate data.
+    :param date: String format YYYY-MM-DD
+    :param df_raw: None or raw dataframe
+    :param df_aggr: None or aggr dataframe
+    :param dict_rollups: Dictionary, key window size in minutes,
+        value dataframe or None
+    :param dataset:
+    :return: dictionary, table, replace duration in seconds
+    """
+    jobs = [(TABLE_RAW, replace_day_table, [date, df_raw, TABLE_RAW, dataset]),
+            (TABLE_AGGR, replace_day_table, [date, df_aggr, TABLE_AGGR, dataset])]
+    for resolution in window.ROLLUP_MINUTES:
+        jobs.append((get_table_rollup(resolution), replace_day_table,
+                     [date, dict_rollups.get(resolution),
+                      get_table_rollup(resolution), dataset]))
+    return run_jobs(jobs)
+
 
+def aggregate_rows(df):
+    """
+    Aggregate rows with the same AGGR_KEY.
+    AHT is the sum, Travel_Time the min not 0, Travel_Time_Sketch the
+    sketches joined
+    :param df: aggr dataframe
+    :return: aggr dataframe, a row by key
+    """
+    df_travel_time = df["Travel_Time"].where(df["Travel_Time"] > 0)
+    df_group = df.assign(Travel_Time=df_travel_time).groupby(AGGR_KEY)
+    df_result = df_group["AHT"].sum().to_frame()
+    df_result["Travel_Time"] = df_group["Travel_Time"].min().fillna(0).astype(int)
+    df_result["Travel_Time_Sketch"] = df_group["Travel_Time_Sketch"].agg(
+        lambda texts: ",".join(text for text in texts if isinstance(text, str) and text != ""))
+    return df_result.reset_index()[df.columns]
 
-def get_client_bigquery():
+
+def merge_df_aggr(df, table_id, dataset=DEFAULT_DATASET, batch_id=None):
     """
-    :return: A big query client
+    Merge aggr rows to an aggr or rollup table, by AGGR_KEY:
+    rows of minutes already in the table are corrections,
+    added to the row in the table. Other rows are inserted.
+    The merge adds, it is not idempotent. With batch_id a batch is merged
+    once, a retry of the batch is not added again (storage.py). Rows of
+    other batches are always added: online, rows read again after a
+    restart from the checkpoint are added again, online corrections are
+    at-least-once. A day reload (replace_day) is idempotent.
+    :param df: aggr dataframe
+    :param table_id: aggr or rollup table
+    :param dataset:
+    :param batch_id: None or id of the batch
+    :return:
     """
-    return bigquery.Client(project=PROJECT_ID)
+    if len(df) == 0:
+        return
+    df = aggregate_rows(get_typed_columns(df, TABLE_AGGR_SCHEMA))
+    get_storage().merge_df(df, dataset, table_id, TABLE_AGGR_SCHEMA, AGGR_KEY,
+                           AGGR_MERGE_UPDATE, TABLE_AGGR_PARTITION, batch_id=batch_id)
+    metrics.count("rows_out", len(df), table=table_id)
 
 
-def create_dataset(client, dataset_id):
-    """ Create a dataset en EU if it do not exist."""
-    dataset_ref = client.dataset(dataset_id)
-    dataset = bigquery.Dataset(dataset_ref)
-    dataset.location = 'EU'
-    try:
-        client.create_dataset(dataset)
-    except exceptions.Conflict:
-        pass
+def create_dataset(storage_used, dataset_id):
+    """ Create a dataset if it do not exist."""
+    storage_used.create_dataset(dataset_id)
 
 
 def get_schema_from_list(schema_list):
@@ -189,33 +522,55 @@ def get_columns_from_list(schema_list):
     return columns_name
 
 
-def create_table(dataset_id, table_id, schema_list, client_bq):
+def create_table(dataset_id, table_id, schema_list, storage_used,
+                 partition_column=None, cluster_columns=None):
     """
     Create a table if it does not exist, form a schema
     :param dataset_id:
     :param table_id:
     :param schema_list: Columns definitions separate by  "," character,
         A column definition is NAME: TYPE
-    :param client_bq:
+    :param storage_used: storage backend
+    :param partition_column: DATE column to partition by day, None not partitioned
+    :param cluster_columns: list of columns to cluster, None not clustered
     :return:
     """
-    dataset_ref = client_bq.dataset(dataset_id)
-    table_ref = dataset_ref.table(table_id)
-    schema = get_schema_from_list(schema_list)
-    table = bigquery.Table(table_ref, schema=schema)
-    try:
-        client_bq.create_table(table)
-    except exceptions.Conflict:
-        pass
+    storage_used.create_table(dataset_id, table_id, schema_list,
+                              partition_column, cluster_columns)
 
 
-def delete_table(dataset_id, table_id, client_bq):
+def delete_table(dataset_id, table_id, storage_used):
     """ Deleta a table"""
-    table_ref = client_bq.dataset(dataset_id).table(table_id)
-    try:
-        client_bq.delete_table(table_ref)
-    except exceptions.NotFound:
-        pass
+    storage_used.delete_table(dataset_id, table_id)
+
+
+def get_tables():
+    """
+    :return: list of raw, aggr and rollup tables,
+        tuples (table_id, schema_list, partition_column, cluster_columns)
+    """
+    lst_tables = [(TABLE_RAW, TABLE_RAW_SCHEMA, TABLE_RAW_PARTITION, TABLE_RAW_CLUSTER),
+                  (TABLE_AGGR, TABLE_AGGR_SCHEMA, TABLE_AGGR_PARTITION, TABLE_AGGR_CLUSTER)]
+    for resolution in window.ROLLUP_MINUTES:
+        lst_tables.append((get_table_rollup(resolution), TABLE_AGGR_SCHEMA,
+                           TABLE_AGGR_PARTITION, TABLE_AGGR_CLUSTER))
+    return lst_tables
+
+
+def create_tables(storage_used, dataset=DEFAULT_DATASET):
+    """
+    Create dataset, raw, aggr and rollup tables if they do not exist,
+    partitioned by date and clustered by route. Tables are created concurrently.
+    :param storage_used: storage backend
+    :param dataset:
+    :return: dictionary, table, create duration in seconds
+    """
+    create_dataset(storage_used, dataset)
+    return run_jobs([(table_id, create_table,
+                      [dataset, table_id, schema_list, storage_used,
+                       partition_column, cluster_columns])
+                     for table_id, schema_list, partition_column, cluster_columns
+                     in get_tables()])
 
 
 def add_travel_time(df):
@@ -226,34 +581,11 @@ def add_travel_time(df):
         "Travel_Time_Second" = toll time - entry time
     other case:
         "Travel_Time_Second" = 0
+    Vectorized, see normalize.py
     :param df:  Dataframe with car transit info.
     :return: dataframe with travel time added "Travel_Time_Second"
     """
-
-    def get_time(row):
-        """ Add time trave to a dataframe row"""
-        seconds_travel = 0
-        try:
-
-            timestamp = datetime.datetime.strptime(row['D_Date'] + " @ " +
-                                                   row['T_Time'],
-                                                   "%Y-%m-%d @ %H:%M:%S")
-            timestamp_sg = (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
-
-            if row["N_Obu_Payment"] != 0 and row["N_Obu_Entry_Ok"] == 0:
-                # If we have a valid obu with a valid entry info
-                timestamp_in = datetime.datetime.strptime(row['D_Obu_Entry_Date'] +
-                                                          " @ " +
-                                                          row["T_Obu_Entry_Time"],
-                                                          "%Y-%m-%d @ %H:%M:%S")
-                timestamp_in_sg = (timestamp_in - datetime.datetime(1970, 1, 1)).total_seconds()
-                seconds_travel = timestamp_sg - timestamp_in_sg
-        except Exception as e:
-            print(e)
-            pass
-        return int(seconds_travel)
-    df["Travel_Time_Second"] = df.apply(get_time, axis=1)
-    return df
+    return normalize.add_travel_time(df)
 
 
 def add_raw_columns_names(df):
@@ -266,29 +598,162 @@ def add_raw_columns_names(df):
     return df
 
 
-def load_file_csv_to_raw(file_load):
-    """ Load file to raw table and aggr table"""
-    df = pd.read_csv(file_load,
-                     names=get_columns_from_list(TABLE_RAW_SCHEMA))
-    df[["Sz_Key"]] = df[["Sz_Key"]].astype(object)
-    client = get_client_bigquery()
-    create_table(DEFAULT_DATASET, TABLE_RAW, TABLE_RAW_SCHEMA, client)
-    create_table(DEFAULT_DATASET, TABLE_AGGR, TABLE_AGGR_SCHEMA, client)
-    add_travel_time(df)
-    write_df(df, TABLE_RAW)
-    # Windonize dataframe
-    window.window_add_dataframe(df)
-    # Get first window info, dataframe format
-    df_aggr_total = window.window_get_window_ready(0)
-    if df_aggr_total is not None:
-        # if we have info for first window, get info for next window
-        df_aggr = window.window_get_window_ready(0)
-        while df_aggr is not None:
-            # While we get info for a time window, add to the total info dataframe
-            df_aggr_total = df_aggr_total.append(df_aggr)
-            # Get info for the next dataframe
-            df_aggr = window.window_get_window_ready(0)
-        write_df(df_aggr_total, TABLE_AGGR)
+class BulkLoad:
+    """
+    Bulk load: dataframes are staged in compressed parquet files with the
+    table schema and loaded together with commit.
+    add .- Write a dataframe to a file of a table
+    add_windows .- Add aggr data and rollup windows
+    commit .- Load the files, a table with all its files or nothing,
+              the tables concurrently. Files are removed.
+              With a date, the files replace the day in all the tables.
+    """
+    def __init__(self, dataset=DEFAULT_DATASET):
+        """
+        :param dataset:
+        """
+        self.dataset = dataset
+        self.directory = tempfile.mkdtemp()
+        # Table: list of files
+        self.files = {}
+
+    def add(self, df, table_id):
+        """
+        Write a dataframe to a file
+        :param df: None or dataframe
+        :param table_id:
+        :return:
+        """
+        if df is None or len(df) == 0:
+            return
+        schema_list = get_table_schema(table_id)
+        lst_files = self.files.setdefault(table_id, [])
+        file_name = os.path.join(self.directory,
+                                 table_id + "_" + str(len(lst_files)) + ".parquet")
+        storage.write_parquet(get_typed_columns(df, schema_list), file_name, schema_list)
+        lst_files.append(file_name)
+        metrics.count("rows_out", len(df), table=table_id)
+
+    def add_windows(self, df_aggr, dict_rollups):
+        """
+        Add aggregate data of time windows and rollup windows
+        :param df_aggr: None or dataframe with data of time windows
+        :param dict_rollups: Dictionary, key window size in minutes,
+            value dataframe or None
+        :return:
+        """
+        self.add(df_aggr, TABLE_AGGR)
+        for resolution, df in dict_rollups.items():
+            self.add(df, get_table_rollup(resolution))
+
+    def commit(self, date=None):
+        """
+        Load all the files to the tables and remove them
+        :param date: None to add the rows. A date, String format YYYY-MM-DD,
+            to replace the day in raw, aggr and rollup tables, all the rows
+            must be of the date.
+        :return: dictionary, table, load duration in seconds
+        """
+        try:
+            if date is None:
+                jobs = [(table_id, get_storage().load_files,
+                         [lst_files, self.dataset, table_id, get_table_schema(table_id)])
+                        for table_id, lst_files in self.files.items()]
+            else:
+                jobs = [(table_id, replace_day_files,
+                         [date, self.files.get(table_id, []), table_id, self.dataset])
+                        for table_id, schema_list, partition_column, cluster_columns
+                        in get_tables()]
+            return run_jobs(jobs)
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = tempfile.mkdtemp()
+            self.files = {}
+
+
+def replace_day_files(date, lst_files, table_id, dataset=DEFAULT_DATASET):
+    """
+    Replace day info of a table with parquet files, atomic
+    :param date: String format YYYY-MM-DD
+    :param lst_files: files of BulkLoad, empty to remove the day info
+    :param table_id:
+    :param dataset:
+    :return:
+    """
+    if len(lst_files) == 0:
+        replace_day_table(date, None, table_id, dataset=dataset)
+    else:
+        get_storage().replace_partition_files(lst_files, dataset, table_id,
+                                              get_table_schema(table_id),
+                                              get_table_partition(table_id), date)
+
+
+def get_rollups_ready(df_aggr):
+    """
+    :param df_aggr: None or dataframe with data of time windows closed
+    :return: Dictionary of rollup windows closed with them, see
+        window.window_get_rollups_ready
+    """
+    if df_aggr is None:
+        return {}
+    return window.window_get_rollups_ready()
+
+
+def merge_df_windows(df_aggr, dict_rollups):
+    """
+    Merge aggregate data of time windows to aggr table and the rollup
+    windows to the rollup tables, in default dataset.
+    Corrections of windows already in the tables are added to them.
+    The tables are merged concurrently.
+    :param df_aggr: None or dataframe with data of time windows
+    :param dict_rollups: Dictionary, key window size in minutes,
+        value dataframe or None
+    :return: dictionary, table, merge duration in seconds
+    """
+    jobs = []
+    if df_aggr is not None:
+        jobs.append((TABLE_AGGR, merge_df_aggr, [df_aggr, TABLE_AGGR]))
+    for resolution, df in dict_rollups.items():
+        if df is not None:
+            jobs.append((get_table_rollup(resolution), merge_df_aggr,
+                         [df, get_table_rollup(resolution)]))
+    return run_jobs(jobs)
+
+
+def load_file_csv_to_raw(file_load, chunk_rows=None, allowed_lateness=5):
+    """
+    Load file to raw table and aggr table.
+    With chunk_rows the file is read in chunks, every chunk is staged
+    to raw table and the windows closed by the chunk (event time watermark)
+    to aggr table, memory do not depend on the file size.
+    Files staged are loaded together at the end, see BulkLoad.
+    :param file_load: csv file, TABLE_RAW_SCHEMA columns
+    :param chunk_rows: rows by chunk, None to read all the file
+    :param allowed_lateness: minutes to wait for late data between chunks
+    :return: dictionary, table, load duration in seconds
+    """
+    create_tables(get_storage())
+    bulk = BulkLoad()
+    if chunk_rows is None:
+        chunks = [pd.read_csv(file_load,
+                              names=get_columns_from_list(TABLE_RAW_SCHEMA))]
+    else:
+        chunks = pd.read_csv(file_load,
+                             names=get_columns_from_list(TABLE_RAW_SCHEMA),
+                             chunksize=chunk_rows)
+    for df in chunks:
+        df[["Sz_Key"]] = df[["Sz_Key"]].astype(object)
+        add_travel_time(df)
+        bulk.add(df, TABLE_RAW)
+        # Windonize dataframe
+        window.window_add_dataframe(df)
+        if chunk_rows is not None:
+            df_aggr = window.window_get_windows_closed(allowed_lateness)
+            bulk.add_windows(df_aggr, get_rollups_ready(df_aggr))
+    # Get info for all the time windows, dataframe format
+    df_aggr = window.window_get_windows_ready(0)
+    bulk.add_windows(df_aggr, get_rollups_ready(df_aggr))
+    return bulk.commit()
 
 
 class TestBigQuery(unittest.TestCase):
@@ -297,12 +762,12 @@ class TestBigQuery(unittest.TestCase):
         """ Create a dataset and clean tables for test
         Called before test
         """
-        self.client = get_client_bigquery()
-        create_dataset(self.client, TEST_DATASET)
-        delete_table(TEST_DATASET, TABLE_RAW, self.client)
-        create_table(TEST_DATASET, TABLE_RAW, TABLE_RAW_SCHEMA, self.client)
-        delete_table(TEST_DATASET, TABLE_AGGR, self.client)
-        create_table(TEST_DATASET, TABLE_AGGR, TABLE_AGGR_SCHEMA, self.client)
+        self.storage = get_storage()
+        create_dataset(self.storage, TEST_DATASET)
+        for table_id, schema_list, partition_column, cluster_columns in get_tables():
+            delete_table(TEST_DATASET, table_id, self.storage)
+            delete_table(TEST_DATASET, storage.get_batch_table(table_id), self.storage)
+        create_tables(self.storage, dataset=TEST_DATASET)
 
     def test_remove_operation(self):
         date_remove = "2018-01-01"
@@ -312,7 +777,7 @@ class TestBigQuery(unittest.TestCase):
         assert df_read.shape[0] > 0
         df_read = read_df_from_raw(date_remove, dataset=TEST_DATASET)
         assert df_read.shape[0] > 0
-        delete_day(date_remove, self.client, dataset=TEST_DATASET)
+        delete_day(date_remove, self.storage, dataset=TEST_DATASET)
         df_read = read_df_from_aggr(date_remove, dataset=TEST_DATASET)
         assert df_read.shape[0] == 0
         df_read = read_df_from_raw(date_remove, dataset=TEST_DATASET)
@@ -349,8 +814,8 @@ class TestBigQuery(unittest.TestCase):
     def test_aggr_opperation(self):
         def create_df_test_aggr(columns_name):
             """ For test use"""
-            lst = [[6, 2, "2018-01-01", "00:00:00", 1, 2],
-                   [6, 2, "2018-01-01", "00:00:00", 6, 7]
+            lst = [[6, 2, "2018-01-01", "00:00:00", 1, 2, "", 6],
+                   [6, 2, "2018-01-01", "00:00:00", 6, 7, "", 6]
                    ]
             return pd.DataFrame(lst,
                                 columns=columns_name)
@@ -361,6 +826,139 @@ class TestBigQuery(unittest.TestCase):
         df_read = read_df_from_aggr("2018-01-01", dataset=TEST_DATASET)
         assert df_read.equals(df_test)
 
+    def test_typed_columns(self):
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 2, "", 6],
+                                [6, 2, "2018-01-02", "10:02", 6, 7, "", 6]],
+                               columns=get_columns_from_list(TABLE_AGGR_SCHEMA))
+        write_df(df_test, TABLE_AGGR, dataset=TEST_DATASET)
+        # Dataframe is not changed, times are HH:MM:SS in the table
+        assert list(df_test["Time"]) == ["00:01", "10:02"]
+        df_read = read_df_from_aggr("2018-01-02", dataset=TEST_DATASET)
+        assert list(df_read["Date"]) == ["2018-01-02", "2018-01-02"]
+        assert list(df_read["Time"]) == ["00:01:00", "10:02:00"]
+
+    def test_replace_day(self):
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 2, "", 6],
+                                [6, 2, "2018-01-03", "00:02", 6, 7, "", 6]],
+                               columns=get_columns_from_list(TABLE_AGGR_SCHEMA))
+        write_df(df_test, TABLE_AGGR, dataset=TEST_DATASET)
+        write_df(df_test, TABLE_AGGR, dataset=TEST_DATASET)
+        # Load again a day replace it, other days are not changed
+        replace_day("2018-01-02", None, df_test.iloc[:1], {}, dataset=TEST_DATASET)
+        replace_day("2018-01-02", None, df_test.iloc[:1], {}, dataset=TEST_DATASET)
+        assert read_df_from_aggr("2018-01-02", dataset=TEST_DATASET)["AHT"].tolist() == [1]
+        assert read_df_from_aggr("2018-01-03", dataset=TEST_DATASET)["AHT"].tolist() == [6, 6]
+        replace_day("2018-01-03", None, None, {}, dataset=TEST_DATASET)
+        assert read_df_from_aggr("2018-01-03", dataset=TEST_DATASET).shape[0] == 0
+
+    def test_bulk_load(self):
+        columns = get_columns_from_list(TABLE_AGGR_SCHEMA)
+        bulk = BulkLoad(dataset=TEST_DATASET)
+        bulk.add(pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 2, "", 6]], columns=columns),
+                 TABLE_AGGR)
+        bulk.add(pd.DataFrame([[6, 2, "2018-01-02", "00:02", 3, 0, "", 6]], columns=columns),
+                 TABLE_AGGR)
+        bulk.add(pd.DataFrame([[6, 2, "2018-01-02", "00:00", 4, 2, "", 6]], columns=columns),
+                 get_table_rollup(5))
+        # Nothing loaded before commit
+        assert read_df_from_aggr("2018-01-02", dataset=TEST_DATASET).shape[0] == 0
+        durations = bulk.commit()
+        assert sorted(durations.keys()) == [TABLE_AGGR, get_table_rollup(5)]
+        df_read = read_df_from_aggr("2018-01-02", dataset=TEST_DATASET)
+        assert df_read["Time"].tolist() == ["00:01:00", "00:02:00"]
+        assert df_read["AHT"].tolist() == [1, 3]
+        # Replace the day
+        bulk.add(pd.DataFrame([[6, 2, "2018-01-02", "00:03", 5, 0, "", 6]], columns=columns),
+                 TABLE_AGGR)
+        bulk.commit("2018-01-02")
+        assert read_df_from_aggr("2018-01-02", dataset=TEST_DATASET)["AHT"].tolist() == [5]
+
+    def test_run_jobs(self):
+        def job_fail(seconds):
+            time.sleep(seconds)
+            raise ValueError("Job failed")
+        durations = run_jobs([("sleep_" + str(n), time.sleep, [0.2]) for n in range(4)])
+        assert sorted(durations.keys()) == ["sleep_0", "sleep_1", "sleep_2", "sleep_3"]
+        assert min(durations.values()) >= 0.2
+        with self.assertRaises(ValueError):
+            run_jobs([("sleep", time.sleep, [0.1]), ("fail", job_fail, [0])])
+        with self.assertRaises(TimeoutError):
+            run_jobs([("sleep", time.sleep, [0.5])], timeout=0.1)
+
+    def test_merge_aggr(self):
+        columns = get_columns_from_list(TABLE_AGGR_SCHEMA)
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 3, 0, "", 6],
+                                [6, 2, "2018-01-02", "00:02", 6, 70, "17:2", 6]],
+                               columns=columns)
+        merge_df_aggr(df_test, TABLE_AGGR, dataset=TEST_DATASET)
+        # Corrections, added to the minute rows
+        df_correction = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 50, "10:1", 6],
+                                      [6, 2, "2018-01-02", "00:01", 1, 40, "5:1", 6],
+                                      [6, 2, "2018-01-02", "00:02", 1, 80, "17:1", 6],
+                                      [6, 1, "2018-01-02", "00:02", 2, 0, "", 6]],
+                                     columns=columns)
+        merge_df_aggr(df_correction, TABLE_AGGR, dataset=TEST_DATASET)
+        df_read = read_df_from_aggr("2018-01-02", dataset=TEST_DATASET).\
+            sort_values(["Time", "Destination"])
+        assert df_read["AHT"].tolist() == [5, 2, 7]
+        assert df_read["Travel_Time"].tolist() == [40, 0, 70]
+        # Sketches are joined, a bucket can be repeated
+        assert [sketch.get_sketch_from_string(text) for text in df_read["Travel_Time_Sketch"]] == \
+            [{10: 1, 5: 1}, {}, {17: 3}]
+
+    def test_merge_batch(self):
+        columns = get_columns_from_list(TABLE_AGGR_SCHEMA)
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 3, 50, "10:3", 6]], columns=columns)
+        df_raw = pd.DataFrame([[0, 6, 2, "2018-01-02", "00:00:00", "55555", 6, 7, 8, 9, 10, 8,
+                                "2018-01-02", "01:00:00", 13, 14]],
+                              columns=get_columns_from_list(TABLE_RAW_SCHEMA))
+        # A batch written again, e.g. a retry, is not added again
+        for _ in range(2):
+            merge_df_aggr(df_test, TABLE_AGGR, dataset=TEST_DATASET, batch_id="batch_1")
+            write_df(df_raw, TABLE_RAW, dataset=TEST_DATASET, batch_id="batch_1")
+        merge_df_aggr(df_test, get_table_rollup(5), dataset=TEST_DATASET, batch_id="batch_1")
+        assert read_df_from_aggr("2018-01-02", dataset=TEST_DATASET)["AHT"].tolist() == [3]
+        assert read_df_from_raw("2018-01-02", dataset=TEST_DATASET).shape[0] == 1
+        # Other batch is added
+        merge_df_aggr(df_test, TABLE_AGGR, dataset=TEST_DATASET, batch_id="batch_2")
+        df_read = read_df_from_aggr("2018-01-02", dataset=TEST_DATASET)
+        assert df_read["AHT"].tolist() == [6]
+        assert df_read["Travel_Time_Sketch"].tolist() == ["10:3,10:3"]
+        df_read = self.storage.read_sql("select AHT from " + TEST_DATASET + "." +
+                                        get_table_rollup(5))
+        assert df_read["AHT"].tolist() == [3]
+
+    def test_travel_time_quantiles(self):
+        def get_sketch_string(lst_travel_time):
+            return sketch.get_sketch_string(sketch.get_sketch(pd.Series(lst_travel_time).values))
+
+        def get_value(travel_time):
+            return sketch.get_quantiles(sketch.get_sketch(pd.Series([travel_time]).values), [1])[0]
+        columns = get_columns_from_list(TABLE_AGGR_SCHEMA)
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 10, 600, get_sketch_string([600] * 10), 6],
+                                [6, 1, "2018-01-02", "00:01", 3, 0, "", 6],
+                                [6, 2, "2018-01-02", "00:02", 12, 900,
+                                 get_sketch_string([900] * 10), 6],
+                                [6, 2, "2018-01-03", "00:00", 20, 1200,
+                                 get_sketch_string([1200] * 20), 6]],
+                               columns=columns)
+        write_df(df_test, TABLE_AGGR, dataset=TEST_DATASET)
+        # A minute
+        df_quantiles = read_travel_time_quantiles("2018-01-02", time_from="00:01", time_to="00:01",
+                                                  dataset=TEST_DATASET)
+        assert list(df_quantiles.columns) == ["Source", "Destination", "AHT", "P50", "P85", "P95"]
+        assert df_quantiles.values.tolist() == [[6, 1, 3, 0, 0, 0],
+                                                [6, 2, 10] + [get_value(600)] * 3]
+        # A day
+        df_quantiles = read_travel_time_quantiles("2018-01-02", dataset=TEST_DATASET)
+        assert df_quantiles.values.tolist()[1] == [6, 2, 22, get_value(600), get_value(900),
+                                                   get_value(900)]
+        # Some minutes of two days
+        df_quantiles = read_travel_time_quantiles("2018-01-02", "2018-01-03", "00:02", "00:00",
+                                                  quantiles=[0.25, 0.5], dataset=TEST_DATASET)
+        assert df_quantiles.values.tolist() == [[6, 2, 32, get_value(900), get_value(1200)]]
+        assert abs(get_value(1200) - 1200) <= 0.025 * 1200
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -368,7 +966,22 @@ if __name__ == "__main__":
                         '--file_to_raw',
                         dest='input',
                         help='Input file to process.')
+    parser.add_argument('--chunk_rows',
+                        type=int,
+                        default=None,
+                        help='Read and load the file in chunks of rows.')
+    parser.add_argument('--lateness',
+                        type=int,
+                        default=5,
+                        help='With chunks, minutes to wait for late data.')
+    parser.add_argument('--local',
+                        default=None,
+                        help='Local storage directory, not big query.')
     known_args, other_args = parser.parse_known_args()
+    if known_args.local is not None:
+        set_storage(storage.LocalStorage(known_args.local))
 
     if known_args.input is not None:
-        load_file_csv_to_raw(known_args.input)
+        print_jobs(load_file_csv_to_raw(known_args.input,
+                                        chunk_rows=known_args.chunk_rows,
+                                        allowed_lateness=known_args.lateness))
@@ -0,0 +1,389 @@
+"""
+Change-feed sources for the loader.
+A source gives the new rows of a station and a day, mysql dataframes (see
+mysql.get_data_chunks) with index higher than the last index read,
+and waits for new rows. Stations can be read at the same time.
+    PollSource .- Query mysql and sleep --wait_seconds (60) between polls.
+    BinlogSource .- Row based replication. The day is read with a query and
+        then the inserted rows are read from the binlog, as a replica, a
+        transit is loaded seconds after it is written and mysql does not
+        run a query every cycle. Needs binlog_format=ROW, a user with
+        REPLICATION SLAVE and REPLICATION CLIENT grants and the
+        python-mysql-replication package.
+    FileSource .- Tail of a csv file with the columns of the mysql query,
+        offline. A file is replayed and the rows added later are read.
+Use:
+    source = PollSource(mysql_pool)
+    for df in source.read(day, last_index, station): ...
+    source.wait() .- Wait for new rows
+    source.close()
+"""
+
+import datetime
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import pandas as pd
+import generator
+import mysql
+
+# Seconds between polls of the mysql table
+POLL_SECONDS = 60
+# Seconds between reads of the binlog or the file
+WAIT_SECONDS = 2
+# Replication client id, unique among the replicas of the server
+SERVER_ID = 4061
+# Null value in csv files, as mysql select into outfile
+NULL_VALUE = "\\N"
+# Columns of csv files, by position
+FILE_DATE_COLUMNS = [3, 12]
+FILE_TIME_COLUMNS = [4, 13]
+
+
+class PollSource:
+    """
+    Poll mysql, rows with index higher than the last index read
+    """
+    def __init__(self, mysql_pool, chunk_rows=mysql.CHUNK_ROWS,
+                 wait_seconds=POLL_SECONDS):
+        """
+        :param mysql_pool: mysql.ConnectionPool
+        :param chunk_rows: rows by chunk
+        :param wait_seconds: seconds between polls
+        """
+        self.mysql_pool = mysql_pool
+        self.chunk_rows = chunk_rows
+        self.wait_seconds = wait_seconds
+
+    def read(self, date_load, last_index, station=mysql.STATION):
+        """
+        New rows of a station and a day
+        :param date_load: day, String YYYY-MM-DD
+        :param last_index: last index read
+        :param station: toll station
+        :return: generator of mysql dataframes
+        """
+        return mysql.get_data_chunks(self.mysql_pool, date_load, last_index,
+                                     self.chunk_rows, station)
+
+    def wait(self):
+        """ Wait for new rows"""
+        time.sleep(self.wait_seconds)
+
+    def close(self):
+        pass
+
+
+class BinlogSource(PollSource):
+    """
+    Row based replication of the mysql table.
+    The first read of a station and a day is a query, the binlog position
+    is taken before the first query, rows inserted while the query runs are
+    read from the binlog again and skipped by index. If the binlog stream is
+    lost, the next read of every station is a query.
+    A stream for all the stations and days, binlog rows are kept by station
+    and day until they are read, rows of days older than the day before
+    the day read are discarded.
+    """
+    def __init__(self, mysql_pool, chunk_rows=mysql.CHUNK_ROWS,
+                 wait_seconds=WAIT_SECONDS, server_id=SERVER_ID, stations=None):
+        """
+        :param mysql_pool: mysql.ConnectionPool
+        :param chunk_rows: rows by chunk
+        :param wait_seconds: seconds between binlog reads
+        :param server_id: replication client id
+        :param stations: list of toll stations, None for the default station
+        """
+        super().__init__(mysql_pool, chunk_rows, wait_seconds)
+        self.server_id = server_id
+        self.stations = set(stations or [mysql.STATION])
+        self.lock = threading.Lock()
+        self.stream = None
+        # (station, day) read with a query since the stream was opened
+        self.stations_read = set()
+        # Binlog rows not read, (station, day): list of rows
+        self.pending = {}
+
+    def open_stream(self):
+        """ Open the binlog stream from the current position"""
+        # Optional dependency, only for this source
+        from pymysqlreplication import BinLogStreamReader
+        from pymysqlreplication.row_event import WriteRowsEvent
+        with self.mysql_pool.query("show master status") as cursor:
+            log_file, log_pos = cursor.fetchone()[:2]
+        self.stream = BinLogStreamReader(connection_settings=mysql.get_connection_settings(),
+                                         server_id=self.server_id,
+                                         only_schemas=[mysql.QUERY_SCHEMA],
+                                         only_tables=[mysql.QUERY_TABLE],
+                                         only_events=[WriteRowsEvent],
+                                         log_file=log_file, log_pos=log_pos,
+                                         resume_stream=True, blocking=False)
+
+    def close(self):
+        """ Close the binlog stream, next reads are queries"""
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.stations_read = set()
+        self.pending = {}
+
+    def read(self, date_load, last_index, station=mysql.STATION):
+        """
+        New rows of a station and a day, a query the first time of the day,
+        later from the binlog
+        :param date_load: day, String YYYY-MM-DD
+        :param last_index: last index read
+        :param station: toll station
+        :return: generator of mysql dataframes
+        """
+        with self.lock:
+            if self.stream is None:
+                self.open_stream()
+            query = (station, date_load) not in self.stations_read
+            self.stations_read.add((station, date_load))
+        if query:
+            return super().read(date_load, last_index, station)
+        return self.read_stream(date_load, last_index, station)
+
+    def read_pending(self):
+        """ Keep the binlog rows inserted since the last read, without wait"""
+        try:
+            for event in self.stream:
+                for row in event.rows:
+                    values = row["values"]
+                    if values["N_Estacion_C"] in self.stations:
+                        self.pending.setdefault((values["N_Estacion_C"], str(values["D_Data_C"])),
+                                                []).append(values)
+        except Exception as error:
+            # Stream lost, next read is a query from the last index
+            print("Binlog stream lost: " + str(error))
+            self.close()
+
+    def read_stream(self, date_load, last_index, station):
+        """
+        Rows of a station inserted since the last read
+        :param date_load: day, String YYYY-MM-DD
+        :param last_index: last index read
+        :param station: toll station
+        :return: generator of mysql dataframes
+        """
+        with self.lock:
+            if self.stream is not None:
+                self.read_pending()
+            lst_values = self.pending.pop((station, date_load), [])
+            # Days not read any more
+            oldest = str(datetime.datetime.strptime(date_load, "%Y-%m-%d").date() -
+                         datetime.timedelta(days=1))
+            self.pending = {key: rows for key, rows in self.pending.items() if key[1] >= oldest}
+        for start in range(0, len(lst_values), self.chunk_rows):
+            df = get_binlog_dataframe(lst_values[start:start + self.chunk_rows],
+                                      date_load, last_index, station)
+            if df is not None:
+                yield df
+
+
+class FileSource(PollSource):
+    """
+    Tail of a csv file, rows with the columns of the mysql query,
+    without header, dates YYYY-MM-DD, times HH:MM:SS, null \\N.
+    Only complete lines are read.
+    """
+    def __init__(self, file_name, wait_seconds=WAIT_SECONDS):
+        """
+        :param file_name: csv file
+        :param wait_seconds: seconds between reads
+        """
+        super().__init__(None, wait_seconds=wait_seconds)
+        self.file_name = file_name
+        # By (station, day), position of the first line not read
+        self.positions = {}
+
+    def read(self, date_load, last_index, station=mysql.STATION):
+        """
+        Rows of a station and a day added to the file since the last read
+        :param date_load: day, String YYYY-MM-DD
+        :param last_index: last index read
+        :param station: toll station
+        :return: generator of mysql dataframes
+        """
+        if not os.path.exists(self.file_name):
+            return
+        # A new day is replayed from the start of the file
+        position = self.positions.get((station, date_load), 0)
+        with open(self.file_name, "rb") as file_read:
+            file_read.seek(position)
+            data = file_read.read()
+        # Last line not complete, read it later
+        data = data[:data.rfind(b"\n") + 1]
+        if len(data) == 0:
+            return
+        self.positions[(station, date_load)] = position + len(data)
+        df = get_file_dataframe(data.decode(), date_load, last_index, station)
+        if len(df) > 0:
+            yield df
+
+
+def get_binlog_dataframe(lst_values, date_load, last_index, station=mysql.STATION):
+    """
+    Rows of the query from binlog rows, ordered by time
+    :param lst_values: list of dictionaries, column: value
+    :param date_load: day, String YYYY-MM-DD
+    :param last_index: last index read
+    :param station: toll station
+    :return: None or mysql dataframe
+    """
+    rows = [tuple(values[column] for column in mysql.QUERY_COLUMNS)
+            for values in lst_values
+            if mysql.is_query_row(values, date_load, last_index, station)]
+    if len(rows) == 0:
+        return None
+    df = mysql.get_dataframe(rows)
+    return df.sort_values(4, kind="mergesort").reset_index(drop=True)
+
+
+def get_file_dataframe(text, date_load, last_index, station=mysql.STATION):
+    """
+    Csv lines of a station and a day to mysql dataframe, dates datetime.date,
+    times datetime.timedelta. Rows are filtered before the conversion,
+    only the distinct dates are parsed. A date not valid (e.g. 2018-13-01)
+    is None, as MySQLdb reads it.
+    :param text: csv lines
+    :param date_load: day, String YYYY-MM-DD
+    :param last_index: last index read
+    :param station: toll station
+    :return: mysql dataframe, rows of the station and the day with index
+        higher than last_index
+    """
+    df = pd.read_csv(io.StringIO(text), header=None,
+                     names=range(len(mysql.QUERY_COLUMNS)),
+                     na_values=[NULL_VALUE], keep_default_na=False, dtype=str)
+    df = df[(df[1].astype("int64") == station) & (df[3] == str(date_load)) &
+            (df[mysql.INDEX_COLUMN].astype("int64") > last_index)].reset_index(drop=True)
+    for column in df.columns:
+        if column in FILE_DATE_COLUMNS:
+            codes, uniques = pd.factorize(df[column])
+            parsed = pd.to_datetime(pd.Series(uniques, dtype=object),
+                                    format="%Y-%m-%d", errors="coerce")
+            dates = np.array([None if pd.isnull(value) else value.date()
+                              for value in parsed] + [None], dtype=object)
+            # None has code -1, the last value
+            df[column] = dates[codes]
+        elif column in FILE_TIME_COLUMNS:
+            df[column] = pd.to_timedelta(df[column]).fillna(pd.Timedelta(0))
+        elif column in mysql.INTEGER_COLUMNS:
+            df[column] = df[column].astype("int64")
+    return df
+
+
+def write_file(df, file_name):
+    """
+    Add rows to a csv file of FileSource
+    :param df: mysql dataframe
+    :param file_name:
+    :return:
+    """
+    df_write = df.copy()
+    for column in FILE_TIME_COLUMNS:
+        df_write[column] = ['{:02d}:{:02d}:{:02d}'.format(value.seconds // 3600,
+                                                          value.seconds // 60 % 60,
+                                                          value.seconds % 60)
+                            for value in df_write[column]]
+    df_write.to_csv(file_name, mode="a", header=False, index=False,
+                    na_rep=NULL_VALUE)
+
+
+class TestFeed(unittest.TestCase):
+    def get_rows(self, lst_index, day=datetime.date(2018, 1, 2), station=6):
+        return pd.DataFrame([(0, station, 2, day, datetime.timedelta(hours=1, seconds=index),
+                              "55555", 6, 7, 8, 0, 5, 8, None, datetime.timedelta(0), 13,
+                              index) for index in lst_index])
+
+    def test_file_source(self):
+        file_name = os.path.join(tempfile.mkdtemp(), "feed.csv")
+        source = FileSource(file_name)
+        assert list(source.read("2018-01-02", 0)) == []
+        write_file(self.get_rows([1, 2, 3]), file_name)
+        write_file(self.get_rows([4], day=datetime.date(2018, 1, 3)), file_name)
+        lst_df = list(source.read("2018-01-02", 1))
+        assert len(lst_df) == 1
+        df = lst_df[0]
+        assert df[mysql.INDEX_COLUMN].tolist() == [2, 3]
+        assert df[3].tolist() == [datetime.date(2018, 1, 2)] * 2
+        assert df[4].tolist() == [datetime.timedelta(hours=1, seconds=2),
+                                  datetime.timedelta(hours=1, seconds=3)]
+        assert df[12].tolist() == [None, None]
+        # A line not complete is read when it is complete
+        write_file(self.get_rows([5]), file_name)
+        with open(file_name, "a") as file_write:
+            file_write.write("0,6,2,2018-01-02")
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-02", 3)] == [[5]]
+        with open(file_name, "a") as file_write:
+            file_write.write(",02:00:00,55555,6,7,8,0,5,8,\\N,00:00:00,13,6\n")
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-02", 5)] == [[6]]
+        # Next day
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-03", 0)] == [[4]]
+        # Days are read at the same time, the previous day is not replayed
+        assert list(source.read("2018-01-02", 0)) == []
+        # Other station, read from the start of the file
+        write_file(self.get_rows([7, 8], day=datetime.date(2018, 1, 3), station=7), file_name)
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-03", 0, station=7)] == [[7, 8]]
+        assert list(source.read("2018-01-03", 4)) == []
+
+    def test_file_generator(self):
+        # Generator rows with the default shares, malformed obu entry dates
+        df = generator.create_mysql_transits("2018-01-02", 20000, seed=2)
+        assert (df[12] == generator.MALFORMED_DATE).any()
+        file_name = os.path.join(tempfile.mkdtemp(), "feed.csv")
+        write_file(df, file_name)
+        df_read = pd.concat(FileSource(file_name).read("2018-01-02", 0))
+        assert len(df_read) == len(df)
+        for column in df.columns:
+            if column == 12:
+                expected = [None if value == generator.MALFORMED_DATE else value
+                            for value in df[column]]
+            else:
+                expected = df[column].tolist()
+            assert df_read[column].tolist() == expected, column
+
+    def test_binlog_rows(self):
+        df = self.get_rows([1, 2, 3])
+        df.columns = mysql.QUERY_COLUMNS
+        lst_values = [dict(values, N_Avance_X=0) for values in df.to_dict("records")]
+        # Not a query row
+        lst_values[0]["N_Avance_X"] = 1
+        # Later transit first
+        lst_values[1]["T_Hora_C"] = datetime.timedelta(hours=2)
+        df_binlog = get_binlog_dataframe(lst_values, "2018-01-02", 0)
+        assert df_binlog[mysql.INDEX_COLUMN].tolist() == [3, 2]
+        assert get_binlog_dataframe(lst_values, "2018-01-02", 3) is None
+
+    def test_binlog_stations(self):
+        class Event:
+            def __init__(self, df):
+                df.columns = mysql.QUERY_COLUMNS
+                self.rows = [{"values": dict(values, N_Avance_X=0)}
+                             for values in df.to_dict("records")]
+        source = BinlogSource(None, chunk_rows=2, stations=[6, 7])
+        source.stream = iter([Event(self.get_rows([1, 2, 3])),
+                              Event(self.get_rows([4, 5], station=7)),
+                              Event(self.get_rows([6], station=8)),
+                              Event(self.get_rows([7], day=datetime.date(2018, 1, 3))),
+                              Event(self.get_rows([8], day=datetime.date(2017, 12, 31)))])
+        source.stations_read = {(6, "2018-01-02"), (7, "2018-01-02"), (6, "2018-01-03")}
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-02", 0, 6)] == [[1, 2], [3]]
+        # Rows of station 7 and of the next day were kept, station 8 is not loaded
+        # and the rows of an old day are discarded
+        assert sorted(source.pending.keys()) == [(6, "2018-01-03"), (7, "2018-01-02")]
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-02", 4, 7)] == [[5]]
+        assert [df[mysql.INDEX_COLUMN].tolist()
+                for df in source.read("2018-01-03", 0, 6)] == [[7]]
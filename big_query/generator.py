@@ -0,0 +1,227 @@
+"""
+Synthetic car transits of the Cecebre toll, to test and benchmark the
+loader without the production mysql.
+Rows like mysql.get_data (columns by position, dates datetime.date,
+times datetime.timedelta, index column) or TABLE_RAW_SCHEMA rows:
+    Routes .- Sources and destinations of the toll (dash/apps/toll_info.py),
+              most of the cars from Santiago to Corunha
+    Volume .- Daily curve by hour, morning and evening peaks, and weekly
+               curve by day of the week
+    Obu .- OBU_SHARE of the cars pay with an obu, the entry time is the
+           transit time minus the travel time of the source
+    Late .- LATE_SHARE of the cars arrive up to LATE_SECONDS late, the
+            rows are ordered by arrival (index), not by time
+    Malformed .- MALFORMED_SHARE of the obu entry dates are not valid
+Use:
+    generator.py Date .- Print a day of 100000 cars, mysql csv (feed.write_file)
+    generator.py Date --rows N --days D --file file.csv .- D days from Date,
+                                       N cars by day before the weekly curve
+    create_mysql_transits("2018-01-02", 100000)
+    create_transits("2018-01-02", 100000)
+    for day, df in create_days("2018-01-01", 7, 100000): ...
+"""
+
+import argparse
+import datetime
+import unittest
+import numpy as np
+import pandas as pd
+import big_query as bq
+import mysql
+import normalize
+
+# Cecebre toll, see dash/apps/toll_info.py
+STATION = mysql.STATION
+# Share of the cars by route (source, destination)
+# Sources: 13 Santiago, 12 Sigueiro, 11 Ordes, 8 Macenda
+# Destinations: 1 Corunha, 5 Ferrol
+ROUTE_SHARES = {(13, 1): 0.40, (12, 1): 0.12, (11, 1): 0.10, (8, 1): 0.08,
+                (13, 5): 0.14, (12, 5): 0.06, (11, 5): 0.05, (8, 5): 0.05}
+# Seconds from the source to the toll, at 100 km/h
+TRAVEL_SECONDS = {13: 1600, 12: 1400, 11: 900, 8: 240}
+# Share of the cars of a day by hour
+HOUR_SHARES = [0.8, 0.5, 0.3, 0.3, 0.4, 0.9, 2.5, 5.5, 7.5, 6.0, 5.0, 5.0,
+               5.5, 6.0, 5.5, 5.0, 5.5, 6.5, 7.0, 6.5, 5.0, 3.5, 2.5, 1.5]
+# Cars of a day by day of the week (monday first), by the cars of a monday
+WEEKDAY_SHARES = [1.0, 0.97, 0.98, 1.02, 1.15, 0.8, 0.75]
+# Cars paying with an obu
+OBU_SHARE = 0.35
+# Obu cars with a not valid entry (N_Obu_Entry_Ok != 0)
+OBU_ERROR_SHARE = 0.02
+# Cars arriving late, up to LATE_SECONDS
+LATE_SHARE = 0.005
+LATE_SECONDS = 600
+# Obu entry dates not valid, half null (0000-00-00) and half a wrong date
+MALFORMED_SHARE = 0.001
+MALFORMED_DATE = "2018-13-01"
+# Lanes of the toll, the mysql query reads lanes < 20
+LANES = 19
+
+
+def get_day_rows(date, rows_day):
+    """
+    :param date: day, String YYYY-MM-DD
+    :param rows_day: cars of a monday
+    :return: cars of the day, weekly curve
+    """
+    weekday = datetime.datetime.strptime(date, "%Y-%m-%d").weekday()
+    return int(rows_day * WEEKDAY_SHARES[weekday])
+
+
+def create_mysql_transits(date, n_rows, seed=0, first_index=1,
+                          obu_share=OBU_SHARE, late_share=LATE_SHARE,
+                          malformed_share=MALFORMED_SHARE):
+    """
+    Create the cars of a day like mysql.get_data, with index column,
+    ordered by arrival (index)
+    :param date: day, String YYYY-MM-DD
+    :param n_rows: number of cars
+    :param seed: random seed
+    :param first_index: index and message number of the first car
+    :param obu_share: cars with obu
+    :param late_share: cars arriving late
+    :param malformed_share: obu entry dates not valid
+    :return: dataframe, columns by position
+    """
+    rnd = np.random.RandomState(seed)
+    day = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    # Time of the cars, daily curve
+    hour_shares = np.array(HOUR_SHARES) / np.sum(HOUR_SHARES)
+    seconds = np.sort(rnd.choice(24, n_rows, p=hour_shares) * 3600 +
+                      rnd.randint(0, 3600, n_rows))
+    # Arrival, late cars are read after cars with a newer time
+    late = rnd.random_sample(n_rows) < late_share
+    arrival = seconds + np.where(late, rnd.randint(1, LATE_SECONDS + 1, n_rows), 0)
+    order = np.argsort(arrival, kind="mergesort")
+    seconds = seconds[order]
+    # Routes
+    routes = list(ROUTE_SHARES.keys())
+    route_codes = rnd.choice(len(routes), n_rows,
+                             p=np.array(list(ROUTE_SHARES.values())) / sum(ROUTE_SHARES.values()))
+    sources = np.array([source for source, _ in routes])[route_codes]
+    destinations = np.array([destination for _, destination in routes])[route_codes]
+    # Obu, entry time is the time minus the travel time, can be the day before
+    obu = rnd.random_sample(n_rows) < obu_share
+    obu_error = obu & (rnd.random_sample(n_rows) < OBU_ERROR_SHARE)
+    travel = (np.vectorize(TRAVEL_SECONDS.get)(sources) *
+              rnd.lognormal(0.1, 0.15, n_rows)).astype(np.int64)
+    entry = seconds - travel
+    entry_dates = np.array([day, day - datetime.timedelta(days=1)],
+                           dtype=object)[(entry < 0).astype(int)]
+    entry_dates[~obu] = None
+    malformed = obu & (rnd.random_sample(n_rows) < malformed_share)
+    entry_dates[malformed] = np.where(rnd.randint(0, 2, n_rows) == 0,
+                                      None, MALFORMED_DATE)[malformed]
+    entry = np.where(obu, entry % (24 * 3600), 0)
+    index = np.arange(first_index, first_index + n_rows)
+    return pd.DataFrame({
+        0: index,
+        1: STATION,
+        2: rnd.randint(1, LANES + 1, n_rows),
+        3: np.array([day] * n_rows, dtype=object),
+        4: pd.to_timedelta(seconds, unit="s").to_pytimedelta(),
+        5: "55555",
+        6: sources,
+        7: destinations,
+        8: 8,
+        9: obu_error.astype(np.int64),
+        10: obu.astype(np.int64),
+        11: np.where(obu, sources, 0),
+        12: entry_dates,
+        13: pd.to_timedelta(entry, unit="s").to_pytimedelta(),
+        14: np.where(obu, rnd.randint(1, 5, n_rows), 0),
+        mysql.INDEX_COLUMN: index}, columns=range(mysql.INDEX_COLUMN + 1))
+
+
+def create_transits(date, n_rows, seed=0, first_index=1, **kwargs):
+    """
+    Create the cars of a day, TABLE_RAW_SCHEMA columns, ordered by arrival.
+    See create_mysql_transits
+    :param date: day, String YYYY-MM-DD
+    :param n_rows: number of cars
+    :param seed: random seed
+    :param first_index: message number of the first car
+    :param kwargs: shares of create_mysql_transits
+    :return: dataframe
+    """
+    df = create_mysql_transits(date, n_rows, seed, first_index, **kwargs)
+    return normalize.normalize_mysql(df.drop(columns=mysql.INDEX_COLUMN))
+
+
+def create_days(first_day, n_days, rows_day, seed=0, raw=False):
+    """
+    Create the cars of some days, weekly curve, indexes go on between days
+    :param first_day: day, String YYYY-MM-DD
+    :param n_days: number of days
+    :param rows_day: cars of a monday
+    :param seed: random seed of the first day
+    :param raw: True for TABLE_RAW_SCHEMA dataframes, False for mysql dataframes
+    :return: generator of tuples (day, dataframe)
+    """
+    start = datetime.datetime.strptime(first_day, "%Y-%m-%d").date()
+    first_index = 1
+    for n_day in range(n_days):
+        day = (start + datetime.timedelta(days=n_day)).strftime("%Y-%m-%d")
+        n_rows = get_day_rows(day, rows_day)
+        if raw:
+            yield day, create_transits(day, n_rows, seed + n_day, first_index)
+        else:
+            yield day, create_mysql_transits(day, n_rows, seed + n_day, first_index)
+        first_index += n_rows
+
+
+class TestGenerator(unittest.TestCase):
+    def test_mysql_transits(self):
+        df = create_mysql_transits("2018-01-02", 20000, late_share=0.05, malformed_share=0.05)
+        assert list(df.columns) == list(range(mysql.INDEX_COLUMN + 1))
+        assert df[mysql.INDEX_COLUMN].tolist() == list(range(1, 20001))
+        assert set(zip(df[6], df[7])) == set(ROUTE_SHARES.keys())
+        assert (df[2] < 20).all()
+        # Morning peak
+        hours = np.array([time.seconds // 3600 for time in df[4]])
+        assert np.sum(hours == 8) > 10 * np.sum(hours == 3)
+        # Late cars are not ordered by time
+        seconds = np.array([time.seconds for time in df[4]])
+        assert 0 < np.sum(np.diff(seconds) < 0) < 0.1 * len(df)
+        assert 0.3 < df[10].mean() < 0.4
+        assert (df[12] == MALFORMED_DATE).any()
+        # Same seed, same cars
+        assert df.equals(create_mysql_transits("2018-01-02", 20000, late_share=0.05,
+                                               malformed_share=0.05))
+
+    def test_transits(self):
+        df = create_transits("2018-01-02", 10000)
+        assert list(df.columns) == bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA)
+        assert set(df["D_Date"]) == {"2018-01-02"}
+        obu_ok = (df["N_Obu_Payment"] == 1) & (df["N_Obu_Entry_Ok"] == 0) & \
+            df["D_Obu_Entry_Date"].isin(["2018-01-01", "2018-01-02"])
+        travel = df["Travel_Time_Second"]
+        assert (travel[~obu_ok] == 0).all()
+        assert (travel[obu_ok] >= 0.5 * min(TRAVEL_SECONDS.values())).all()
+        assert (travel[obu_ok] <= 3 * max(TRAVEL_SECONDS.values())).all()
+
+    def test_days(self):
+        lst_days = list(create_days("2018-01-01", 7, 1000))
+        assert [day for day, _ in lst_days][-1] == "2018-01-07"
+        # Friday busier than sunday
+        assert len(lst_days[4][1]) > len(lst_days[6][1])
+        index = pd.concat([df[mysql.INDEX_COLUMN] for _, df in lst_days])
+        assert index.tolist() == list(range(1, len(index) + 1))
+
+
+if __name__ == "__main__":
+    import sys
+    import feed
+    parser = argparse.ArgumentParser()
+    parser.add_argument("day", help="first day string")
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Cars of a monday')
+    parser.add_argument('--days', type=int, default=1,
+                        help='Number of days')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    parser.add_argument('--file', default=None,
+                        help='Add the rows to a csv file of feed.FileSource, not print')
+    args = parser.parse_args()
+    for day_create, df_create in create_days(args.day, args.days, args.rows, args.seed):
+        feed.write_file(df_create, args.file or sys.stdout)
@@ -5,20 +5,74 @@ or streaming (load data from a date, wait, and load new data).
 * loader.py Date online .- Load in streamind mode.
 * loader.py Date --until_yestarday .- Load all data from
                                             date until yestarday
-
-Based in biq_query.py and window.py
+Online, a minute window is loaded when it is --lateness minutes older
+than the newest transit time (event time watermark), or than the
+wall clock with --wall_clock. No more than --max_windows are open.
+Data for a minute already loaded is loaded as a correction row,
+or discarded with --drop_late.
+Online, the windows of a station are no more than --window_memory_mb (256)
+by the number of stations, measured bytes. Over the budget (a burst of old
+rows) the oldest windows are loaded before the watermark closes them, later
+rows of them are corrections. If the uploads stall, the write-behind sink
+queue is full and the loader waits, it does not read mysql.
+The first load of a day replaces the day in the tables, atomic, a reload
+never duplicates data or leaves the day empty. Online, next loads add raw
+data and merge the windows, late data is added to the minute rows.
+Online, every cycle the last index read and the open windows are saved
+in CHECKPOINT_DIR. On restart the day is resumed from the checkpoint,
+without replace and load again the day (--restart to ignore it).
+Rows read after the last checkpoint are read and written again on restart:
+online raw rows and corrections are at-least-once, a day reload is exact.
+With --partitions N routes are aggregated in N worker processes.
+With --until_yesterday (not online) days are loaded by --backfill_workers
+processes, read, transform and write stages at the same time (backfill.py).
+Days loaded are saved in a manifest, a backfill run again skips them
+(--restart to load them again).
+With --local directory data is loaded to local storage, not big query.
+Online, raw rows and windows are written in background by a write-behind
+sink (sink.py), flushed every --flush_rows rows or --flush_seconds seconds.
+With --stations 6 7 ... the toll stations are loaded by a loader, every
+station has its own cursor, last index read and windows, and the rows of
+all the stations are written together. A day is replaced with the rows of
+all the stations, a day has to be loaded by a loader. Aggr rows are by
+station (Station column), routes read in several stations do not mix.
+Online, new rows are read from a change-feed source (feed.py), --source:
+    poll .- Query mysql every --wait_seconds (60), by default.
+    binlog .- Read inserted rows from the mysql binlog (row based
+        replication) every --wait_seconds (2), --server_id replica id.
+    file .- Tail of the csv file --feed_file, offline replay.
+Mysql connections are taken from a pool (mysql.ConnectionPool), a lost
+connection is opened again and the query retried, the loader does not stop.
+Online, the loader never stops at midnight: it goes on with the new day,
+and the previous day is read --rollover_minutes (15) more for late rows.
+The windows are kept, the last minutes of a day are closed by the rows of
+the next day. The checkpoint is of the newest day, a restart resumes there.
+Metrics (metrics.py): rows read and written, latency of the stages (read,
+normalize, window, load, table jobs), open windows, ingest lag (now minus
+the newest transit time) by station, rows waiting in the sink and upload
+bytes. --metrics_port N serves them on http://127.0.0.1:N/metrics,
+--metrics_seconds S prints them every S seconds, a json line.
+
+Based in biq_query.py, normalize.py and window.py
 Fill raw table with car info
 Fill aggr table with info aggregate by minites
+Fill aggr_5, aggr_15 and aggr_60 tables with info aggregate by 5, 15 and 60 minutes
 
 """
 
-from string import Template
 import argparse
 import datetime
 import numpy as np
+import os
+import pickle
+import backfill
 import big_query
+import feed
+import metrics
+import normalize
+import sink
+import storage
 import window
-from time import sleep
 from datetime import date, timedelta
 import mysql
 
@@ -26,68 +80,16 @@ from typing import Optional
 
 
 INPUT_DIR_LOCAL = "./data/"
-
-
-class DeltaTemplate(Template):
-    delimiter = "%"
-
-
-def strfdelta(tdelta, fmt):
-    """
-    :param tdelta:datetime timedelta
-    :param fmt: Format
-    :return: String from tdelte in fmt format
-    """
-    d = {"D": tdelta.days}
-    hours, rem = divmod(tdelta.seconds, 3600)
-    minutes, seconds = divmod(rem, 60)
-    d["H"] = '{:02d}'.format(hours)
-    d["M"] = '{:02d}'.format(minutes)
-    d["S"] = '{:02d}'.format(seconds)
-    t = DeltaTemplate(fmt)
-    return t.substitute(**d)
-
-
-# Get a string from a datetime.timedelta
-def lambda_timedelta(x): return strfdelta(x, '%H:%M:%S')
-
-
-# Get a string from a datetime.date
-def lambda_date2string(x): return x.strftime('%Y-%m-%d') if type(x) == datetime.date else x
-
-
-# Replace None with 0000-00-00
-def lambda_data_none(x):
-    if x is None:
-        return "0000-00-00"
-    else:
-        return x
-
-
-def process_daraframe(dataframe_result):
-    """
-    Process time and dates from a dataframe
-    :param dataframe_result: dataframe
-    :return: dataframe processed
-    """
-    if dataframe_result is not None:
-        #T_Hora_C : Transit time
-        dataframe_result[4] = dataframe_result[4]. \
-            apply(lambda_timedelta)
-        # D_Obu_Data : Obu entry date
-        dataframe_result[12] = dataframe_result[12]. \
-            apply(lambda_data_none)
-        # T_Obu_Time : Obu entry time
-        dataframe_result[13] = dataframe_result[13]. \
-            apply(lambda_timedelta)
-        ##D_Data_C : Transit date
-        dataframe_result[3] = dataframe_result[3]. \
-            apply(lambda_date2string)
-        # D_Obu_Data : Obu entry date
-        dataframe_result[12] = dataframe_result[12]. \
-            apply(lambda_date2string)
-    return dataframe_result
-
+# Online checkpoints, a file by day
+CHECKPOINT_DIR = "./checkpoint/"
+# Days loaded by backfill
+BACKFILL_MANIFEST = "backfill_manifest.txt"
+# Online, minutes after midnight the previous day is read for late rows
+ROLLOVER_MINUTES = 15
+# Online, memory budget of the windows of all the stations, MB
+WINDOW_MEMORY_MB = 256
+# Online write-behind sink, None to write in the polling thread
+write_sink = None
 
 
 def print_lines(dataframe_load):
@@ -111,6 +113,26 @@ def parse_parameter():
         only_print
         online
         until_yestarday
+        lateness
+        max_windows
+        wall_clock
+        drop_late
+        restart
+        partitions
+        local
+        flush_rows
+        flush_seconds
+        chunk_rows
+        source
+        feed_file
+        wait_seconds
+        server_id
+        backfill_workers
+        stations
+        rollover_minutes
+        metrics_port
+        metrics_seconds
+        window_memory_mb
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("day", help="day string")
@@ -120,76 +142,336 @@ def parse_parameter():
                         action='store_true', default=False)
     parser.add_argument('--until_yesterday', help="load fron date to yestarday",
                         action='store_true', default=False)
+    parser.add_argument('--lateness', help="Online, minutes to wait for late data",
+                        type=int, default=5)
+    parser.add_argument('--max_windows', help="Online, max number of minute windows open",
+                        type=int, default=60)
+    parser.add_argument('--wall_clock', help="Online, close minute windows by wall clock too",
+                        action='store_true', default=False)
+    parser.add_argument('--drop_late', help="Online, discard data for minutes already loaded",
+                        action='store_true', default=False)
+    parser.add_argument('--restart', help="Do not resume from checkpoint or backfill manifest",
+                        action='store_true', default=False)
+    parser.add_argument('--partitions', help="Worker processes to aggregate the routes",
+                        type=int, default=0)
+    parser.add_argument('--local', help="Local storage directory, not big query",
+                        default=None)
+    parser.add_argument('--flush_rows', help="Online, rows buffered before writing",
+                        type=int, default=sink.FLUSH_ROWS)
+    parser.add_argument('--flush_seconds', help="Online, max seconds rows are buffered",
+                        type=int, default=sink.FLUSH_SECONDS)
+    parser.add_argument('--chunk_rows', help="Rows read from mysql by chunk",
+                        type=int, default=mysql.CHUNK_ROWS)
+    parser.add_argument('--source', help="Change-feed source of new rows",
+                        choices=["poll", "binlog", "file"], default="poll")
+    parser.add_argument('--feed_file', help="File source, csv file with mysql rows",
+                        default=None)
+    parser.add_argument('--wait_seconds', help="Online, seconds between reads of the source",
+                        type=float, default=None)
+    parser.add_argument('--server_id', help="Binlog source, replica server id",
+                        type=int, default=feed.SERVER_ID)
+    parser.add_argument('--stations', help="Toll stations loaded",
+                        type=int, nargs="+", default=[mysql.STATION])
+    parser.add_argument('--backfill_workers', help="Until yesterday, days loaded at the same time",
+                        type=int, default=backfill.DAY_WORKERS)
+    parser.add_argument('--rollover_minutes', help="Online, minutes after midnight the "
+                                                   "previous day is read",
+                        type=int, default=ROLLOVER_MINUTES)
+    parser.add_argument('--metrics_port', help="Serve metrics on localhost port",
+                        type=int, default=None)
+    parser.add_argument('--metrics_seconds', help="Print metrics every seconds, json line",
+                        type=float, default=None)
+    parser.add_argument('--window_memory_mb', help="Online, memory budget of the windows, MB",
+                        type=float, default=WINDOW_MEMORY_MB)
     args_return = parser.parse_args()
     return args_return
 
 
-def load_df(df, window_remain=5):
+def get_windows_closed(online, window_remain=0):
+    """
+    Get the time windows closed, all aggregate in the same pass.
+    Online, windows closed by the event time watermark (--lateness,
+    --wall_clock, --max_windows) or by the memory budget of a station
+    (--window_memory_mb). Batch, all the windows but the last window_remain.
+    :param online:
+    :param window_remain: Batch, windows not closed
+    :return: None or aggr dataframe, dictionary of rollup dataframes
+    """
+    if online:
+        now = datetime.datetime.now() if args.wall_clock else None
+        df_aggr = window.window_get_windows_closed(args.lateness,
+                                                   now=now,
+                                                   max_window=args.max_windows,
+                                                   max_bytes=args.window_memory_mb * 1000000 /
+                                                   len(args.stations))
+    else:
+        # If not online, not future data incomming, not store.
+        df_aggr = window.window_get_windows_ready(window_remain)
+    return df_aggr, big_query.get_rollups_ready(df_aggr)
+
+
+def load_df(df, online, bulk=None, window_remain=0):
+    """
+    Load a dataframe to in memory windows time slider,
+    and load raw data and the windows closed to big query.
+    :param df: None or dataframe normalized, TABLE_RAW_SCHEMA columns
+    :param online:
+    :param bulk: None or big_query.BulkLoad, raw data and windows are staged
+        to replace the day on commit.
+        None, raw data is added and windows are merged, late data
+        for windows already loaded is added to them. With write_sink, in
+        background.
+    :param window_remain: Batch, windows not closed, more data can come
+    :return:
+    """
+    if df is not None:
+        # Add data to window time slider
+        window.window_add_dataframe(df)
+    df_aggr, dict_rollups = get_windows_closed(online, window_remain)
+    if bulk is not None:
+        bulk.add(df, big_query.TABLE_RAW)
+        bulk.add_windows(df_aggr, dict_rollups)
+    elif write_sink is not None:
+        write_sink.write_raw(df)
+        write_sink.merge_windows(df_aggr, dict_rollups)
+    else:
+        if df is not None:
+            big_query.write_df_raw(df)
+        big_query.print_jobs(big_query.merge_df_windows(df_aggr, dict_rollups))
+
+
+def get_checkpoint_file(date_load):
     """
-    Load a dataframe to raw data
-    Load a dataframe to in memory windows  time slider
-    Store the last window_remain time windows for future data.
-    Load the rest of the time windows to  bigquery.
-    :param df: dataframe
-    :param window_remain: number of win
+    :param date_load: day
+    :return: checkpoint file name for the day
+    """
+    return os.path.join(CHECKPOINT_DIR, date_load + ".pkl")
+
+
+def save_checkpoint(lst_days, dict_stations):
+    """
+    Save the days read, and by station the last index read from mysql
+    and the windows open. The file is of the newest day.
+    With write_sink, the file is written after the rows loaded before.
+    :param lst_days: days read, the newest last
+    :param dict_stations: dictionary, station: dictionary with
+        last_index .- dictionary, day: last index read from mysql database
+        window .- window state, see window.window_get_state
     :return:
     """
+    # Windows are pickled now, they change before the file is written
+    checkpoint = pickle.dumps({"day": lst_days[-1],
+                               "days": lst_days,
+                               "stations": dict_stations},
+                              protocol=pickle.HIGHEST_PROTOCOL)
+    if write_sink is not None:
+        write_sink.call(write_checkpoint, [lst_days[-1], checkpoint])
+    else:
+        write_checkpoint(lst_days[-1], checkpoint)
 
-    df["Travel_Time_Second"] = 0
-    # Prepare data and load to rwa table
-    df = big_query.add_raw_columns_names(df)
-    df = big_query.add_travel_time(df)
-    big_query.write_df_raw(df)
-    # Add data to window time slider
-    window.window_add_dataframe(df)
-    # Get windows to load to big query
-    df_aggr_total = window.window_get_window_ready(window_remain)
-    if df_aggr_total is not None:
-        df_aggr = window.window_get_window_ready(window_remain)
-        while df_aggr is not None:
-            df_aggr_total = df_aggr_total.append(df_aggr)
-            df_aggr = window.window_get_window_ready(window_remain)
-        big_query.write_df_aggr(df_aggr_total)
+
+def write_checkpoint(date_load, checkpoint):
+    """
+    Write a checkpoint file, the file is replaced atomically.
+    :param date_load: day
+    :param checkpoint: pickled checkpoint
+    :return:
+    """
+    if not os.path.exists(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR)
+    file_checkpoint = get_checkpoint_file(date_load)
+    with open(file_checkpoint + ".tmp", "wb") as file_tmp:
+        file_tmp.write(checkpoint)
+    os.replace(file_checkpoint + ".tmp", file_checkpoint)
 
 
-def load_day(date_load, online, lmysql, lbigquery):
+def load_checkpoint(date_load):
+    """
+    Read the newest checkpoint of a day or a later day, online the loader
+    goes on with the next days.
+    :param date_load: day
+    :return: None .- There is not checkpoint
+            tuple, list of days read and dictionary, station: dictionary
+            with last_index and window, see save_checkpoint
+    """
+    if not os.path.exists(CHECKPOINT_DIR):
+        return None
+    lst_days = [file_name[:-len(".pkl")] for file_name in os.listdir(CHECKPOINT_DIR)
+                if file_name.endswith(".pkl") and file_name[:-len(".pkl")] >= date_load]
+    if len(lst_days) == 0:
+        return None
+    with open(get_checkpoint_file(max(lst_days)), "rb") as file_load:
+        checkpoint = pickle.load(file_load)
+    if "stations" not in checkpoint:
+        # Checkpoint of a loader of a station
+        checkpoint["stations"] = {mysql.STATION: {"last_index": checkpoint["last_index"],
+                                                  "window": checkpoint["window"]}}
+    for state in checkpoint["stations"].values():
+        if not isinstance(state["last_index"], dict):
+            # Checkpoint of a loader of a day
+            state["last_index"] = {checkpoint["day"]: state["last_index"]}
+    return checkpoint.get("days", [checkpoint["day"]]), checkpoint["stations"]
+
+
+def get_online_days(lst_days, now, rollover_minutes):
+    """
+    Online, days to read: the day of the wall clock. After midnight the
+    previous day too, rollover_minutes, for its late rows. The windows
+    are the same for all the days, the last minutes of a day are closed
+    by the rows of the next day.
+    :param lst_days: days read, the newest last
+    :param now: datetime, wall clock
+    :param rollover_minutes: minutes after midnight the previous day is read
+    :return: list of days, the newest last
+    """
+    today = now.strftime("%Y-%m-%d")
+    if today > lst_days[-1]:
+        print("Rollover from " + lst_days[-1] + " to " + today)
+        return [lst_days[-1], today]
+    midnight = datetime.datetime.combine(now.date(), datetime.time())
+    if len(lst_days) > 1 and now - midnight >= timedelta(minutes=rollover_minutes):
+        print("Day " + ", ".join(lst_days[:-1]) + " closed")
+        return lst_days[-1:]
+    return lst_days
+
+
+def read_days(source, lst_days, dict_index, station):
+    """
+    New rows of a station, from the oldest day to the newest
+    :param source: change-feed source, see feed.py
+    :param lst_days: days to read
+    :param dict_index: dictionary, day: last index read
+    :param station: toll station
+    :return: generator of tuples (day, mysql dataframe)
     """
-    Get day data from mysql and load to bigquery.
-    Before this delete data in big query from that day
+    for day in lst_days:
+        for data in source.read(day, dict_index.get(day, 0), station):
+            yield day, data
+
+
+def get_station_state():
+    """
+    :return: state of a station without data, see save_checkpoint
+    """
+    return {"last_index": {},
+            "window": window.window_new_state(drop_late=args.drop_late,
+                                              n_partition=args.partitions)}
+
+
+def get_source(mysql_pool):
+    """
+    Change-feed source of --source
+    :param mysql_pool: Mysql connection pool
+    :return: feed.PollSource, feed.BinlogSource or feed.FileSource
+    """
+    kwargs = {} if args.wait_seconds is None else {"wait_seconds": args.wait_seconds}
+    if args.source == "binlog":
+        return feed.BinlogSource(mysql_pool, args.chunk_rows, server_id=args.server_id,
+                                 stations=args.stations, **kwargs)
+    if args.source == "file":
+        return feed.FileSource(args.feed_file, **kwargs)
+    return feed.PollSource(mysql_pool, args.chunk_rows, **kwargs)
+
+
+def get_ingest_lag(day, data):
+    """
+    :param day: day of the rows, String YYYY-MM-DD
+    :param data: mysql dataframe
+    :return: seconds from the newest transit time to now
+    """
+    newest = datetime.datetime.strptime(day, "%Y-%m-%d") + \
+        data[normalize.COLUMN_TIME].max()
+    return (datetime.datetime.now() - newest).total_seconds()
+
+
+def load_day(date_load, online, source):
+    """
+    Get day data from the source and load to bigquery.
+    Data is read in chunks of --chunk_rows rows from a server side cursor,
+    a chunk is loaded while mysql sends the next one.
+    The first load replaces the day in big query, atomic, the day
+    is never empty: chunks are staged in parquet files and committed
+    together. Next loads add raw data and merge the windows.
+    Every station of --stations has its own cursor, last index read and
+    windows, the stations are read at the same time and their rows are
+    written together.
+    Online, if there is a checkpoint for the day, do not replace,
+    resume from the checkpoint.
+    Online, never finish: at midnight the loader goes on with the new day,
+    see get_online_days. The windows are not reset, the rows of the new
+    day close the last minutes of the previous day.
     :param date_load:  day
     :param online: if True, never finish, load data, sleep and load new data
-    :param lmysql: Mysql conection
-    :param lbigquery:  BigQuery connection
+    :param source: change-feed source, see feed.py
     :return:
     """
-    print("Load day, delete " + str(date_load) + " online " + str(online))
-    big_query.delete_day(date_load, lbigquery)
+    checkpoint = None
+    if online and not args.restart:
+        checkpoint = load_checkpoint(date_load)
+    replace = checkpoint is None
+    if replace:
+        print("Load day, replace " + str(date_load) + " online " + str(online))
+        lst_days, dict_stations = [date_load], {}
+    else:
+        lst_days, dict_stations = checkpoint
+        print("Resume days " + ", ".join(lst_days) + " from " +
+              str({station: state["last_index"] for station, state in dict_stations.items()}))
+    for station in args.stations:
+        if station not in dict_stations:
+            dict_stations[station] = get_station_state()
     print("Load day " + str(date_load) + " online " + str(online))
     end = False
-    last_index = 0  # Last index read from mysql database
     while not end:
-        # Get data from mysql
-        data = mysql.get_data(lmysql, date_load, last_index)
-        data = process_daraframe(data)
-        if data is not None:
-            # Last column is database index.
-            # Store for new sql querys and remove from dataframes
-            print("Loading " + str(data.shape))
-            last_index = data[15].max()
-            data = data.drop(columns=15)
-            if args.only_print:
-                print_lines(data)
-            else:
-                if args.online:
-                    # If online, we store the last five window for future data incoming
-                    load_df(data,  window_remain=5)
+        bulk = big_query.BulkLoad() if replace and not args.only_print else None
+        # Get data from mysql, a cursor by station at the same time
+        dict_chunks = {station: backfill.pipe(read_days(source, lst_days,
+                                                        dict(state["last_index"]), station))
+                       for station, state in dict_stations.items()}
+        for station, state in dict_stations.items():
+            window.window_set_state(state["window"], close=False)
+            for day, data in metrics.timed(dict_chunks[station], "stage_seconds", stage="read"):
+                # Last column is database index.
+                # Store for new sql querys and remove from dataframes
+                print("Loading station " + str(station) + " " + day + " " + str(data.shape))
+                metrics.count("rows_in", len(data), station=station)
+                metrics.set_gauge("ingest_lag_seconds", get_ingest_lag(day, data),
+                                  station=station)
+                state["last_index"][day] = max(state["last_index"].get(day, 0),
+                                               int(data[mysql.INDEX_COLUMN].max()))
+                data = data.drop(columns=mysql.INDEX_COLUMN)
+                # Times, dates and travel time, vectorized
+                with metrics.timer("stage_seconds", stage="normalize"):
+                    data = normalize.normalize_mysql(data)
+                if args.only_print:
+                    print_lines(data)
                 else:
-                    # If not online, not future data incomming, not store.
-                    load_df(data,  window_remain=0)
-            if not args.online:
-                end = True
-            else:
-                sleep(60)
+                    # If online, windows are loaded when the watermark close them.
+                    # Data is ordered by time, next chunk can have cars of the last minute
+                    with metrics.timer("stage_seconds", stage="load"):
+                        load_df(data, online, bulk, window_remain=1)
+            if not args.only_print:
+                with metrics.timer("stage_seconds", stage="load"):
+                    load_df(None, online, bulk)
+            state["window"] = window.window_get_state()
+        if not args.only_print:
+            if bulk is not None:
+                big_query.print_jobs(bulk.commit(date_load))
+                replace = False
+        if not online:
+            end = True
+        else:
+            if not args.only_print:
+                # Data read is loaded, save to resume from here
+                save_checkpoint(lst_days, dict_stations)
+            source.wait()
+            lst_days = get_online_days(lst_days, datetime.datetime.now(),
+                                       args.rollover_minutes)
+            for state in dict_stations.values():
+                state["last_index"] = {day: index for day, index in state["last_index"].items()
+                                       if day in lst_days}
+    # Stop the worker processes of the station windows
+    for state in dict_stations.values():
+        window.window_close_state(state["window"])
 
 
 def get_days(init_date, until_yesterday):
@@ -214,16 +496,46 @@ def get_days(init_date, until_yesterday):
 if __name__ == "__main__":
     np.seterr(all='raise')
     args = parse_parameter()
-    # Get mysql and big_query client connections
-    mysql_conn = mysql.connect_mysql()
-    client = big_query.get_client_bigquery()
+    # Get mysql connection pool, source and storage backend
+    # A connection by station, stations are read at the same time
+    mysql_pool = mysql.ConnectionPool(size=max(mysql.POOL_SIZE, len(args.stations))) \
+        if args.source != "file" else None
+    source = get_source(mysql_pool)
+    if args.local is not None:
+        big_query.set_storage(storage.LocalStorage(args.local))
+    big_query.print_jobs(big_query.create_tables(big_query.get_storage()))
     print(args)
-    # Init window
-    window.window_init()
+    reporter = None
+    if args.metrics_port is not None or args.metrics_seconds is not None:
+        reporter = metrics.MetricsReporter(port=args.metrics_port,
+                                           log_seconds=args.metrics_seconds)
+    if args.online and not args.only_print:
+        write_sink = sink.WriteBehindSink(flush_rows=args.flush_rows,
+                                          flush_seconds=args.flush_seconds)
     try:
-        for day in get_days(args.day, args.until_yesterday):
-            load_day(day, args.online, mysql_conn, client)
+        if args.until_yesterday and not args.online and not args.only_print:
+            lst_failed = backfill.run_backfill(get_days(args.day, True), args.backfill_workers,
+                                               os.path.join(CHECKPOINT_DIR, BACKFILL_MANIFEST),
+                                               local=args.local,
+                                               feed_file=args.feed_file
+                                               if args.source == "file" else None,
+                                               chunk_rows=args.chunk_rows,
+                                               restart=args.restart,
+                                               stations=args.stations)
+            if len(lst_failed) > 0:
+                print("Days not loaded " + ", ".join(lst_failed))
+        else:
+            for day in get_days(args.day, args.until_yesterday):
+                load_day(day, args.online, source)
     except KeyboardInterrupt:
         pass
-    mysql.close_mysql(mysql_conn)
+    finally:
+        if write_sink is not None:
+            # Write the rows buffered
+            write_sink.close()
+        if reporter is not None:
+            reporter.close()
+    source.close()
+    if mysql_pool is not None:
+        mysql_pool.close()
 
@@ -0,0 +1,306 @@
+"""
+Loader metrics, in memory and thread safe, by name and labels:
+    Counters .- e.g. rows read, rows written, upload bytes
+    Gauges .- e.g. open windows, ingest lag, rows waiting in the sink
+    Histograms .- Latency of the stages in seconds, LATENCY_BUCKETS
+Metrics are exposed on a local http endpoint, Prometheus text format,
+and/or a structured log line (json) every log_seconds.
+Metrics are of a process, worker processes have their own metrics.
+Use:
+    metrics.count("rows_in", len(df), station=6)
+    metrics.set_gauge("open_windows", 10)
+    with metrics.timer("stage_seconds", stage="normalize"): ...
+    for item in metrics.timed(chunks, "stage_seconds", stage="read"): ...
+    reporter = MetricsReporter(port=8000, log_seconds=60)
+    reporter.close()
+"""
+
+import bisect
+import contextlib
+import http.server
+import json
+import threading
+import time
+import unittest
+import urllib.request
+
+# Upper bounds of the latency histograms, seconds
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0]
+# Metric name prefix on the endpoint
+PREFIX = "loader_"
+
+lock = threading.Lock()
+# Key (name, labels): value. Labels, tuple of (label, value) sorted
+counters = {}
+gauges = {}
+# Key (name, labels): [count by bucket, the last +Inf, sum, count]
+histograms = {}
+
+
+def get_key(name, labels):
+    """
+    :param name: metric name
+    :param labels: dictionary, label: value
+    :return: key of the metric
+    """
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def count(name, value=1, **labels):
+    """
+    Add to a counter
+    :param name:
+    :param value:
+    :param labels:
+    :return:
+    """
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge
+    :param name:
+    :param value:
+    :param labels:
+    :return:
+    """
+    key = get_key(name, labels)
+    with lock:
+        gauges[key] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Add a latency to a histogram
+    :param name:
+    :param seconds:
+    :param labels:
+    :return:
+    """
+    key = get_key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Observe the seconds of a block in a histogram
+    :param name:
+    :param labels:
+    :return:
+    """
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start_time, **labels)
+
+
+def timed(iterable, name, **labels):
+    """
+    Observe the seconds waiting for every item of an iterable,
+    e.g. chunks read from mysql
+    :param iterable:
+    :param name:
+    :param labels:
+    :return: generator of the items
+    """
+    iterator = iter(iterable)
+    while True:
+        start_time = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.time() - start_time, **labels)
+        yield item
+
+
+def reset():
+    """ Remove all the metrics"""
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+
+
+def get_name(key):
+    """
+    :param key: key of a metric
+    :return: String name{label="value",...}
+    """
+    name, labels = key
+    if len(labels) == 0:
+        return name
+    return name + "{" + ",".join('{}="{}"'.format(label, value)
+                                 for label, value in labels) + "}"
+
+
+def get_snapshot():
+    """
+    :return: dictionary with all the metrics
+        counters .- name: value
+        gauges .- name: value
+        histograms .- name: dictionary with count, sum and percentiles p50,
+            p90, p99 (upper bound of the bucket)
+    """
+    with lock:
+        snapshot = {"counters": {get_name(key): value for key, value in counters.items()},
+                    "gauges": {get_name(key): value for key, value in gauges.items()},
+                    "histograms": {}}
+        for key, (buckets, total, n_observed) in histograms.items():
+            summary = {"count": n_observed, "sum": round(total, 6)}
+            for percentile in [50, 90, 99]:
+                summary["p" + str(percentile)] = get_percentile(buckets, n_observed,
+                                                                percentile)
+            snapshot["histograms"][get_name(key)] = summary
+    return snapshot
+
+
+def get_percentile(buckets, n_observed, percentile):
+    """
+    :param buckets: count by bucket of a histogram
+    :param n_observed: count of the histogram
+    :param percentile: 0 - 100
+    :return: upper bound of the bucket of the percentile, None for +Inf
+    """
+    accumulated = 0
+    for position, n_bucket in enumerate(buckets):
+        accumulated += n_bucket
+        if accumulated * 100 >= n_observed * percentile:
+            return LATENCY_BUCKETS[position] if position < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def get_text():
+    """
+    :return: String, all the metrics in Prometheus text format
+    """
+    lines = []
+    with lock:
+        for key, value in sorted(counters.items()):
+            lines.append(PREFIX + get_name(key) + " " + str(value))
+        for key, value in sorted(gauges.items()):
+            lines.append(PREFIX + get_name(key) + " " + str(value))
+        for (name, labels), (buckets, total, n_observed) in sorted(histograms.items()):
+            accumulated = 0
+            for position, n_bucket in enumerate(buckets):
+                accumulated += n_bucket
+                bound = str(LATENCY_BUCKETS[position]) \
+                    if position < len(LATENCY_BUCKETS) else "+Inf"
+                lines.append(PREFIX + get_name((name + "_bucket", labels + (("le", bound),))) +
+                             " " + str(accumulated))
+            lines.append(PREFIX + get_name((name + "_sum", labels)) + " " + str(total))
+            lines.append(PREFIX + get_name((name + "_count", labels)) + " " + str(n_observed))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ GET /metrics, Prometheus text format"""
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Do not log the requests"""
+        pass
+
+
+class MetricsReporter:
+    """
+    Expose the metrics in background threads: http endpoint on localhost
+    and/or a json log line every log_seconds.
+    """
+    def __init__(self, port=None, log_seconds=None, host="127.0.0.1"):
+        """
+        :param port: None for no endpoint, 0 for a free port
+        :param log_seconds: None for no log line
+        :param host: address of the endpoint
+        """
+        self.log_seconds = log_seconds
+        self.stop = threading.Event()
+        self.server = None
+        self.threads = []
+        if port is not None:
+            self.server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+            self.port = self.server.server_address[1]
+            self.threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+        if log_seconds is not None:
+            self.threads.append(threading.Thread(target=self.run_log, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def log(self):
+        """ Print the metrics, a json line"""
+        print(json.dumps(dict(get_snapshot(), time=round(time.time(), 3)), sort_keys=True),
+              flush=True)
+
+    def run_log(self):
+        """ Background thread, log every log_seconds"""
+        while not self.stop.wait(self.log_seconds):
+            self.log()
+
+    def close(self):
+        """ Stop the endpoint, last log line"""
+        self.stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.log_seconds is not None:
+            self.log()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        reset()
+
+    def test_metrics(self):
+        count("rows_in", 10, station=6)
+        count("rows_in", 5, station=6)
+        count("rows_in", 1, station=7)
+        set_gauge("open_windows", 3)
+        for seconds in [0.002, 0.002, 0.02, 2.0]:
+            observe("stage_seconds", seconds, stage="read")
+        assert list(timed(iter([1, 2]), "stage_seconds", stage="timed")) == [1, 2]
+        with timer("stage_seconds", stage="timer"):
+            pass
+        snapshot = get_snapshot()
+        assert snapshot["counters"] == {'rows_in{station="6"}': 15, 'rows_in{station="7"}': 1}
+        assert snapshot["gauges"] == {"open_windows": 3}
+        read = snapshot["histograms"]['stage_seconds{stage="read"}']
+        assert read["count"] == 4 and read["p50"] == 0.005 and read["p99"] == 5.0
+        assert snapshot["histograms"]['stage_seconds{stage="timed"}']["count"] == 2
+        assert snapshot["histograms"]['stage_seconds{stage="timer"}']["count"] == 1
+        text = get_text()
+        assert 'loader_rows_in{station="6"} 15\n' in text
+        assert 'loader_stage_seconds_bucket{stage="read",le="0.005"} 2\n' in text
+        assert 'loader_stage_seconds_bucket{stage="read",le="+Inf"} 4\n' in text
+        assert 'loader_stage_seconds_count{stage="read"} 4\n' in text
+
+    def test_endpoint(self):
+        count("rows_out", 7, table="raw")
+        reporter = MetricsReporter(port=0)
+        try:
+            url = "http://127.0.0.1:" + str(reporter.port) + "/metrics"
+            with urllib.request.urlopen(url) as response:
+                assert 'loader_rows_out{table="raw"} 7' in response.read().decode()
+        finally:
+            reporter.close()
@@ -0,0 +1,248 @@
+"""
+Migrate raw, aggr and rollup tables with STRING dates and times
+to DATE and TIME columns, partitioned by date and clustered by route.
+For every table:
+    Skip it if its date column is already DATE (e.g. migrated and
+        table_string deleted with --drop)
+    Create the new table as table_migrate, see big_query.create_tables
+    Copy the rows with a sql sentence, dates and times cast in the storage
+    Rename the table to table_string and table_migrate to the table
+    Delete table_string with --drop
+A table already migrated (table_string and the table exist) or not existing
+is skipped. The migration is resumable: a copy not complete is done again,
+a table stopped between the renames gets table_migrate.
+Aggr and rollup tables get the Station column (key of the rows), the rows
+without station are of --station (big_query.LEGACY_STATION, the station of
+the loader before the column), typed tables too. Run it again is a no-op.
+Use:
+    migrate.py .- Migrate tables in default dataset
+    migrate.py --dataset name .- Migrate tables in a dataset
+    migrate.py --local directory .- Migrate local storage tables
+    migrate.py --drop .- Delete old tables after the copy
+    migrate.py --station N .- Station of the aggr rows without station
+"""
+
+import argparse
+import tempfile
+import unittest
+import pandas as pd
+import big_query as bq
+import storage
+
+# Old table name suffix
+LEGACY_SUFFIX = "_string"
+# New table name suffix, until the copy is complete
+MIGRATE_SUFFIX = "_migrate"
+
+
+def get_copy_sql(storage_used, dataset, table_id, schema_list, column_types):
+    """
+    :param storage_used: storage backend
+    :param dataset:
+    :param table_id: old table, new table is table_id + MIGRATE_SUFFIX
+    :param schema_list: new table schema
+    :param column_types: dictionary, column: type in the old table
+    :return: sql sentence to copy old table to new table, only STRING
+        columns are cast
+    """
+    columns = bq.get_columns_from_list(schema_list)
+    expressions = []
+    for column_def in schema_list.split(','):
+        column_name, column_type = column_def.split(':')
+        if column_types.get(column_name, "STRING") == "STRING":
+            expressions.append(storage_used.cast_sql(column_name, column_type))
+        else:
+            expressions.append(column_name)
+    return "insert into " + dataset + "." + table_id + MIGRATE_SUFFIX + \
+           " (" + ", ".join(columns) + ") select " + ", ".join(expressions) + \
+           " from " + dataset + "." + table_id
+
+
+def migrate_table(storage_used, dataset, table_id, schema_list,
+                  partition_column, cluster_columns, drop=False):
+    """
+    Migrate a table to typed, partitioned and clustered table
+    :param storage_used: storage backend
+    :param dataset:
+    :param table_id:
+    :param schema_list: new schema
+    :param partition_column:
+    :param cluster_columns:
+    :param drop: delete old table
+    :return: True if the table is migrated
+    """
+    if storage_used.table_exists(dataset, table_id + LEGACY_SUFFIX):
+        if storage_used.table_exists(dataset, table_id):
+            print("Skip " + table_id + ", already migrated")
+            return False
+        # Stopped between the renames, the copy is complete
+        print("Resume " + dataset + "." + table_id)
+        rename_table(storage_used, dataset, table_id + MIGRATE_SUFFIX, table_id)
+        if drop:
+            bq.delete_table(dataset, table_id + LEGACY_SUFFIX, storage_used)
+        return True
+    if not storage_used.table_exists(dataset, table_id):
+        print("Skip " + table_id + ", does not exist")
+        return False
+    column_types = storage_used.get_column_types(dataset, table_id)
+    if column_types.get(partition_column) == "DATE":
+        print("Skip " + table_id + ", already typed")
+        return False
+    print("Migrate " + dataset + "." + table_id)
+    # Columns new in the schema, e.g. travel time sketches, to copy them
+    storage_used.add_columns(dataset, table_id, schema_list)
+    # Rows of a copy not complete, of a migration stopped
+    bq.delete_table(dataset, table_id + MIGRATE_SUFFIX, storage_used)
+    bq.create_table(dataset, table_id + MIGRATE_SUFFIX, schema_list, storage_used,
+                    partition_column, cluster_columns)
+    storage_used.query(get_copy_sql(storage_used, dataset, table_id, schema_list,
+                                    column_types))
+    rename_table(storage_used, dataset, table_id, table_id + LEGACY_SUFFIX)
+    rename_table(storage_used, dataset, table_id + MIGRATE_SUFFIX, table_id)
+    if drop:
+        bq.delete_table(dataset, table_id + LEGACY_SUFFIX, storage_used)
+    return True
+
+
+def rename_table(storage_used, dataset, table_id, new_table_id):
+    """
+    :param storage_used: storage backend
+    :param dataset:
+    :param table_id:
+    :param new_table_id:
+    :return:
+    """
+    storage_used.query("alter table " + dataset + "." + table_id +
+                       " rename to " + new_table_id)
+
+
+def fill_station(storage_used, dataset, table_id, schema_list, station):
+    """
+    Add the Station column to an aggr or rollup table, if it does not
+    have it, and set the station of the rows without station
+    :param storage_used: storage backend
+    :param dataset:
+    :param table_id:
+    :param schema_list: new schema
+    :param station: toll station of the rows without station
+    :return:
+    """
+    storage_used.add_columns(dataset, table_id, schema_list)
+    storage_used.query("update " + dataset + "." + table_id + " set Station = " +
+                       str(station) + " where Station is null")
+
+
+def migrate_dataset(storage_used, dataset=bq.DEFAULT_DATASET, drop=False,
+                    station=bq.LEGACY_STATION):
+    """
+    Migrate raw, aggr and rollup tables of a dataset
+    :param storage_used: storage backend
+    :param dataset:
+    :param drop: delete old tables
+    :param station: toll station of the aggr rows without station
+    :return: number of tables migrated
+    """
+    n_migrated = 0
+    for table_id, schema_list, partition_column, cluster_columns in bq.get_tables():
+        if migrate_table(storage_used, dataset, table_id, schema_list,
+                         partition_column, cluster_columns, drop=drop):
+            n_migrated += 1
+        if table_id != bq.TABLE_RAW and storage_used.table_exists(dataset, table_id):
+            fill_station(storage_used, dataset, table_id, schema_list, station)
+    return n_migrated
+
+
+class TestMigrate(unittest.TestCase):
+    def test_migrate(self):
+        storage_used = storage.LocalStorage(tempfile.mkdtemp())
+        bq.set_storage(storage_used)
+        # Old aggr table, times HH:MM, without sketches and stations
+        schema_string = bq.TABLE_AGGR_SCHEMA.replace("DATE", "STRING").\
+            replace("TIME", "STRING").replace(",Travel_Time_Sketch:STRING", "").\
+            replace(",Station:INTEGER", "")
+        storage_used.create_table(bq.TEST_DATASET, bq.TABLE_AGGR, schema_string)
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 2],
+                                [6, 2, "2018-01-02", "10:02", 6, 7]],
+                               columns=bq.get_columns_from_list(schema_string))
+        storage_used.write_df(df_test, bq.TEST_DATASET, bq.TABLE_AGGR)
+        assert migrate_dataset(storage_used, bq.TEST_DATASET, drop=True) == 1
+        assert not storage_used.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR + LEGACY_SUFFIX)
+        assert storage_used.get_column_types(bq.TEST_DATASET, bq.TABLE_AGGR)["Date"] == "DATE"
+        df_read = bq.read_df_from_aggr("2018-01-02", dataset=bq.TEST_DATASET)
+        assert list(df_read["Time"]) == ["00:01:00", "10:02:00"]
+        assert list(df_read["AHT"]) == [1, 6]
+        assert df_read["Travel_Time_Sketch"].isnull().all()
+        assert list(df_read["Station"]) == [bq.LEGACY_STATION] * 2
+        # Already migrated, the old table was deleted, the typed table is not changed
+        assert migrate_dataset(storage_used, bq.TEST_DATASET) == 0
+        assert not storage_used.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR + LEGACY_SUFFIX)
+        assert bq.read_df_from_aggr("2018-01-02", dataset=bq.TEST_DATASET).equals(df_read)
+        # Typed table without stations
+        schema_typed = bq.TABLE_AGGR_SCHEMA.replace(",Station:INTEGER", "")
+        table_rollup = bq.get_table_rollup(5)
+        storage_used.create_table(bq.TEST_DATASET, table_rollup, schema_typed)
+        storage_used.write_df(df_test.assign(Time="00:00:00", Travel_Time_Sketch=""),
+                              bq.TEST_DATASET, table_rollup)
+        assert migrate_dataset(storage_used, bq.TEST_DATASET, station=7) == 0
+        df_read = storage_used.read_sql("select Station from " + bq.TEST_DATASET + "." +
+                                        table_rollup)
+        assert list(df_read["Station"]) == [7, 7]
+        bq.set_storage(None)
+        storage_used.close()
+
+    def test_resume(self):
+        storage_used = storage.LocalStorage(tempfile.mkdtemp())
+        bq.set_storage(storage_used)
+        schema_string = bq.TABLE_AGGR_SCHEMA.replace("DATE", "STRING").\
+            replace("TIME", "STRING")
+        storage_used.create_table(bq.TEST_DATASET, bq.TABLE_AGGR, schema_string)
+        df_test = pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 2, "", 6],
+                                [6, 2, "2018-01-02", "10:02", 6, 7, "", 6]],
+                               columns=bq.get_columns_from_list(schema_string))
+        storage_used.write_df(df_test, bq.TEST_DATASET, bq.TABLE_AGGR)
+        query = storage_used.query
+
+        def query_fail(sql):
+            # Fails after the sql sentence
+            query(sql)
+            if fail_sql in sql:
+                raise ConnectionError(fail_sql)
+        storage_used.query = query_fail
+        # The copy fails, the table is not migrated
+        fail_sql = "insert into"
+        with self.assertRaises(ConnectionError):
+            migrate_dataset(storage_used, bq.TEST_DATASET)
+        assert storage_used.get_column_types(bq.TEST_DATASET, bq.TABLE_AGGR)["Date"] == "STRING"
+        # Stopped between the renames
+        fail_sql = LEGACY_SUFFIX
+        with self.assertRaises(ConnectionError):
+            migrate_dataset(storage_used, bq.TEST_DATASET)
+        assert not storage_used.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR)
+        fail_sql = "not a sql sentence"
+        assert migrate_dataset(storage_used, bq.TEST_DATASET, drop=True) == 1
+        assert not storage_used.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR + MIGRATE_SUFFIX)
+        assert not storage_used.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR + LEGACY_SUFFIX)
+        # Rows copied once
+        df_read = bq.read_df_from_aggr("2018-01-02", dataset=bq.TEST_DATASET)
+        assert list(df_read["Time"]) == ["00:01:00", "10:02:00"]
+        assert migrate_dataset(storage_used, bq.TEST_DATASET) == 0
+        bq.set_storage(None)
+        storage_used.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default=bq.DEFAULT_DATASET,
+                        help='Dataset to migrate')
+    parser.add_argument('--local', default=None,
+                        help='Local storage directory, not big query.')
+    parser.add_argument('--drop', action='store_true', default=False,
+                        help='Delete old tables after the copy')
+    parser.add_argument('--station', type=int, default=bq.LEGACY_STATION,
+                        help='Station of the aggr rows without station')
+    args = parser.parse_args()
+    if args.local is not None:
+        bq.set_storage(storage.LocalStorage(args.local))
+    print(str(migrate_dataset(bq.get_storage(), args.dataset, drop=args.drop,
+                              station=args.station)) +
+          " tables migrated")
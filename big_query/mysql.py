@@ -1,7 +1,65 @@
+"""
+Mysql access, peaje.tb_mensaxes_in_transitos table.
+Connections are taken from a pool (ConnectionPool), checked with ping
+before use and opened again if they are lost, queries are retried.
+Queries have parameters, the sql text is always the same.
+Use:
+    mysql.py Date .- Print the query plan (explain) of a day
+    mysql.py Date --index N .- Query plan reading from index N
+    mysql.py Date --station N .- Query plan of a station
+    mysql.py Date --create_index .- Create the index for the query
+"""
+
+import argparse
+import contextlib
+import datetime
+import threading
+import time
+import unittest
 import MySQLdb
+import MySQLdb.cursors
+import numpy as np
 import pandas as pd
 from env import DB_HOST, DB_PORT, DB_USER, DB_PASS, DB_NAME
 
+# Rows by chunk in streaming mode
+CHUNK_ROWS = 100000
+# Default toll station
+STATION = 6
+# Integer columns of the query, by position
+INTEGER_COLUMNS = [0, 1, 2, 6, 7, 8, 9, 10, 11, 14, 15]
+# Index column of the query, by position
+INDEX_COLUMN = 15
+# Connections in the pool
+POOL_SIZE = 2
+# A connection idle more than these seconds is checked with ping
+POOL_CHECK_SECONDS = 10
+# Retries of a lost connection, first wait in seconds, doubled every retry
+RETRIES = 3
+RETRY_FIRST = 1.0
+# Errors of a lost connection
+CONNECTION_ERRORS = (MySQLdb.OperationalError, MySQLdb.InterfaceError)
+# Table and columns of the query, by position
+QUERY_SCHEMA = "peaje"
+QUERY_TABLE = "tb_mensaxes_in_transitos"
+QUERY_COLUMNS = ["N_Mensaxe_C", "N_Estacion_C", "N_Via_C", "D_Data_C",
+                 "T_Hora_C", "Sz_Chave_C", "N_Orixen_X", "N_Destino_X",
+                 "N_Pago_X", "N_Obu_Validez_In", "N_Obu_Pago", "N_Obu_Estacion",
+                 "D_Obu_Data", "T_Obu_Time", "N_Obu_Via_Entrada", "indice"]
+# Query of a station and a day from an index, parameters station, day and index
+SQL_QUERY = "select N_Mensaxe_C, N_Estacion_C, N_Via_C, D_Data_C,\
+                T_Hora_C, Sz_Chave_C, N_Orixen_X, N_Destino_X,\
+                N_Pago_X, N_Obu_Validez_In, N_Obu_Pago, N_Obu_Estacion,\
+                D_Obu_Data, T_Obu_Time, N_Obu_Via_Entrada, indice\n\
+        from peaje.tb_mensaxes_in_transitos\n \
+        where N_Estacion_C = %s   and N_Via_C < 20 and N_Avance_X = 0  and\
+        D_Data_C = %s and indice > %s order by T_Hora_C"
+# Index for SQL_QUERY, equality on station and day, range on indice.
+# A poll late in the day reads only the new rows.
+INDEX_NAME = "ix_transitos_estacion_data_indice"
+INDEX_SQL = "create index " + INDEX_NAME + \
+            " on peaje.tb_mensaxes_in_transitos (N_Estacion_C, D_Data_C, indice)"
+
 def connect_mysql():
     """
     Connect to a mysl BBDD
@@ -11,6 +69,13 @@ def connect_mysql():
     lconn = MySQLdb.connect(*datos)
     return lconn
 
+def get_connection_settings():
+    """
+    :return: dictionary, mysql connection settings, for replication clients
+    """
+    return {"host": DB_HOST, "port": int(DB_PORT), "user": DB_USER,
+            "passwd": DB_PASS}
+
 def close_mysql(lmysql_conn):
     """
     Close MySQLdb connection object
@@ -19,43 +84,379 @@ def close_mysql(lmysql_conn):
     """
     lmysql_conn.close()
 
-def get_sql_query(day_load, lindex):
+class ConnectionPool:
+    """
+    Pool of mysql connections.
+    A connection idle more than check_seconds is checked with ping,
+    a lost connection is closed and a new one is opened.
+    query .- Execute a query in a connection of the pool, retry
+             if the connection is lost.
+    """
+    def __init__(self, size=POOL_SIZE, connect=connect_mysql,
+                 check_seconds=POOL_CHECK_SECONDS, retries=RETRIES,
+                 retry_first=RETRY_FIRST):
+        """
+        :param size: max connections
+        :param connect: function, return a new connection
+        :param check_seconds: idle seconds to check a connection
+        :param retries: retries of a lost connection
+        :param retry_first: first wait to retry, seconds
+        """
+        self.connect = connect
+        self.check_seconds = check_seconds
+        self.retries = retries
+        self.retry_first = retry_first
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(size)
+        # Idle connections, tuples (connection, last time used)
+        self.idle = []
+
+    @staticmethod
+    def is_alive(lmysql_conn):
+        """
+        :param lmysql_conn: MySQLdb connection object
+        :return: True if the connection answers a ping
+        """
+        try:
+            lmysql_conn.ping()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    @staticmethod
+    def close_quiet(lmysql_conn):
+        """ Close a connection, maybe lost"""
+        try:
+            close_mysql(lmysql_conn)
+        except CONNECTION_ERRORS:
+            pass
+
+    def get(self):
+        """
+        Take a connection, wait if all are used
+        :return: MySQLdb connection object, alive
+        """
+        self.semaphore.acquire()
+        try:
+            with self.lock:
+                item = self.idle.pop() if len(self.idle) > 0 else None
+            if item is not None:
+                lmysql_conn, last_used = item
+                if time.time() - last_used < self.check_seconds or \
+                        self.is_alive(lmysql_conn):
+                    return lmysql_conn
+                print("Mysql connection lost, connect again")
+                self.close_quiet(lmysql_conn)
+            return self.connect()
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def put(self, lmysql_conn, lost=False):
+        """
+        Give back a connection
+        :param lmysql_conn: MySQLdb connection object
+        :param lost: True to close it, the connection is lost
+        :return:
+        """
+        if lost:
+            self.close_quiet(lmysql_conn)
+        else:
+            with self.lock:
+                self.idle.append((lmysql_conn, time.time()))
+        self.semaphore.release()
+
+    @contextlib.contextmanager
+    def query(self, sql, params=None, cursor_class=None):
+        """
+        Execute a query and yield the cursor.
+        If the connection is lost before the query is executed, it is
+        retried in a new connection with exponential backoff.
+        :param sql: sql sentence, %s for parameters
+        :param params: tuple, parameters of the sentence
+        :param cursor_class: None or MySQLdb cursor class
+        :return: cursor
+        """
+        delay = self.retry_first
+        for retry in range(self.retries + 1):
+            lmysql_conn = self.get()
+            try:
+                cursor = lmysql_conn.cursor() if cursor_class is None \
+                    else lmysql_conn.cursor(cursor_class)
+                cursor.execute(sql, params)
+                break
+            except CONNECTION_ERRORS as error:
+                self.put(lmysql_conn, lost=True)
+                if retry == self.retries:
+                    raise
+                print("Mysql retry in " + str(delay) + " s: " + str(error))
+                time.sleep(delay)
+                delay *= 2
+            except Exception:
+                self.put(lmysql_conn)
+                raise
+        lost = False
+        try:
+            yield cursor
+        except CONNECTION_ERRORS:
+            lost = True
+            raise
+        finally:
+            try:
+                cursor.close()
+            except CONNECTION_ERRORS:
+                lost = True
+            self.put(lmysql_conn, lost=lost)
+
+    def close(self):
+        """ Close the idle connections"""
+        with self.lock:
+            lst_idle, self.idle = self.idle, []
+        for lmysql_conn, last_used in lst_idle:
+            self.close_quiet(lmysql_conn)
+
+def get_sql_query(day_load, lindex, station=STATION):
     """
-    Return a string quety to get data from a lane and from a list of days.
+    Return the query to get data from a station and from a day, and its
+    parameters. The sql text does not change, only the parameters.
     The Query colect info about cars with spanish obu only
     :param day_load .- Day to get from mysql
     :param lindex : Get only data higher than lindex
-    :return: query string
+    :param station: toll station
+    :return: tuple, query string and tuple of parameters
     """
+    return SQL_QUERY, (int(station), str(day_load), int(lindex))
 
-    sz = "select N_Mensaxe_C, N_Estacion_C, N_Via_C, D_Data_C,\
-                T_Hora_C, Sz_Chave_C, N_Orixen_X, N_Destino_X,\
-                N_Pago_X, N_Obu_Validez_In, N_Obu_Pago, N_Obu_Estacion,\
-                D_Obu_Data, T_Obu_Time, N_Obu_Via_Entrada, indice\n\
-        from peaje.tb_mensaxes_in_transitos\n \
-        where N_Estacion_C = 6   and N_Via_C < 20 and N_Avance_X = 0  and\
-        D_Data_C=\"" + day_load + "\" and indice>" + str(lindex) + " order by T_Hora_C"
+def is_query_row(values, day_load, index, station=STATION):
+    """
+    Filter of SQL_QUERY for a row of the table, e.g. a replication event
+    :param values: dictionary, column: value
+    :param day_load: day, String YYYY-MM-DD
+    :param index: last index read
+    :param station: toll station
+    :return: True if the query returns the row
+    """
+    return values["N_Estacion_C"] == station and values["N_Via_C"] < 20 and \
+        values["N_Avance_X"] == 0 and str(values["D_Data_C"]) == str(day_load) and \
+        values["indice"] > index
 
-    return sz
+def get_dataframe(rows):
+    """
+    Rows to dataframe, a numpy array by column.
+    Integer columns are int64 arrays, object arrays if they have NULL.
+    :param rows: list of tuples
+    :return: dataframe, columns by position
+    """
+    columns = {}
+    for position, values in enumerate(zip(*rows)):
+        if position in INTEGER_COLUMNS:
+            try:
+                columns[position] = np.array(values, dtype=np.int64)
+                continue
+            except (TypeError, ValueError):
+                pass
+        columns[position] = np.array(values, dtype=object)
+    return pd.DataFrame(columns)
 
-def get_data(lmysql_conn, day_load, index):
-    # type: (object, str, int) -> Optional[pd.DataFrame]
+def get_data(pool, day_load, index, station=STATION):
+    # type: (ConnectionPool, str, int, int) -> Optional[pd.DataFrame]
     """
     Get data from mysql database
-    :param lmysql_conn: Mysql connection
+    :param pool: Mysql connection pool
     :param day_load: day to get data
     :param index: last index read, get data older than index
+    :param station: toll station
     :return: None or a dataframe with new data
     """
-    sz_sql = get_sql_query(day_load, index)
-    cursor = lmysql_conn.cursor()
-    cursor.execute(sz_sql)
-    lst = list(cursor.fetchall())
-    cursor.close()
+    sz_sql, params = get_sql_query(day_load, index, station)
+    with pool.query(sz_sql, params) as cursor:
+        lst = cursor.fetchall()
     if len(lst) > 0:
-        dataframe_result = pd.DataFrame(lst)
+        dataframe_result = get_dataframe(lst)
         return dataframe_result
     else:
         return None
 
+def get_data_chunks(pool, day_load, index, chunk_rows=CHUNK_ROWS, station=STATION):
+    """
+    Get data from mysql database in chunks, streaming.
+    Server side cursor, rows are read while they are processed,
+    only a chunk is in memory. The connection is not in the pool until
+    all the chunks are read.
+    If the connection is lost while reading, the query is executed again
+    in a new connection and the rows already read are skipped (by index).
+    :param pool: Mysql connection pool
+    :param day_load: day to get data
+    :param index: last index read, get data older than index
+    :param chunk_rows: rows by chunk
+    :param station: toll station
+    :return: generator of dataframes with new data, chunk_rows rows
+    """
+    sz_sql, params = get_sql_query(day_load, index, station)
+    # Indexes of the rows read
+    lst_read = []
+    retry = 0
+    while True:
+        try:
+            with pool.query(sz_sql, params, MySQLdb.cursors.SSCursor) as cursor:
+                read = np.concatenate(lst_read) if len(lst_read) > 0 else None
+                while True:
+                    lst = cursor.fetchmany(chunk_rows)
+                    if len(lst) == 0:
+                        return
+                    df = get_dataframe(lst)
+                    if read is not None:
+                        df = df[~df[INDEX_COLUMN].isin(read)].reset_index(drop=True)
+                        if len(df) == 0:
+                            continue
+                    lst_read.append(df[INDEX_COLUMN].values)
+                    yield df
+        except CONNECTION_ERRORS as error:
+            retry += 1
+            if retry > pool.retries:
+                raise
+            print("Mysql connection lost reading, query again: " + str(error))
+
+def explain_query(pool, day_load, index, station=STATION):
+    """
+    Query plan of the query of a day
+    :param pool: Mysql connection pool
+    :param day_load: day to get data
+    :param index: last index read
+    :param station: toll station
+    :return: dataframe, mysql explain rows
+    """
+    sz_sql, params = get_sql_query(day_load, index, station)
+    with pool.query("explain " + sz_sql, params) as cursor:
+        columns = [description[0] for description in cursor.description]
+        lst = list(cursor.fetchall())
+    return pd.DataFrame(lst, columns=columns)
+
+def get_plan_report(df_explain):
+    """
+    Check a query plan, the query has to use an index and not
+    read all the table
+    :param df_explain: dataframe, mysql explain rows
+    :return: list of strings, problems of the plan, empty if it is good
+    """
+    lst_problems = []
+    for row in df_explain.to_dict("records"):
+        if row.get("type") == "ALL":
+            lst_problems.append("Full scan of " + str(row.get("table")) +
+                                ", " + str(row.get("rows")) + " rows")
+        if row.get("key") is None:
+            lst_problems.append("No index used, create it: " + INDEX_SQL)
+    return lst_problems
+
+class TestMysql(unittest.TestCase):
+    row = (0, 6, 2, datetime.date(2018, 1, 1), datetime.timedelta(hours=1),
+           "55555", 6, 7, 8, 0, 5, 8, None, datetime.timedelta(0), 13, 1)
+
+    def get_pool(self, lst_rows, lst_errors):
+        """
+        Pool of fake connections
+        :param lst_rows: rows of the query
+        :param lst_errors: list of (method, error), raised once, in order.
+            fetchmany errors are raised after the first chunk
+        :return: pool, list of connections opened
+        """
+        lst_connections = []
+
+        def fail(method):
+            if len(lst_errors) > 0 and lst_errors[0][0] == method:
+                raise lst_errors.pop(0)[1]
+
+        class Cursor:
+            def __init__(self):
+                self.rows = list(lst_rows)
+                self.sql = None
+
+            def execute(self, sql, params):
+                fail("execute")
+                assert params == (6, "2018-01-01", 0)
+                self.sql = sql
+
+            def fetchmany(self, size):
+                if len(self.rows) < len(lst_rows):
+                    fail("fetchmany")
+                lst, self.rows = self.rows[:size], self.rows[size:]
+                return lst
+
+            def close(self):
+                pass
+
+        class Connection:
+            def __init__(self):
+                self.closed = False
+                lst_connections.append(self)
+
+            def cursor(self, cursor_class=None):
+                assert cursor_class == MySQLdb.cursors.SSCursor
+                return Cursor()
+
+            def ping(self):
+                fail("ping")
+
+            def close(self):
+                self.closed = True
+
+        return ConnectionPool(connect=Connection, check_seconds=0,
+                              retry_first=0.01), lst_connections
+
+    def test_get_data_chunks(self):
+        pool, lst_connections = self.get_pool([self.row] * 5, [])
+        lst_df = list(get_data_chunks(pool, "2018-01-01", 0, chunk_rows=2))
+        assert [len(df) for df in lst_df] == [2, 2, 1]
+        df = lst_df[0]
+        assert df[0].dtype == np.int64 and df[15].dtype == np.int64
+        assert df[3].tolist() == [datetime.date(2018, 1, 1)] * 2
+        assert df[12].tolist() == [None, None]
+        # Connection back in the pool, used again
+        list(get_data_chunks(pool, "2018-01-01", 0, chunk_rows=2))
+        assert len(lst_connections) == 1 and len(pool.idle) == 1
+
+    def test_reconnect(self):
+        lst_rows = [self.row[:15] + (index,) for index in range(1, 6)]
+        lst_errors = [("execute", MySQLdb.OperationalError("Gone away")),
+                      ("fetchmany", MySQLdb.OperationalError("Lost")),
+                      ("ping", MySQLdb.OperationalError("Gone away"))]
+        pool, lst_connections = self.get_pool(lst_rows, lst_errors)
+        lst_df = list(get_data_chunks(pool, "2018-01-01", 0, chunk_rows=2))
+        # Rows read before the error are not read again
+        assert [df[15].tolist() for df in lst_df] == [[1, 2], [3, 4], [5]]
+        assert [connection.closed for connection in lst_connections] == [True, True, False]
+        # Connection lost while idle
+        list(get_data_chunks(pool, "2018-01-01", 0))
+        assert lst_errors == []
+        assert len(lst_connections) == 4 and lst_connections[2].closed
+
+    def test_plan_report(self):
+        df_full = pd.DataFrame([["t", "ALL", None, 1000, "Using where; Using filesort"]],
+                               columns=["table", "type", "key", "rows", "Extra"])
+        assert len(get_plan_report(df_full)) == 2
+        df_index = pd.DataFrame([["t", "range", INDEX_NAME, 10, "Using filesort"]],
+                                columns=["table", "type", "key", "rows", "Extra"])
+        assert get_plan_report(df_index) == []
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('day', help='Day of the query, format YYYY-MM-DD')
+    parser.add_argument('--index', type=int, default=0,
+                        help='Last index read')
+    parser.add_argument('--station', type=int, default=STATION,
+                        help='Toll station')
+    parser.add_argument('--create_index', action='store_true', default=False,
+                        help='Create the index of the query')
+    args = parser.parse_args()
+    mysql_pool = ConnectionPool()
+    if args.create_index:
+        with mysql_pool.query(INDEX_SQL):
+            pass
+    df_plan = explain_query(mysql_pool, args.day, args.index, args.station)
+    print(df_plan.to_string())
+    lst_plan = get_plan_report(df_plan)
+    for problem in lst_plan:
+        print(problem)
+    if len(lst_plan) == 0:
+        print("Query plan uses an index")
+    mysql_pool.close()
@@ -0,0 +1,185 @@
+"""
+Vectorized normalization of car data read from mysql.
+All the columns are processed in bulk, not row by row:
+    Times (datetime.timedelta) .- String HH:MM:SS
+    Dates (datetime.date) .- String YYYY-MM-DD, None obu entry date is 0000-00-00
+    Integer columns .- Narrowest integer dtype
+    Travel_Time_Second .- Transit timestamp - obu entry timestamp (datetime64),
+                          0 if the car has not a valid obu or a date is not valid
+Use:
+    normalize_mysql .- Normalize a mysql dataframe to TABLE_RAW_SCHEMA columns
+    add_travel_time .- Add travel time to a TABLE_RAW_SCHEMA dataframe
+"""
+
+import datetime
+import numpy as np
+import pandas as pd
+import unittest
+import big_query as bq
+
+# Mysql dataframe columns, by position
+COLUMN_TIME = 4
+COLUMN_DATE = 3
+COLUMN_OBU_DATE = 12
+COLUMN_OBU_TIME = 13
+# Obu entry date when mysql has not date
+DATE_NONE = "0000-00-00"
+EPOCH = datetime.datetime(1970, 1, 1)
+# Strings HH:MM:SS for the seconds of a day, see get_time_strings
+TIME_STRINGS = None
+
+
+def get_time_strings():
+    """
+    :return: numpy array with the strings HH:MM:SS of all the seconds of a day
+    """
+    global TIME_STRINGS
+    if TIME_STRINGS is None:
+        TIME_STRINGS = np.array(['{:02d}:{:02d}:{:02d}'.format(second // 3600,
+                                                               second // 60 % 60,
+                                                               second % 60)
+                                 for second in range(24 * 3600)], dtype=object)
+    return TIME_STRINGS
+
+
+def format_time(serie):
+    """
+    :param serie: serie of datetime.timedelta
+    :return: serie of strings HH:MM:SS, hours of the day
+    """
+    seconds = pd.to_timedelta(serie).values.astype("timedelta64[s]").\
+        astype(np.int64) % (24 * 3600)
+    return pd.Series(get_time_strings()[seconds], index=serie.index)
+
+
+def format_date(serie, none_value=None):
+    """
+    Dates to string, only the distinct values are formatted
+    :param serie: serie of datetime.date, other values are not changed
+    :param none_value: value for None, None to not change
+    :return: serie of strings YYYY-MM-DD
+    """
+    if none_value is not None:
+        serie = serie.where(serie.notnull(), none_value)
+    codes, uniques = pd.factorize(serie)
+    formatted = np.array([value.strftime('%Y-%m-%d')
+                          if type(value) == datetime.date else value
+                          for value in uniques] + [None], dtype=object)
+    # None has code -1, the last value
+    return pd.Series(formatted[codes], index=serie.index)
+
+
+def get_timestamps(dates, times):
+    """
+    Only the distinct dates and times are parsed
+    :param dates: serie of strings YYYY-MM-DD
+    :param times: serie of strings HH:MM:SS
+    :return: serie datetime64, NaT if date or time are not valid
+    """
+    codes_date, unique_dates = pd.factorize(dates)
+    codes_time, unique_times = pd.factorize(times)
+    parsed_dates = pd.to_datetime(pd.Series(unique_dates, dtype=object),
+                                  format="%Y-%m-%d",
+                                  errors="coerce").values
+    parsed_times = (pd.to_datetime("1970-01-01 " + pd.Series(unique_times, dtype=object),
+                                   format="%Y-%m-%d %H:%M:%S",
+                                   errors="coerce") - EPOCH).values
+    # None has code -1, the last value
+    parsed_dates = np.append(parsed_dates, np.datetime64("NaT"))
+    parsed_times = np.append(parsed_times, np.timedelta64("NaT"))
+    return pd.Series(parsed_dates[codes_date] + parsed_times[codes_time],
+                     index=dates.index)
+
+
+def get_travel_time(df):
+    """
+    Travel time in seconds, vectorized
+    If car has a obu transponder ["N_Obu_Payment"] != 0
+    and entry info in obu is ok row["N_Obu_Entry_Ok"]==0
+        toll time - entry time
+    other case, or a date is not valid:
+        0
+    :param df: Dataframe with car transit info, TABLE_RAW_SCHEMA columns
+    :return: numpy array of int
+    """
+    timestamp = get_timestamps(df["D_Date"], df["T_Time"])
+    timestamp_in = get_timestamps(df["D_Obu_Entry_Date"], df["T_Obu_Entry_Time"])
+    seconds = (timestamp - timestamp_in).dt.total_seconds()
+    valid = (df["N_Obu_Payment"] != 0) & (df["N_Obu_Entry_Ok"] == 0) & \
+        seconds.notnull()
+    return np.where(valid, seconds.fillna(0), 0).astype(int)
+
+
+def add_travel_time(df):
+    """
+    Add travel time to a dataframe, "Travel_Time_Second" column
+    :param df:  Dataframe with car transit info.
+    :return: dataframe with travel time added "Travel_Time_Second"
+    """
+    df["Travel_Time_Second"] = get_travel_time(df)
+    return df
+
+
+def downcast_integers(df):
+    """
+    Change INTEGER columns of TABLE_RAW_SCHEMA to the narrowest integer dtype
+    :param df: Dataframe with TABLE_RAW_SCHEMA columns
+    :return: dataframe
+    """
+    for column_def in bq.TABLE_RAW_SCHEMA.split(','):
+        column_name, column_type = column_def.split(':')
+        if column_type == "INTEGER" and column_name in df.columns:
+            df[column_name] = pd.to_numeric(df[column_name], downcast="integer")
+    return df
+
+
+def process_dataframe(df):
+    """
+    Process time and dates from a mysql dataframe, columns by position
+    :param df: dataframe
+    :return: dataframe processed
+    """
+    df[COLUMN_TIME] = format_time(df[COLUMN_TIME])
+    df[COLUMN_OBU_DATE] = format_date(df[COLUMN_OBU_DATE], none_value=DATE_NONE)
+    df[COLUMN_OBU_TIME] = format_time(df[COLUMN_OBU_TIME])
+    df[COLUMN_DATE] = format_date(df[COLUMN_DATE])
+    return df
+
+
+def normalize_mysql(df):
+    """
+    Normalize a mysql dataframe, without the index column,
+    in a TABLE_RAW_SCHEMA dataframe with travel time
+    :param df: dataframe, columns by position
+    :return: dataframe
+    """
+    df = process_dataframe(df)
+    df["Travel_Time_Second"] = 0
+    df.columns = bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA)
+    df = add_travel_time(df)
+    return downcast_integers(df)
+
+
+class TestNormalize(unittest.TestCase):
+    def test_normalize_mysql(self):
+        lst = [[0, 6, 2, datetime.date(2018, 1, 1), datetime.timedelta(hours=1, seconds=5),
+                "55555", 6, 7, 8, 0, 5, 8, datetime.date(2018, 1, 1), datetime.timedelta(minutes=5), 13],
+               [1, 6, 2, datetime.date(2018, 1, 1), datetime.timedelta(hours=23, minutes=59, seconds=59),
+                "55555", 6, 7, 8, 0, 5, 8, None, datetime.timedelta(0), 13],
+               [2, 6, 2, datetime.date(2018, 1, 2), datetime.timedelta(0),
+                "55555", 6, 7, 8, 1, 5, 8, datetime.date(2018, 1, 1), datetime.timedelta(minutes=5), 13],
+               [3, 6, 2, datetime.date(2018, 1, 2), datetime.timedelta(seconds=10),
+                "55555", 6, 7, 8, 0, 5, 8, "2018-13-01", datetime.timedelta(minutes=5), 13],
+               [4, 6, 2, datetime.date(2018, 1, 2), datetime.timedelta(seconds=10),
+                "55555", 6, 7, 8, 0, 5, 8, datetime.date(2018, 1, 1), datetime.timedelta(hours=23), 13]
+               ]
+        df = normalize_mysql(pd.DataFrame(lst))
+        assert list(df.columns) == bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA)
+        assert list(df["D_Date"]) == ["2018-01-01", "2018-01-01", "2018-01-02", "2018-01-02", "2018-01-02"]
+        assert list(df["T_Time"]) == ["01:00:05", "23:59:59", "00:00:00", "00:00:10", "00:00:10"]
+        assert list(df["D_Obu_Entry_Date"]) == ["2018-01-01", "0000-00-00", "2018-01-01",
+                                                "2018-13-01", "2018-01-01"]
+        assert list(df["T_Obu_Entry_Time"]) == ["00:05:00", "00:00:00", "00:05:00", "00:05:00", "23:00:00"]
+        # Not valid obu entry, 0000-00-00 and not valid date have not travel time
+        assert list(df["Travel_Time_Second"]) == [3305, 0, 0, 0, 3610]
+        assert df["N_Station"].dtype == np.int8
@@ -0,0 +1,370 @@
+"""
+Write-behind sink for the online loader.
+Raw rows and window rows are buffered in memory and written to the tables
+in a background thread: mysql polling, aggregation and upload overlap,
+and many small loads become a few big ones.
+    The buffer is flushed when it has flush_rows rows or when it is
+        flush_seconds old.
+    Flushed batches wait in a queue of max_queue batches. If the queue is
+        full, the writer waits (backpressure), memory is bounded.
+    Transient errors are retried with exponential backoff. Other errors
+        stop the sink, they are raised in the next call.
+    A batch has an id, its writes are done once by table (storage.py): a
+        retry after a timeout or a lost connection, when the write could
+        be committed, do not duplicate raw rows or add windows twice.
+    Functions added with call run after the rows added before them are
+        written, e.g. save a checkpoint.
+    Rows in the buffer and batches in the queue are metrics.py gauges
+        (sink_rows, sink_batches), the write backlog.
+Use:
+    sink = WriteBehindSink()
+    sink.write_raw(df)
+    sink.merge_windows(df_aggr, dict_rollups)
+    sink.call(function, args)
+    sink.close() .- Write all and stop
+"""
+
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import pandas as pd
+from google.api_core import exceptions
+import big_query as bq
+import metrics
+import storage
+
+# Flush thresholds, rows in the buffer and age in seconds
+FLUSH_ROWS = 100000
+FLUSH_SECONDS = 120
+# Max batches waiting to be written
+MAX_QUEUE = 4
+# Retries of a transient error, first wait in seconds, doubled every retry
+RETRIES = 5
+RETRY_FIRST = 1.0
+# Errors retried, the write could be committed or not, writes of a batch
+# are idempotent by its id
+TRANSIENT_ERRORS = (exceptions.ServiceUnavailable,
+                    exceptions.InternalServerError,
+                    exceptions.BadGateway,
+                    exceptions.TooManyRequests,
+                    ConnectionError,
+                    TimeoutError)
+
+
+class WriteBehindSink:
+    """
+    Buffer rows by table and write them in a background thread.
+    Raw table rows are added, aggr and rollup rows are merged.
+    """
+    def __init__(self, dataset=bq.DEFAULT_DATASET, flush_rows=FLUSH_ROWS,
+                 flush_seconds=FLUSH_SECONDS, max_queue=MAX_QUEUE,
+                 retries=RETRIES, retry_first=RETRY_FIRST):
+        """
+        :param dataset:
+        :param flush_rows: rows in the buffer to flush
+        :param flush_seconds: age of the buffer to flush
+        :param max_queue: max batches waiting to be written
+        :param retries: retries of a transient error
+        :param retry_first: first wait to retry, seconds
+        """
+        self.dataset = dataset
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.retries = retries
+        self.retry_first = retry_first
+        self.lock = threading.Lock()
+        # Held to take a batch and put it in the queue, batches are written
+        # in order (FIFO), with the callbacks after their rows
+        self.push_lock = threading.RLock()
+        # Buffer, table: list of dataframes, and functions to call after
+        self.buffer = {}
+        self.callbacks = []
+        self.rows = 0
+        self.oldest = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def check_error(self):
+        """ Raise the error that stopped the sink"""
+        if self.error is not None:
+            raise self.error
+
+    def add(self, table_id, df):
+        """
+        Add rows to the buffer, flushed if it is full
+        :param table_id:
+        :param df: None or dataframe
+        :return:
+        """
+        self.check_error()
+        if df is None or len(df) == 0:
+            return
+        with self.lock:
+            self.buffer.setdefault(table_id, []).append(df)
+            self.rows += len(df)
+            if self.oldest is None:
+                self.oldest = time.time()
+            metrics.set_gauge("sink_rows", self.rows)
+        if self.is_ready():
+            self.push()
+
+    def write_raw(self, df):
+        """ Add rows to raw table"""
+        self.add(bq.TABLE_RAW, df)
+
+    def merge_windows(self, df_aggr, dict_rollups):
+        """
+        Merge window rows to aggr and rollup tables
+        :param df_aggr: None or dataframe
+        :param dict_rollups: Dictionary, key window size in minutes,
+            value dataframe or None
+        :return:
+        """
+        self.add(bq.TABLE_AGGR, df_aggr)
+        for resolution, df in dict_rollups.items():
+            self.add(bq.get_table_rollup(resolution), df)
+
+    def call(self, function, args_call):
+        """
+        Call a function after the rows added before are written
+        :param function:
+        :param args_call: list of arguments
+        :return:
+        """
+        self.check_error()
+        with self.lock:
+            self.callbacks.append((function, args_call))
+            if self.oldest is None:
+                self.oldest = time.time()
+
+    def is_ready(self):
+        """
+        :return: True if the buffer has to be flushed
+        """
+        with self.lock:
+            return self.rows >= self.flush_rows or \
+                (self.oldest is not None and
+                 time.time() - self.oldest >= self.flush_seconds)
+
+    def take_batch(self):
+        """
+        Get the buffer and empty it
+        :return: None if buffer is empty, or
+            tuple (batch id, dictionary table: dataframe, list of callbacks)
+        """
+        with self.lock:
+            if self.oldest is None:
+                return None
+            batch = (uuid.uuid4().hex,
+                     {table_id: pd.concat(lst_df, ignore_index=True)
+                      for table_id, lst_df in self.buffer.items()},
+                     self.callbacks)
+            self.buffer = {}
+            self.callbacks = []
+            self.rows = 0
+            self.oldest = None
+            metrics.set_gauge("sink_rows", 0)
+        return batch
+
+    def push(self):
+        """ Send the buffer to the queue, wait if the queue is full"""
+        with self.push_lock:
+            batch = self.take_batch()
+            if batch is not None:
+                self.queue.put(batch)
+                metrics.set_gauge("sink_batches", self.queue.qsize())
+
+    def push_old(self):
+        """
+        Background thread, send the buffer to the queue if it is too old
+        and the queue is empty, the put does not wait. If other thread is
+        sending a batch, nothing to do, the buffer is sent after it.
+        :return:
+        """
+        if not self.push_lock.acquire(blocking=False):
+            return
+        try:
+            if self.queue.empty() and self.is_ready():
+                self.push()
+        finally:
+            self.push_lock.release()
+
+    def flush(self):
+        """ Write all the buffer and wait until it is written"""
+        self.push()
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        """ Write all the buffer and stop the sink"""
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+
+    def write_table(self, table_id, df, batch_id):
+        """
+        Write rows to a table, retry transient errors.
+        The rows are written once by batch, a retry do not write them again.
+        :param table_id:
+        :param df:
+        :param batch_id: id of the batch
+        :return:
+        """
+        delay = self.retry_first
+        for retry in range(self.retries + 1):
+            try:
+                if table_id == bq.TABLE_RAW:
+                    bq.write_df(df, table_id, dataset=self.dataset, batch_id=batch_id)
+                else:
+                    bq.merge_df_aggr(df, table_id, dataset=self.dataset, batch_id=batch_id)
+                return
+            except TRANSIENT_ERRORS as error:
+                if retry == self.retries:
+                    raise
+                print("Retry " + table_id + " in " + str(delay) + " s: " + str(error))
+                time.sleep(delay)
+                delay *= 2
+
+    def write_batch(self, batch):
+        """
+        Write a batch, tables concurrently, and call its callbacks.
+        After an error, batches are not written.
+        :param batch: tuple (batch id, dictionary table: dataframe, list of callbacks)
+        :return:
+        """
+        if self.error is not None:
+            return
+        batch_id, dict_df, callbacks = batch
+        try:
+            bq.print_jobs(bq.run_jobs([(table_id, self.write_table, [table_id, df, batch_id])
+                                       for table_id, df in dict_df.items()]))
+            for function, args_call in callbacks:
+                function(*args_call)
+        except Exception as error:
+            self.error = error
+
+    def run(self):
+        """
+        Background thread, write the batches of the queue, only the queue:
+        a buffer too old is sent to the queue, batches are written in order
+        """
+        while True:
+            try:
+                batch = self.queue.get(timeout=min(self.flush_seconds, 1.0))
+            except queue.Empty:
+                self.push_old()
+                continue
+            if batch is not None:
+                self.write_batch(batch)
+            self.queue.task_done()
+            metrics.set_gauge("sink_batches", self.queue.qsize())
+            if batch is None:
+                return
+
+
+class TestSink(unittest.TestCase):
+    def setUp(self):
+        bq.set_storage(storage.LocalStorage(tempfile.mkdtemp()))
+        bq.create_tables(bq.get_storage(), dataset=bq.TEST_DATASET)
+        self.columns = bq.get_columns_from_list(bq.TABLE_AGGR_SCHEMA)
+
+    def tearDown(self):
+        bq.get_storage().close()
+        bq.set_storage(None)
+
+    def test_sink(self):
+        lst_called = []
+        sink = WriteBehindSink(dataset=bq.TEST_DATASET, flush_rows=3, flush_seconds=60)
+        sink.merge_windows(pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 0, "", 6]],
+                                        columns=self.columns), {})
+        sink.call(lst_called.append, ["first"])
+        # Not flushed, the buffer is not full
+        time.sleep(0.2)
+        assert lst_called == []
+        sink.merge_windows(pd.DataFrame([[6, 2, "2018-01-02", "00:01", 2, 50, "", 6],
+                                         [6, 2, "2018-01-02", "00:02", 1, 0, "", 6]],
+                                        columns=self.columns),
+                           {5: pd.DataFrame([[6, 2, "2018-01-02", "00:00", 4, 50, "", 6]],
+                                            columns=self.columns)})
+        sink.call(lst_called.append, ["second"])
+        sink.close()
+        assert lst_called == ["first", "second"]
+        df_read = bq.read_df_from_aggr("2018-01-02", dataset=bq.TEST_DATASET)
+        assert df_read["AHT"].tolist() == [3, 1]
+        assert df_read["Travel_Time"].tolist() == [50, 0]
+
+    def test_age_flush(self):
+        lst_called = []
+        sink = WriteBehindSink(dataset=bq.TEST_DATASET, flush_seconds=0.2)
+        sink.merge_windows(pd.DataFrame([[6, 2, "2018-01-02", "00:01", 1, 0, "", 6]],
+                                        columns=self.columns), {})
+        sink.call(lst_called.append, ["written"])
+        time.sleep(1.5)
+        assert lst_called == ["written"]
+        sink.close()
+
+    def test_order(self):
+        # Batches pushed by the loader and by age, written in order
+        lst_called = []
+        sink = WriteBehindSink(dataset=bq.TEST_DATASET, flush_rows=2, flush_seconds=0.01,
+                               max_queue=1)
+        for minute in range(40):
+            sink.merge_windows(pd.DataFrame([[6, 2, "2018-01-02", "00:%02d" % minute, 1, 0, "", 6]],
+                                            columns=self.columns), {})
+            sink.call(lst_called.append, [minute])
+            time.sleep(0.005 * (minute % 3))
+        sink.close()
+        assert lst_called == list(range(40))
+        assert bq.read_df_from_aggr("2018-01-02", dataset=bq.TEST_DATASET).shape[0] == 40
+
+    def test_retry(self):
+        lst_errors = [ConnectionError("Transient"), ConnectionError("Transient")]
+        write_df = bq.write_df
+
+        def write_df_fail(*args_write, **kwargs):
+            if len(lst_errors) > 0:
+                raise lst_errors.pop()
+            write_df(*args_write, **kwargs)
+        bq.write_df = write_df_fail
+        try:
+            sink = WriteBehindSink(dataset=bq.TEST_DATASET, retry_first=0.01)
+            sink.write_raw(pd.DataFrame([[0, 6, 2, "2018-01-02", "00:00:00", "55555", 6, 7,
+                                          8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 14]],
+                                        columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA)))
+            sink.close()
+        finally:
+            bq.write_df = write_df
+        assert lst_errors == []
+        assert bq.read_df_from_raw("2018-01-02", dataset=bq.TEST_DATASET).shape[0] == 1
+        # Timeout of a merge committed, the retry do not add it again
+        lst_errors = [TimeoutError("Job not finished")]
+        merge_df_aggr = bq.merge_df_aggr
+
+        def merge_df_aggr_timeout(*args_merge, **kwargs):
+            merge_df_aggr(*args_merge, **kwargs)
+            if len(lst_errors) > 0:
+                raise lst_errors.pop()
+        bq.merge_df_aggr = merge_df_aggr_timeout
+        try:
+            sink = WriteBehindSink(dataset=bq.TEST_DATASET, retry_first=0.01)
+            sink.merge_windows(pd.DataFrame([[6, 2, "2018-01-02", "00:01", 2, 50, "10:2", 6]],
+                                            columns=self.columns), {})
+            sink.close()
+        finally:
+            bq.merge_df_aggr = merge_df_aggr
+        assert lst_errors == []
+        df_read = bq.read_df_from_aggr("2018-01-02", dataset=bq.TEST_DATASET)
+        assert df_read["AHT"].tolist() == [2]
+        assert df_read["Travel_Time_Sketch"].tolist() == ["10:2"]
+        # Not transient errors stop the sink
+        sink = WriteBehindSink(dataset=bq.TEST_DATASET)
+        sink.write_raw(pd.DataFrame([[1]], columns=["Not_Column"]))
+        with self.assertRaises(Exception):
+            sink.close()
@@ -0,0 +1,151 @@
+"""
+Travel time quantile sketches, a fixed bucket histogram by route and window.
+Buckets are log spaced from SKETCH_MIN_SECONDS, every bucket is SKETCH_RATIO
+times the previous one: a quantile got from a sketch is the middle of its
+bucket, less than 2.5% from the travel time, for any number of cars.
+Travel times shorter than SKETCH_MIN_SECONDS are in the first bucket,
+longer than the last bucket in the last one.
+Sketches are mergeable, the count of a bucket is added: minutes are merged
+in rollup windows, corrections in the minute rows and any range of minutes
+or days in a query, without the raw transits.
+In memory a sketch is a dictionary, bucket: cars. In the aggr tables it is
+a string "bucket:cars,bucket:cars", "" without travel time. Two strings
+joined with "," are the merge of their sketches, a bucket can be repeated,
+so the sql MERGE of a correction only concatenates the strings.
+Use:
+    sketch = get_sketch(np.array([600, 640, 700]))
+    merge_sketch(sketch, get_sketch(np.array([620])))
+    get_quantiles(sketch, [0.5, 0.85, 0.95])
+    get_sketch_from_string(get_sketch_string(sketch))
+    get_sketch_bytes(sketch) .- Bytes in memory, see window.get_routes_bytes
+"""
+
+import sys
+import unittest
+import numpy as np
+
+# Upper bound of the first bucket, seconds
+SKETCH_MIN_SECONDS = 30
+# Size of a bucket by the size of the previous one
+SKETCH_RATIO = 1.05
+# Number of buckets, the last one ends over 6 hours
+SKETCH_BUCKETS = 136
+# Quantiles of the travel time queries, P50, P85 and P95
+QUANTILES = [0.5, 0.85, 0.95]
+
+
+def get_buckets(travel_time):
+    """
+    :param travel_time: numpy array of travel times in seconds, greater than 0
+    :return: numpy array, bucket of every travel time
+    """
+    buckets = np.floor(np.log(np.maximum(travel_time, SKETCH_MIN_SECONDS) /
+                              SKETCH_MIN_SECONDS) / np.log(SKETCH_RATIO))
+    return np.minimum(buckets, SKETCH_BUCKETS - 1).astype(np.int64)
+
+
+def get_bucket_value(bucket):
+    """
+    :param bucket:
+    :return: travel time of a bucket in seconds, the geometric middle
+    """
+    return int(round(SKETCH_MIN_SECONDS * SKETCH_RATIO ** (bucket + 0.5)))
+
+
+def get_sketch(travel_time):
+    """
+    :param travel_time: numpy array of travel times in seconds,
+        0 is no travel time and it is not counted
+    :return: sketch, dictionary bucket: cars
+    """
+    buckets, counts = np.unique(get_buckets(travel_time[travel_time > 0]),
+                                return_counts=True)
+    return dict(zip(buckets.tolist(), counts.tolist()))
+
+
+def merge_sketch(sketch, other):
+    """
+    Merge a sketch into other in place
+    :param sketch: sketch to update
+    :param other: sketch to merge
+    :return: sketch
+    """
+    for bucket, cars in other.items():
+        sketch[bucket] = sketch.get(bucket, 0) + cars
+    return sketch
+
+
+def get_sketch_bytes(sketch):
+    """
+    :param sketch: dictionary bucket: cars
+    :return: bytes in memory of the sketch: dictionary and the counts not
+        cached by python (over 256), buckets are always cached
+    """
+    return sys.getsizeof(sketch) + sum(sys.getsizeof(cars) for cars in sketch.values()
+                                       if cars > 256)
+
+
+def get_sketch_string(sketch):
+    """
+    :param sketch: dictionary bucket: cars
+    :return: String "bucket:cars,...", ordered by bucket, "" if empty
+    """
+    return ",".join(["%d:%d" % item for item in sorted(sketch.items())])
+
+
+def get_sketch_from_string(text):
+    """
+    :param text: String "bucket:cars,...", sketches joined by "," too.
+        None or "" is an empty sketch, e.g. rows without sketch
+    :return: sketch, dictionary bucket: cars
+    """
+    sketch = {}
+    if not isinstance(text, str):
+        return sketch
+    for item in text.split(","):
+        if item != "":
+            bucket, cars = item.split(":")
+            sketch[int(bucket)] = sketch.get(int(bucket), 0) + int(cars)
+    return sketch
+
+
+def get_quantiles(sketch, quantiles=QUANTILES):
+    """
+    :param sketch: dictionary bucket: cars
+    :param quantiles: list of quantiles, 0 - 1
+    :return: list of travel times in seconds, the bucket value of every
+        quantile. 0 if the sketch is empty, like Travel_Time
+    """
+    n_cars = sum(sketch.values())
+    if n_cars == 0:
+        return [0] * len(quantiles)
+    buckets = sorted(sketch)
+    accumulated = np.cumsum([sketch[bucket] for bucket in buckets])
+    return [get_bucket_value(buckets[np.searchsorted(accumulated, max(1, quantile * n_cars))])
+            for quantile in quantiles]
+
+
+class TestSketch(unittest.TestCase):
+    def test_sketch(self):
+        travel_time = np.arange(0, 1001)
+        sketch = get_sketch(travel_time)
+        assert sum(sketch.values()) == 1000
+        for value, quantile in zip(get_quantiles(sketch), QUANTILES):
+            assert abs(value - quantile * 1000) <= 0.025 * quantile * 1000 + 1
+        # Short and long travel times are in the first and last bucket
+        assert get_sketch(np.array([5, 100000])) == {0: 1, SKETCH_BUCKETS - 1: 1}
+        assert get_quantiles({}) == [0, 0, 0]
+
+    def test_merge(self):
+        travel_time = np.random.RandomState(0).lognormal(6.5, 0.3, 5000).astype(int)
+        sketch = get_sketch(travel_time[:3000])
+        merge_sketch(sketch, get_sketch(travel_time[3000:]))
+        assert sketch == get_sketch(travel_time)
+        # Strings joined are merged
+        text = get_sketch_string(get_sketch(travel_time[:3000])) + "," + \
+            get_sketch_string(get_sketch(travel_time[3000:]))
+        assert get_sketch_from_string(text) == sketch
+        assert get_sketch_from_string(get_sketch_string(sketch)) == sketch
+        assert get_sketch_from_string("") == {} and get_sketch_from_string(None) == {}
+        for value, exact in zip(get_quantiles(sketch), np.quantile(travel_time, QUANTILES)):
+            assert abs(value - exact) <= 0.03 * exact
@@ -0,0 +1,915 @@
+"""
+Storage backends for the raw and aggr tables.
+BigQueryStorage .- Tables in Google big query, based on pandas_gbq
+LocalStorage .- Tables in an embedded sqlite database, a file by dataset
+    in a directory. Same tables and sql sentences than big query, to load
+    and test offline and to make reproducible performance measurements.
+Both backends have the same methods:
+    create_dataset .- Create a dataset if it does not exist
+    create_table .- Create a table if it does not exist, partitioned by a
+                    date column and clustered by route columns. Columns new
+                    in the schema are added to an existing table
+    add_columns .- Add the schema columns missing in a table
+    get_column_types .- Big query types of the columns of a table
+    delete_table .- Delete a table
+    table_exists .- True if a table exists
+    cast_sql .- Sql expression to cast a string column to a column type
+    write_df .- Append a dataframe to a table
+    replace_partition .- Replace the rows of a day, atomic
+    replace_partition_files .- Replace the rows of a day with parquet files, atomic
+    merge_df .- Update the rows with the same key, insert the others. Atomic
+    load_files .- Append parquet files to a table, all the files together
+write_df and merge_df with a batch id are done once by batch and table:
+the id is saved in the table of batches of the table (get_batch_table) in
+the same transaction as the rows, a write of a batch already written is
+skipped. A retry of a write with an unknown result (a job timeout, a lost
+connection) do not duplicate the rows.
+Dataframes are written to big query as parquet files with the table schema
+(write_parquet) and a load job: columnar, compressed, without schema
+inference. Local storage reads the same files.
+    read_sql .- Dataframe from a select
+    query .- Run a sql sentence and wait until it finish
+Big query jobs are waited with exponential backoff polling and a timeout,
+see wait_job. The backends are thread safe, jobs can run concurrently,
+see big_query.run_jobs.
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import numpy as np
+import pandas as pd
+import pandas_gbq as pd_gbq
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.api_core import exceptions
+import big_query as bq
+import metrics
+
+# Big query job polling, first and max seconds between polls
+JOB_POLL_FIRST = 0.05
+JOB_POLL_MAX = 2.0
+# Max seconds to wait a big query job
+JOB_TIMEOUT = 600
+# Parquet column types for the big query types
+PARQUET_TYPES = {"INTEGER": pa.int64(),
+                 "FLOAT": pa.float64(),
+                 "STRING": pa.string(),
+                 "DATE": pa.date32(),
+                 "TIME": pa.time64("us"),
+                 "TIMESTAMP": pa.timestamp("us")}
+PARQUET_COMPRESSION = "snappy"
+# Local storage file extension, a file by dataset
+LOCAL_EXTENSION = ".sqlite"
+# Seconds to wait for a dataset file locked by other process
+LOCAL_LOCK_TIMEOUT = 120
+# Sqlite column types for the big query types.
+# Dates and times are text YYYY-MM-DD and HH:MM:SS, ordered as text.
+# Their names end in TEXT (text affinity) and keep the big query type
+LOCAL_TYPES = {"INTEGER": "INTEGER",
+               "FLOAT": "REAL",
+               "STRING": "TEXT",
+               "DATE": "DATE_TEXT",
+               "TIME": "TIME_TEXT",
+               "TIMESTAMP": "TIMESTAMP_TEXT"}
+# Big query types for the sqlite column types
+LOCAL_BIG_QUERY_TYPES = {local_type: column_type
+                         for column_type, local_type in LOCAL_TYPES.items()}
+# Table of the batches written to a table, table id and suffix
+BATCH_SUFFIX = "_batches"
+BATCH_SCHEMA = "Batch_Id:STRING"
+
+
+def get_schema_dicts(schema_list):
+    """
+    :param schema_list: Columns definitions separate by  "," character,
+        A column definition is NAME: TYPE
+    :return: list of dictionaries with name and type, pandas_gbq table_schema
+    """
+    schema = []
+    for column_def in schema_list.split(','):
+        column_name, column_type = column_def.split(':')
+        schema.append({"name": column_name, "type": column_type})
+    return schema
+
+
+def get_parquet_array(serie, column_type):
+    """
+    Serie to arrow array, dates YYYY-MM-DD and times HH:MM:SS strings
+    are parsed, only the distinct values.
+    :param serie: dataframe column
+    :param column_type: big query type
+    :return: arrow array, null for values not valid
+    """
+    if column_type in ("DATE", "TIME"):
+        codes, uniques = pd.factorize(serie)
+        uniques = pd.Series(uniques, dtype=object)
+        if column_type == "DATE":
+            parsed = pd.to_datetime(uniques, format="%Y-%m-%d", errors="coerce")
+            values = parsed.values.astype("datetime64[D]").astype(np.int64)
+        else:
+            parsed = pd.to_timedelta(uniques, errors="coerce")
+            values = parsed.values.astype("timedelta64[us]").astype(np.int64)
+        null = np.append(parsed.isnull().values, True)[codes]
+        values = np.append(values, 0)[codes]
+        if column_type == "DATE":
+            values = values.astype(np.int32)
+        return pa.array(values, type=PARQUET_TYPES[column_type], mask=null)
+    if column_type == "STRING":
+        serie = serie.where(serie.isnull(), serie.astype(str))
+    return pa.array(serie, type=PARQUET_TYPES[column_type], from_pandas=True)
+
+
+def write_parquet(df, file_name, schema_list):
+    """
+    Write a dataframe to a compressed parquet file with the table schema.
+    Loads upload these files, their size is counted in upload_bytes metric.
+    :param df: dataframe, dates and times as strings
+    :param file_name:
+    :param schema_list: table schema
+    :return:
+    """
+    columns = get_schema_dicts(schema_list)
+    table = pa.Table.from_arrays([get_parquet_array(df[column["name"]], column["type"])
+                                  for column in columns],
+                                 names=[column["name"] for column in columns])
+    pq.write_table(table, file_name, compression=PARQUET_COMPRESSION)
+    metrics.count("upload_bytes", os.path.getsize(file_name))
+
+
+def read_parquet(file_name):
+    """
+    :param file_name: parquet file written by write_parquet
+    :return: dataframe, dates YYYY-MM-DD and times HH:MM:SS strings
+    """
+    table = pq.read_table(file_name)
+    df = table.to_pandas(date_as_object=True)
+    for field in table.schema:
+        if field.type in (PARQUET_TYPES["DATE"], PARQUET_TYPES["TIME"]):
+            df[field.name] = df[field.name].where(df[field.name].isnull(),
+                                                  df[field.name].astype(str))
+    return df
+
+
+def wait_job(job, timeout=JOB_TIMEOUT):
+    """
+    Wait until a big query job finish, polling with exponential backoff.
+    :param job: big query job
+    :param timeout: seconds, the job is cancelled after that
+    :return: job result
+    """
+    delay = JOB_POLL_FIRST
+    start_time = time.time()
+    while not job.done():
+        if time.time() - start_time > timeout:
+            job.cancel()
+            raise TimeoutError("Job " + str(job.job_id) + " not finished in " +
+                               str(timeout) + " s")
+        time.sleep(delay)
+        delay = min(delay * 2, JOB_POLL_MAX)
+    # Raise the job errors
+    return job.result()
+
+
+def get_merge_condition(key_columns, partition_column, dates):
+    """
+    :param key_columns: list of columns, t target and s source tables
+    :param partition_column: date column, None if table is not partitioned
+    :param dates: dates in the source, only these partitions are read
+    :return: sql condition, rows with the same key
+    """
+    condition = " and ".join(["t." + column + " = s." + column
+                              for column in key_columns])
+    if partition_column is not None:
+        condition += " and t." + partition_column + " in ('" + "', '".join(dates) + "')"
+    return condition
+
+
+def get_batch_table(table_id):
+    """
+    :param table_id:
+    :return: table with the ids of the batches written to table_id
+    """
+    return table_id + BATCH_SUFFIX
+
+
+def get_batch_script(sql, dataset_id, table_id, batch_id):
+    """
+    :param sql: dml sentence, write a batch to table_id
+    :param dataset_id:
+    :param table_id:
+    :param batch_id: id of the batch
+    :return: big query script, a transaction: if the batch is not in the
+        table of batches, run the sentence and add the batch
+    """
+    batch_table = dataset_id + "." + get_batch_table(table_id)
+    return "begin transaction; " \
+           "if not exists (select 1 from " + batch_table + \
+           " where Batch_Id = '" + batch_id + "') then " + sql + "; " \
+           "insert into " + batch_table + " (Batch_Id) values ('" + batch_id + "'); " \
+           "end if; commit transaction;"
+
+
+def get_target_sql(sql, table_id):
+    """
+    :param sql: sql expression or condition with t (target table) columns
+    :param table_id: target table
+    :return: sql with table_id columns, e.g. t.AHT to aggr.AHT
+    """
+    return re.sub(r"\bt\.", table_id + ".", sql)
+
+
+class BigQueryStorage:
+    """
+    Tables in Google big query
+    """
+    def __init__(self, project_id):
+        """
+        :param project_id: Google cloud project
+        """
+        self.project_id = project_id
+        self.client = None
+        # Tables of batches created, dataset.table
+        self.batch_tables = set()
+
+    def get_client(self):
+        """
+        :return: A big query client, created the first time
+        """
+        if self.client is None:
+            self.client = bigquery.Client(project=self.project_id)
+        return self.client
+
+    def create_dataset(self, dataset_id):
+        """ Create a dataset en EU if it do not exist."""
+        client = self.get_client()
+        dataset = bigquery.Dataset(client.dataset(dataset_id))
+        dataset.location = 'EU'
+        try:
+            client.create_dataset(dataset)
+        except exceptions.Conflict:
+            pass
+
+    def create_table(self, dataset_id, table_id, schema_list,
+                     partition_column=None, cluster_columns=None):
+        """
+        Create a table if it does not exist, form a schema
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: Columns definitions separate by  "," character,
+            A column definition is NAME: TYPE
+        :param partition_column: DATE column, a partition by day. None not partitioned
+        :param cluster_columns: list of columns to cluster the table, None not clustered
+        :return:
+        """
+        client = self.get_client()
+        table_ref = client.dataset(dataset_id).table(table_id)
+        table = bigquery.Table(table_ref,
+                               schema=bq.get_schema_from_list(schema_list))
+        if partition_column is not None:
+            table.time_partitioning = bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.DAY,
+                field=partition_column)
+        if cluster_columns is not None:
+            table.clustering_fields = cluster_columns
+        try:
+            client.create_table(table)
+        except exceptions.Conflict:
+            self.add_columns(dataset_id, table_id, schema_list)
+
+    def add_columns(self, dataset_id, table_id, schema_list):
+        """
+        Add the schema columns missing in a table, e.g. a column new in the
+        schema, null in the rows of the table. Other columns do not change.
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: Columns definitions separate by  "," character,
+            A column definition is NAME: TYPE
+        :return:
+        """
+        client = self.get_client()
+        table = client.get_table(client.dataset(dataset_id).table(table_id))
+        set_columns = set(field.name for field in table.schema)
+        lst_missing = [field for field in bq.get_schema_from_list(schema_list)
+                       if field.name not in set_columns]
+        if len(lst_missing) > 0:
+            table.schema = list(table.schema) + lst_missing
+            client.update_table(table, ["schema"])
+
+    def create_batch_table(self, dataset_id, table_id):
+        """
+        Create the table of batches of a table if it does not exist,
+        once by storage
+        :param dataset_id:
+        :param table_id:
+        :return:
+        """
+        batch_table = get_batch_table(table_id)
+        if dataset_id + "." + batch_table not in self.batch_tables:
+            self.create_table(dataset_id, batch_table, BATCH_SCHEMA)
+            self.batch_tables.add(dataset_id + "." + batch_table)
+
+    def get_column_types(self, dataset_id, table_id):
+        """
+        :param dataset_id:
+        :param table_id:
+        :return: dictionary, column: big query type
+        """
+        client = self.get_client()
+        table = client.get_table(client.dataset(dataset_id).table(table_id))
+        return {field.name: field.field_type for field in table.schema}
+
+    def delete_table(self, dataset_id, table_id):
+        """ Deleta a table"""
+        client = self.get_client()
+        self.batch_tables.discard(dataset_id + "." + table_id)
+        try:
+            client.delete_table(client.dataset(dataset_id).table(table_id))
+        except exceptions.NotFound:
+            pass
+
+    def table_exists(self, dataset_id, table_id):
+        """ True if the table exists"""
+        client = self.get_client()
+        try:
+            client.get_table(client.dataset(dataset_id).table(table_id))
+        except exceptions.NotFound:
+            return False
+        return True
+
+    @staticmethod
+    def cast_sql(column_name, column_type):
+        """
+        :param column_name: STRING column, dates YYYY-MM-DD,
+            times HH:MM:SS or HH:MM
+        :param column_type: new type
+        :return: standard sql expression, NULL if not valid
+        """
+        if column_type == "DATE":
+            return "SAFE.PARSE_DATE('%Y-%m-%d', " + column_name + ")"
+        if column_type == "TIME":
+            return "SAFE.PARSE_TIME('%H:%M:%S', IF(LENGTH(" + column_name + \
+                   ") = 5, CONCAT(" + column_name + ", ':00'), " + column_name + "))"
+        return column_name
+
+    def write_df(self, df, dataset_id, table_id, schema_list=None, batch_id=None):
+        """
+        Append a dataframe to a table. With schema a parquet file is loaded,
+        without schema pandas_gbq infer it.
+        With batch id the file is loaded to a stage table and inserted in
+        a transaction with the batch, only if the batch is not written.
+        :param df: dataframe to write
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: table schema, needed for DATE and TIME columns
+            with strings
+        :param batch_id: None or id of the batch of the rows
+        :return:
+        """
+        if batch_id is not None:
+            self.create_batch_table(dataset_id, table_id)
+            table_stage = table_id + "_stage_" + uuid.uuid4().hex[:8]
+            self.write_df(df, dataset_id, table_stage, schema_list)
+            columns = ", ".join(df.columns)
+            try:
+                self.query(get_batch_script("insert into " + dataset_id + "." + table_id +
+                                            " (" + columns + ") select " + columns +
+                                            " from " + dataset_id + "." + table_stage,
+                                            dataset_id, table_id, batch_id))
+            finally:
+                self.delete_table(dataset_id, table_stage)
+            return
+        if schema_list is None:
+            pd_gbq.to_gbq(df,
+                          dataset_id + '.' + table_id,
+                          self.project_id,
+                          if_exists='append')
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, table_id + ".parquet")
+            write_parquet(df, file_name, schema_list)
+            self.load_files([file_name], dataset_id, table_id, schema_list)
+        finally:
+            shutil.rmtree(directory)
+
+    def load_file(self, file_name, table_ref, write_disposition):
+        """
+        Load a parquet file to a table
+        :param file_name:
+        :param table_ref: table reference or table id
+        :param write_disposition: bigquery.WriteDisposition
+        :return:
+        """
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=write_disposition)
+        with open(file_name, "rb") as file_load:
+            job = self.get_client().load_table_from_file(file_load, table_ref,
+                                                         job_config=job_config)
+        wait_job(job)
+
+    def load_files(self, lst_files, dataset_id, table_id, schema_list):
+        """
+        Append parquet files to a table, all the files or none.
+        A file is loaded directly, more files are loaded to a stage
+        table and inserted together.
+        :param lst_files: parquet files written with write_parquet
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: table schema
+        :return:
+        """
+        client = self.get_client()
+        if len(lst_files) == 1:
+            self.load_file(lst_files[0], client.dataset(dataset_id).table(table_id),
+                           bigquery.WriteDisposition.WRITE_APPEND)
+            return
+        table_stage = table_id + "_stage_" + uuid.uuid4().hex[:8]
+        try:
+            for file_name in lst_files:
+                self.load_file(file_name, client.dataset(dataset_id).table(table_stage),
+                               bigquery.WriteDisposition.WRITE_APPEND)
+            columns = ", ".join(bq.get_columns_from_list(schema_list))
+            self.query("insert into " + dataset_id + "." + table_id + " (" + columns +
+                       ") select " + columns + " from " + dataset_id + "." + table_stage)
+        finally:
+            self.delete_table(dataset_id, table_stage)
+
+    def replace_partition(self, df, dataset_id, table_id, schema_list,
+                          partition_column, date):
+        """
+        Replace the rows of a day with a dataframe.
+        Load job that truncates the day partition, atomic, without dml.
+        :param df: dataframe, all rows of the date
+        :param dataset_id:
+        :param table_id: table partitioned by partition_column
+        :param schema_list: table schema
+        :param partition_column: DATE column
+        :param date: day, YYYY-MM-DD
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, table_id + ".parquet")
+            write_parquet(df, file_name, schema_list)
+            self.replace_partition_files([file_name], dataset_id, table_id,
+                                         schema_list, partition_column, date)
+        finally:
+            shutil.rmtree(directory)
+
+    def replace_partition_files(self, lst_files, dataset_id, table_id, schema_list,
+                                partition_column, date):
+        """
+        Replace the rows of a day with parquet files, atomic.
+        A file is loaded truncating the partition. More files are loaded
+        to a stage table, copied to the partition truncating it.
+        :param lst_files: parquet files written with write_parquet, rows of the date
+        :param dataset_id:
+        :param table_id: table partitioned by partition_column
+        :param schema_list: table schema
+        :param partition_column: DATE column
+        :param date: day, YYYY-MM-DD
+        :return:
+        """
+        client = self.get_client()
+        table_partition = client.dataset(dataset_id).\
+            table(table_id + "$" + date.replace("-", ""))
+        if len(lst_files) == 1:
+            self.load_file(lst_files[0], table_partition,
+                           bigquery.WriteDisposition.WRITE_TRUNCATE)
+            return
+        table_stage = client.dataset(dataset_id).\
+            table(table_id + "_stage_" + uuid.uuid4().hex[:8])
+        try:
+            for file_name in lst_files:
+                self.load_file(file_name, table_stage,
+                               bigquery.WriteDisposition.WRITE_APPEND)
+            job_config = bigquery.CopyJobConfig(
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+            wait_job(client.copy_table(table_stage, table_partition,
+                                       job_config=job_config))
+        finally:
+            self.delete_table(dataset_id, table_stage.table_id)
+
+    def merge_df(self, df, dataset_id, table_id, schema_list, key_columns,
+                 update_sql, partition_column=None, batch_id=None):
+        """
+        Merge a dataframe in a table: rows with the same key are updated,
+        other rows inserted. The dataframe is loaded to a stage table
+        and merged with a MERGE sentence, only the partitions of the
+        dataframe dates are read. With batch id the MERGE runs in a
+        transaction with the batch, only if the batch is not merged.
+        :param df: dataframe, only a row by key
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: table schema
+        :param key_columns: list of key columns
+        :param update_sql: dictionary, column: sql expression with t (table)
+            and s (dataframe) columns
+        :param partition_column: DATE column of the partitions
+        :param batch_id: None or id of the batch of the rows
+        :return:
+        """
+        columns = list(df.columns)
+        table_stage = table_id + "_merge_" + uuid.uuid4().hex[:8]
+        self.write_df(df, dataset_id, table_stage, schema_list)
+        dates = []
+        if partition_column is not None:
+            dates = [str(date) for date in df[partition_column].unique()]
+        sql = "merge " + dataset_id + "." + table_id + " t using " + \
+              dataset_id + "." + table_stage + " s on " + \
+              get_merge_condition(key_columns, partition_column, dates) + \
+              " when matched then update set " + \
+              ", ".join([column + " = " + expression
+                         for column, expression in update_sql.items()]) + \
+              " when not matched then insert (" + ", ".join(columns) + \
+              ") values (" + ", ".join(["s." + column for column in columns]) + ")"
+        if batch_id is not None:
+            self.create_batch_table(dataset_id, table_id)
+            sql = get_batch_script(sql, dataset_id, table_id, batch_id)
+        try:
+            self.query(sql)
+        finally:
+            self.delete_table(dataset_id, table_stage)
+
+    def read_sql(self, sql):
+        """
+        :param sql: select sentence, standard sql
+        :return: Dataframe with the result
+        """
+        return pd_gbq.read_gbq(sql, self.project_id, dialect='standard')
+
+    def query(self, sql):
+        """
+        Run a sql sentence and wait until it finish
+        :param sql: standard sql
+        :return:
+        """
+        wait_job(self.get_client().query(sql))
+
+
+class LocalStorage:
+    """
+    Tables in an embedded sqlite database.
+    Every dataset is a sqlite file in directory, attached with the
+    dataset name, so dataset.table works in the sql sentences.
+    """
+    def __init__(self, directory):
+        """
+        :param directory: directory with the dataset files,
+            created if it does not exist
+        """
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(":memory:", timeout=LOCAL_LOCK_TIMEOUT,
+                                          check_same_thread=False)
+        self.lock = threading.RLock()
+        self.datasets = set()
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(LOCAL_EXTENSION):
+                self.create_dataset(file_name[:-len(LOCAL_EXTENSION)])
+
+    def close(self):
+        """ Close the database"""
+        self.connection.close()
+
+    def create_dataset(self, dataset_id):
+        """ Create a dataset, a sqlite file, if it do not exist."""
+        with self.lock:
+            if dataset_id not in self.datasets:
+                file_dataset = os.path.join(self.directory,
+                                            dataset_id + LOCAL_EXTENSION)
+                self.connection.execute("attach database ? as " + dataset_id,
+                                        (file_dataset,))
+                self.datasets.add(dataset_id)
+
+    def create_table(self, dataset_id, table_id, schema_list,
+                     partition_column=None, cluster_columns=None):
+        """
+        Create a table if it does not exist, form a schema.
+        Partition and cluster columns are an index of the table,
+        a day query do not read all the table.
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: Columns definitions separate by  "," character,
+            A column definition is NAME: TYPE
+        :param partition_column: date column, None not partitioned
+        :param cluster_columns: list of columns to cluster the table, None not clustered
+        :return:
+        """
+        columns = []
+        for column_def in schema_list.split(','):
+            column_name, column_type = column_def.split(':')
+            columns.append(column_name + " " + LOCAL_TYPES.get(column_type, "TEXT"))
+        self.create_dataset(dataset_id)
+        self.query("create table if not exists " + dataset_id + "." + table_id +
+                   " (" + ", ".join(columns) + ")")
+        self.add_columns(dataset_id, table_id, schema_list)
+        index_columns = ([partition_column] if partition_column is not None else []) + \
+                        (cluster_columns or [])
+        if len(index_columns) > 0:
+            self.query("create index if not exists " + dataset_id + "." + table_id +
+                       "_partition on " + table_id + " (" + ", ".join(index_columns) + ")")
+
+    def add_columns(self, dataset_id, table_id, schema_list):
+        """
+        Add the schema columns missing in a table, e.g. a column new in the
+        schema, null in the rows of the table. Other columns do not change.
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: Columns definitions separate by  "," character,
+            A column definition is NAME: TYPE
+        :return:
+        """
+        set_columns = set(self.get_column_types(dataset_id, table_id))
+        for column_def in schema_list.split(','):
+            column_name, column_type = column_def.split(':')
+            if column_name not in set_columns:
+                self.query("alter table " + dataset_id + "." + table_id + " add column " +
+                           column_name + " " + LOCAL_TYPES.get(column_type, "TEXT"))
+
+    def get_column_types(self, dataset_id, table_id):
+        """
+        :param dataset_id:
+        :param table_id:
+        :return: dictionary, column: big query type. Dates and times of
+            tables created with plain TEXT columns are STRING
+        """
+        self.create_dataset(dataset_id)
+        df = self.read_sql("pragma " + dataset_id + ".table_info(" + table_id + ")")
+        return {column_name: LOCAL_BIG_QUERY_TYPES.get(local_type.upper(), "STRING")
+                for column_name, local_type in zip(df["name"], df["type"])}
+
+    def delete_table(self, dataset_id, table_id):
+        """ Deleta a table"""
+        self.create_dataset(dataset_id)
+        self.query("drop table if exists " + dataset_id + "." + table_id)
+
+    def table_exists(self, dataset_id, table_id):
+        """ True if the table exists"""
+        self.create_dataset(dataset_id)
+        df = self.read_sql("select name from " + dataset_id + ".sqlite_master "
+                           "where type = 'table' and name = '" + table_id + "'")
+        return len(df) > 0
+
+    @staticmethod
+    def cast_sql(column_name, column_type):
+        """
+        :param column_name: text column, dates YYYY-MM-DD,
+            times HH:MM:SS or HH:MM
+        :param column_type: new type
+        :return: sql expression
+        """
+        if column_type == "TIME":
+            return "case when length(" + column_name + ") = 5 then " + \
+                   column_name + " || ':00' else " + column_name + " end"
+        return column_name
+
+    def write_df(self, df, dataset_id, table_id, schema_list=None, batch_id=None):
+        """
+        Append a dataframe to a table. With batch id, in a transaction with
+        the batch, only if the batch is not written.
+        :param df: dataframe to write
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: not used, sqlite dates and times are text
+        :param batch_id: None or id of the batch of the rows
+        :return:
+        """
+        if len(df) == 0:
+            return
+        with self.lock:
+            try:
+                if self.add_batch(dataset_id, table_id, batch_id):
+                    self.insert_df(df, dataset_id + "." + table_id)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def add_batch(self, dataset_id, table_id, batch_id):
+        """
+        Add a batch to the table of batches of a table, without commit
+        :param dataset_id:
+        :param table_id:
+        :param batch_id: None or id of the batch
+        :return: True if the batch has to be written, False if it was
+            written before. Without batch id, True
+        """
+        if batch_id is None:
+            return True
+        batch_table = dataset_id + "." + get_batch_table(table_id)
+        self.connection.execute("create table if not exists " + batch_table +
+                                " (Batch_Id TEXT primary key)")
+        cursor = self.connection.execute("insert or ignore into " + batch_table +
+                                         " (Batch_Id) values (?)", (batch_id,))
+        return cursor.rowcount == 1
+
+    def insert_df(self, df, table_name):
+        """
+        Insert dataframe rows in a table, without commit
+        :param df: dataframe
+        :param table_name: dataset.table
+        :return:
+        """
+        # Python types, sqlite does not know numpy types
+        rows = df.astype(object).where(df.notnull(), None).values.tolist()
+        sql = "insert into " + table_name + \
+              " (" + ", ".join(df.columns) + ") values (" + \
+              ", ".join(["?"] * len(df.columns)) + ")"
+        self.connection.executemany(sql, rows)
+
+    def load_files(self, lst_files, dataset_id, table_id, schema_list=None):
+        """
+        Append parquet files to a table, all the files in a transaction
+        :param lst_files: parquet files written with write_parquet
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: not used
+        :return:
+        """
+        with self.lock:
+            try:
+                for file_name in lst_files:
+                    self.insert_df(read_parquet(file_name), dataset_id + "." + table_id)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def replace_partition(self, df, dataset_id, table_id, schema_list,
+                          partition_column, date):
+        """
+        Replace the rows of a day with a dataframe, in a transaction
+        :param df: dataframe, all rows of the date
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: not used
+        :param partition_column: date column
+        :param date: day, YYYY-MM-DD
+        :return:
+        """
+        with self.lock:
+            try:
+                self.connection.execute("delete from " + dataset_id + "." + table_id +
+                                        " where " + partition_column + " = ?", (date,))
+                self.insert_df(df, dataset_id + "." + table_id)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def replace_partition_files(self, lst_files, dataset_id, table_id, schema_list,
+                                partition_column, date):
+        """
+        Replace the rows of a day with parquet files, in a transaction
+        :param lst_files: parquet files written with write_parquet, rows of the date
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: not used
+        :param partition_column: date column
+        :param date: day, YYYY-MM-DD
+        :return:
+        """
+        with self.lock:
+            try:
+                self.connection.execute("delete from " + dataset_id + "." + table_id +
+                                        " where " + partition_column + " = ?", (date,))
+                for file_name in lst_files:
+                    self.insert_df(read_parquet(file_name), dataset_id + "." + table_id)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def merge_df(self, df, dataset_id, table_id, schema_list, key_columns,
+                 update_sql, partition_column=None, batch_id=None):
+        """
+        Merge a dataframe in a table: rows with the same key are updated,
+        other rows inserted. In a transaction, with batch id only if the
+        batch is not merged.
+        The update sets every column with a correlated subquery on the
+        stage rows, not update from (sqlite 3.33), the environment has
+        sqlite 3.24. Only the partitions of the dataframe dates are read.
+        :param df: dataframe, only a row by key
+        :param dataset_id:
+        :param table_id:
+        :param schema_list: not used
+        :param key_columns: list of key columns
+        :param update_sql: dictionary, column: sql expression with t (table)
+            and s (dataframe) columns
+        :param partition_column: date column of the partitions
+        :param batch_id: None or id of the batch of the rows
+        :return:
+        """
+        columns = list(df.columns)
+        table_name = dataset_id + "." + table_id
+        dates = []
+        if partition_column is not None:
+            dates = [str(date) for date in df[partition_column].unique()]
+        condition = get_merge_condition(key_columns, partition_column, dates)
+        with self.lock:
+            try:
+                if not self.add_batch(dataset_id, table_id, batch_id):
+                    # Batch merged before
+                    self.connection.commit()
+                    return
+                self.connection.execute("create temp table merge_stage as "
+                                        "select " + ", ".join(columns) +
+                                        " from " + table_name + " where 0")
+                self.insert_df(df, "temp.merge_stage")
+                # The table is not t in the update, it is table_id
+                stage_sql = " from temp.merge_stage as s where " + \
+                    get_target_sql(condition, table_id)
+                self.connection.execute(
+                    "update " + table_name + " set " +
+                    ", ".join([column + " = (select " +
+                               get_target_sql(expression, table_id) + stage_sql + ")"
+                               for column, expression in update_sql.items()]) +
+                    " where " + (partition_column + " in ('" + "', '".join(dates) + "') and "
+                                 if partition_column is not None else "") +
+                    "exists (select 1" + stage_sql + ")")
+                self.connection.execute(
+                    "insert into " + table_name + " (" + ", ".join(columns) + ") "
+                    "select " + ", ".join(["s." + column for column in columns]) +
+                    " from temp.merge_stage as s where not exists (select 1 from " +
+                    table_name + " as t where " + condition + ")")
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                self.connection.execute("drop table if exists temp.merge_stage")
+
+    def read_sql(self, sql):
+        """
+        :param sql: select sentence
+        :return: Dataframe with the result
+        """
+        with self.lock:
+            return pd.read_sql_query(sql, self.connection)
+
+    def query(self, sql):
+        """
+        Run a sql sentence
+        :param sql:
+        :return:
+        """
+        with self.lock:
+            self.connection.execute(sql)
+            self.connection.commit()
+
+
+class TestLocalStorage(unittest.TestCase):
+    def test_parquet(self):
+        df_test = pd.DataFrame([[6, 2, "2018-01-01", "00:00:00", 1, 2, "", 6],
+                                [6, 2, "2018-01-02", "23:59:59", 6, 7, "", 6],
+                                [6, 2, "2018-13-02", "00:01:00", 6, 7, "", 6]],
+                               columns=bq.get_columns_from_list(bq.TABLE_AGGR_SCHEMA))
+        file_name = os.path.join(tempfile.mkdtemp(), "test.parquet")
+        write_parquet(df_test, file_name, bq.TABLE_AGGR_SCHEMA)
+        schema = pq.read_schema(file_name)
+        assert schema.field("Date").type == pa.date32()
+        assert schema.field("Time").type == pa.time64("us")
+        df_read = read_parquet(file_name)
+        assert df_read.iloc[:2].values.tolist() == df_test.iloc[:2].values.tolist()
+        # Not valid date
+        assert df_read["Date"].isnull().tolist() == [False, False, True]
+
+    def test_local_storage(self):
+        directory = tempfile.mkdtemp()
+        storage = LocalStorage(directory)
+        storage.create_dataset(bq.TEST_DATASET)
+        storage.create_table(bq.TEST_DATASET, bq.TABLE_AGGR, bq.TABLE_AGGR_SCHEMA,
+                             bq.TABLE_AGGR_PARTITION, bq.TABLE_AGGR_CLUSTER)
+        assert storage.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR)
+        df_test = pd.DataFrame([[6, 2, "2018-01-01", "00:00:00", 1, 2, "", 6],
+                                [6, 2, "2018-01-02", "00:01:00", 6, 7, "", 6]],
+                               columns=bq.get_columns_from_list(bq.TABLE_AGGR_SCHEMA))
+        storage.write_df(df_test, bq.TEST_DATASET, bq.TABLE_AGGR)
+        storage.close()
+        # Data is in the dataset file
+        storage = LocalStorage(directory)
+        df_read = storage.read_sql("select * from " + bq.TEST_DATASET + "." + bq.TABLE_AGGR +
+                                   " where Date = '2018-01-02'")
+        assert df_read.values.tolist() == df_test.iloc[1:].values.tolist()
+        # A column new in the schema is added to the table, null in the rows
+        storage.create_table(bq.TEST_DATASET, bq.TABLE_AGGR,
+                             bq.TABLE_AGGR_SCHEMA + ",Travel_Time_Count:INTEGER")
+        df_read = storage.read_sql("select * from " + bq.TEST_DATASET + "." + bq.TABLE_AGGR)
+        assert list(df_read.columns) == \
+            bq.get_columns_from_list(bq.TABLE_AGGR_SCHEMA) + ["Travel_Time_Count"]
+        assert df_read["Travel_Time_Count"].isnull().all() and len(df_read) == 2
+        storage.query("delete from " + bq.TEST_DATASET + "." + bq.TABLE_AGGR)
+        storage.delete_table(bq.TEST_DATASET, bq.TABLE_AGGR)
+        assert not storage.table_exists(bq.TEST_DATASET, bq.TABLE_AGGR)
+        storage.close()
@@ -1,68 +1,764 @@
 """
 Add car data, group data by date and time window (window size is 1 minute).
-In a time window, group by route
-Calculate IMH and Median travel time for all route
+In a time window, group by route, a route of a toll station
+(station, source, destination): stations loaded together do not mix.
+Calculate IMH, min travel time and a travel time sketch for all route
+A batch is binned into minute windows with vectorized operations and
+folded at once into accumulators by window and route (count, min
+travel time and a quantile sketch of the travel times, see sketch.py),
+raw car data is not stored, memory depends on the number of routes and
+travel time buckets, not on the traffic.
+Windows are indexed by minute in a heap: checking if windows are ready
+is O(1) and getting the oldest window O(log n).
+Windows got are merged in rollup windows of 5, 15 and 60 minutes
+(sum AHT, min travel time, merge of the sketches).
+Optionally routes are partitioned by hash between worker processes,
+each one with its own windows (window_init n_partition).
 Use:
     window_init .- Init data
     window_add_dataframe .- Add dataframes to data
     window_get_window_ready .- Get the oldest window data and remove
+    window_get_windows_ready .- Get all the ready windows data in a dataframe and remove
+    window_get_windows_closed .- Get the windows closed by the event time watermark and remove
+    window_get_rollups_ready .- Get the rollup windows data that can not change and remove
+    window_get_state, window_set_state .- Save and restore the windows
+    window_close_state .- Stop the worker processes of a window state
+    window_new_state .- New windows, e.g. a state by toll station
+Rows added, windows closed and open windows are counted in metrics.py.
+The bytes of the windows are measured (window_get_bytes), online windows
+are closed older first when they are more than a memory budget, see
+window_get_windows_closed max_bytes.
 """
 
 import big_query as bq
+import datetime
+import heapq
+import metrics
+import multiprocessing
+import normalize
+import numpy as np
 import pandas as pd
+import pickle
+import sketch
+import sys
 import unittest
 
-# Store data :Dictionari : keys date, time (hour and minute)
-# Value : List of car data: Columns: N_Orixen_X,N_Destino_X,N_Mensaxe_C,Travel_Time_Second
-window_data = {}
+# Columns from the car data used in a window
+WINDOW_COLUMNS = ["N_Station", "N_Source", "N_Destination", "Travel_Time_Second"]
+# Columns of the aggregate dataframes
+AGGR_COLUMNS = ["Source", "Destination", "AHT", "Travel_Time", "Date", "Time",
+                "Travel_Time_Sketch", "Station"]
+# Minutes of a window are counted from EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+# Position of the aggregates in an accumulator
+ACC_AHT = 0
+ACC_TRAVEL_TIME = 1
+ACC_SKETCH = 2
+# Rollup windows sizes in minutes
+ROLLUP_MINUTES = [5, 15, 60]
 
 
-def window_init():
-    """ Init data"""
-    global window_data
-    window_data = {}
+class Window:
+    """
+    Store aggregate car data by time window and route.
+    data: Dictionary: key minute (minutes from 1970-01-01)
+        Value : Dictionary: key route (station, source, destination)
+                Value: accumulator, list [AHT, Travel_Time, sketch]
+    minutes: heap with the minutes in data, the older is the first
+    newest: newest minute added (event time), None if no data added
+    closed: newest minute removed, None if no window removed
+    drop_late: if True, car data for a minute older than closed is discarded,
+        other case a new window is created to correct the window removed
+    n_late: number of cars discarded or added after its window was removed
+    window_bytes: Dictionary: key minute, value bytes of the window
+    n_bytes: bytes of all the windows
+    add .- Add a dataframe
+    pop_minutes .- Remove the older windows
+    pop_until .- Remove the windows until a minute
+    pop_older .- Get the aggregate info of the older windows and remove
+    set_data .- Replace the windows
+    get_bytes .- Bytes in memory
+    """
+    def __init__(self, drop_late=False):
+        self.data = {}
+        self.minutes = []
+        self.newest = None
+        self.closed = None
+        self.drop_late = drop_late
+        self.n_late = 0
+        self.window_bytes = {}
+        self.n_bytes = 0
 
+    def __len__(self):
+        return len(self.data)
 
-def window_add_dataframe(df):
-    """ Add data from a dataframe do window_data
+    def __setstate__(self, state):
+        """ Windows pickled without their bytes are measured, without sketches
+        get empty sketches, without station get LEGACY_STATION"""
+        self.__dict__.update(state)
+        changed = add_sketches(self.data)
+        changed = add_stations(self.data) or changed
+        if "window_bytes" not in state or changed:
+            self.set_data(self.data)
+
+    def set_data(self, data):
+        """
+        Replace the windows
+        :param data: Dictionary: key minute, value accumulators by route
+        :return:
+        """
+        add_sketches(data)
+        add_stations(data)
+        self.data = data
+        self.minutes = list(data.keys())
+        heapq.heapify(self.minutes)
+        self.window_bytes = {}
+        self.n_bytes = 0
+        self.measure(data.keys())
+
+    def measure(self, lst_minutes):
+        """
+        Measure again the bytes of windows changed
+        :param lst_minutes: minutes of the windows
+        :return:
+        """
+        for minute in lst_minutes:
+            n_bytes = get_routes_bytes(self.data[minute])
+            self.n_bytes += n_bytes - self.window_bytes.get(minute, 0)
+            self.window_bytes[minute] = n_bytes
+
+    def get_bytes(self):
+        """
+        :return: bytes in memory of the windows and their indexes
+        """
+        return self.n_bytes + sys.getsizeof(self.data) + sys.getsizeof(self.minutes) + \
+            sys.getsizeof(self.window_bytes)
+
+    def add(self, df):
+        """
+        Bin the dataframe in minute windows, aggregate by window and route
+        and merge with the window accumulators.
+        Remove seconds from T_Time, where time are store
+        Cars with a not valid date or time are discarded.
+        :param df: dataframe with car data, TABLE_RAW_SCHEMA columns
+        :return: list of minutes of the windows created
+        """
+        lst_new = []
+        if len(df) == 0:
+            return lst_new
+        set_changed = set()
+        codes, minutes = pd.factorize(df["D_Date"] + " " +
+                                      df["T_Time"].str.slice(0, 5))
+        # Only parse the distinct minutes of the batch
+        keys = get_minutes_from_strings(minutes)
+        df_aggr = aggregate_columns(codes,
+                                    *[df[column].values for column in WINDOW_COLUMNS])
+        for code, station, source, destination, aht, travel_time, travel_sketch in zip(
+                df_aggr["Window"].tolist(),
+                df_aggr["Station"].tolist(),
+                df_aggr["Source"].tolist(),
+                df_aggr["Destination"].tolist(),
+                df_aggr["AHT"].tolist(),
+                df_aggr["Travel_Time"].tolist(),
+                df_aggr["Sketch"].tolist()):
+            minute = keys[code]
+            if minute is None:
+                continue
+            if self.closed is not None and minute <= self.closed:
+                # Window already removed
+                self.n_late += aht
+                if self.drop_late:
+                    continue
+            if self.newest is None or minute > self.newest:
+                self.newest = minute
+            routes = self.data.get(minute)
+            if routes is None:
+                routes = self.data[minute] = {}
+                heapq.heappush(self.minutes, minute)
+                lst_new.append(minute)
+            acc = routes.get((station, source, destination))
+            if acc is None:
+                routes[(station, source, destination)] = [aht, travel_time, travel_sketch]
+            else:
+                accumulator_merge(acc, [aht, travel_time, travel_sketch])
+            set_changed.add(minute)
+        self.measure(set_changed)
+        return lst_new
+
+    def pop_minutes(self, n_window):
+        """
+        Remove the n_window older time windows from data.
+        :param n_window: number of windows to remove
+        :return: list of (minute, accumulators by route), older first
+        """
+        lst = []
+        for _ in range(min(n_window, len(self.data))):
+            lst.append(self.pop_oldest())
+        return lst
+
+    def pop_until(self, last_minute):
+        """
+        Remove the time windows older or equal than last_minute
+        :param last_minute: minutes from 1970-01-01
+        :return: list of (minute, accumulators by route), older first
+        """
+        lst = []
+        while len(self.minutes) > 0 and self.minutes[0] <= last_minute:
+            lst.append(self.pop_oldest())
+        return lst
+
+    def pop_oldest(self):
+        """
+        Remove the oldest window, there must be a window
+        :return: (minute, accumulators by route)
+        """
+        minute = heapq.heappop(self.minutes)
+        if self.closed is None or minute > self.closed:
+            self.closed = minute
+        self.n_bytes -= self.window_bytes.pop(minute)
+        return minute, self.data.pop(minute)
+
+    def pop_older(self, n_window):
+        """
+        Get the n_window older time windows and remove from data.
+        :param n_window: number of windows to get
+        :return:
+            None .- No window
+            Dataframe with data from the older time windows, ordered by
+                date, time, source and destination
+                Columns: AGGR_COLUMNS
+        """
+        return get_dataframe_from_minutes(self.pop_minutes(n_window))
+
+    def oldest(self):
+        """
+        :return: The older minute in data, None if there is not data
+        """
+        return self.minutes[0] if len(self.minutes) > 0 else None
+
+
+class PartitionedWindow:
+    """
+    Window with the routes partitioned by hash between worker processes,
+    every worker has its own Window with the data of its routes.
+    The minutes index (heap, newest and closed minute) is kept here, so
+    the windows got are the same than with a Window.
+    Same use than Window, close to stop the workers.
+    """
+    def __init__(self, n_partition, drop_late=False):
+        """
+        :param n_partition: number of worker processes
+        :param drop_late: discard car data for windows already removed
+        """
+        self.n_partition = n_partition
+        self.drop_late = drop_late
+        self.data = set()
+        self.minutes = []
+        self.newest = None
+        self.closed = None
+        self.n_late = 0
+        self.start()
+
+    def start(self):
+        """ Start the worker processes"""
+        self.connections = []
+        self.workers = []
+        for _ in range(self.n_partition):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=partition_worker,
+                                             args=(worker_connection,))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def close(self):
+        """ Stop the worker processes"""
+        for connection in self.connections:
+            connection.send(("stop",))
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, df):
+        """
+        Send the car data of every route to its worker
+        :param df: dataframe with car data, TABLE_RAW_SCHEMA columns
+        :return: list of minutes of the windows created
+        """
+        lst_new = []
+        if len(df) == 0:
+            return lst_new
+        df = df[["D_Date", "T_Time"] + WINDOW_COLUMNS]
+        partitions = get_route_partitions(df["N_Source"].values,
+                                          df["N_Destination"].values,
+                                          self.n_partition)
+        lst_sent = []
+        for partition, df_partition in df.groupby(partitions):
+            self.connections[partition].send(("add", df_partition,
+                                              self.closed, self.drop_late))
+            lst_sent.append(self.connections[partition])
+        for connection in lst_sent:
+            lst_minutes, n_late, newest = connection.recv()
+            self.n_late += n_late
+            if newest is not None and \
+                    (self.newest is None or newest > self.newest):
+                self.newest = newest
+            for minute in lst_minutes:
+                if minute not in self.data:
+                    self.data.add(minute)
+                    heapq.heappush(self.minutes, minute)
+                    lst_new.append(minute)
+        return sorted(lst_new)
+
+    def pop_minutes(self, n_window):
+        """
+        Remove the n_window older time windows.
+        :param n_window: number of windows to remove
+        :return: list of (minute, accumulators by route), older first
+        """
+        lst = []
+        for _ in range(min(n_window, len(self.data))):
+            lst.append(heapq.heappop(self.minutes))
+        return self.pop_workers(lst)
 
+    def pop_until(self, last_minute):
+        """
+        Remove the time windows older or equal than last_minute
+        :param last_minute: minutes from 1970-01-01
+        :return: list of (minute, accumulators by route), older first
+        """
+        lst = []
+        while len(self.minutes) > 0 and self.minutes[0] <= last_minute:
+            lst.append(heapq.heappop(self.minutes))
+        return self.pop_workers(lst)
+
+    def pop_workers(self, lst_minutes):
+        """
+        Remove the minutes from the workers and merge their routes
+        :param lst_minutes: minutes removed from the heap, ordered
+        :return: list of (minute, accumulators by route), older first
+        """
+        if len(lst_minutes) == 0:
+            return []
+        for minute in lst_minutes:
+            self.data.discard(minute)
+        if self.closed is None or lst_minutes[-1] > self.closed:
+            self.closed = lst_minutes[-1]
+        for connection in self.connections:
+            connection.send(("pop_until", lst_minutes[-1]))
+        merged = {minute: {} for minute in lst_minutes}
+        for connection in self.connections:
+            for minute, routes in connection.recv():
+                merged[minute].update(routes)
+        return [(minute, merged[minute]) for minute in lst_minutes]
+
+    def oldest(self):
+        """
+        :return: The older minute in data, None if there is not data
+        """
+        return self.minutes[0] if len(self.minutes) > 0 else None
+
+    def get_bytes(self):
+        """
+        :return: bytes in memory of the windows of the workers and the index
+        """
+        for connection in self.connections:
+            connection.send(("get_bytes",))
+        return sum(connection.recv() for connection in self.connections) + \
+            sys.getsizeof(self.data) + sys.getsizeof(self.minutes)
+
+    def __getstate__(self):
+        """ Pickle the windows of all workers, not the processes"""
+        data = {minute: {} for minute in self.data}
+        for connection in self.connections:
+            connection.send(("get_data",))
+        for connection in self.connections:
+            for minute, routes in connection.recv().items():
+                data[minute].update(routes)
+        return {"n_partition": self.n_partition,
+                "drop_late": self.drop_late,
+                "data": data,
+                "newest": self.newest,
+                "closed": self.closed,
+                "n_late": self.n_late}
+
+    def __setstate__(self, state):
+        """ Start the workers and send them the windows of their routes"""
+        self.__init__(state["n_partition"], drop_late=state["drop_late"])
+        self.newest = state["newest"]
+        self.closed = state["closed"]
+        self.n_late = state["n_late"]
+        lst_data = [{} for _ in range(self.n_partition)]
+        add_stations(state["data"])
+        for minute, routes in state["data"].items():
+            self.data.add(minute)
+            heapq.heappush(self.minutes, minute)
+            for route, acc in routes.items():
+                partition = get_route_partitions(route[1], route[2], self.n_partition)
+                lst_data[partition].setdefault(minute, {})[route] = acc
+        for connection, data in zip(self.connections, lst_data):
+            connection.send(("set_data", data))
+
+
+def get_route_partitions(source, destination, n_partition):
+    """
+    Hash partition of routes
+    :param source: path origin, a number or a numpy array, any integer
+        dtype (normalize.py downcasts the route columns)
+    :param destination: path destination, a number or a numpy array
+    :param n_partition: number of partitions
+    :return: partition of every route
     """
-    for date in df.D_Date.unique():
-        window_add_dataframe_date(date, df.loc[df["D_Date"] == date])
+    return (np.asarray(source, dtype=np.int64) * 1000003 + destination) % n_partition
 
 
-def window_add_dataframe_date(date, df):
+def partition_worker(connection):
     """
-    Add data from a a dataframe.
-    Dataframe has data only from a day
-    Remove seconds from T_Hora_C, where time are store
-    :param date: day
-    :param df:data
+    Worker process of a PartitionedWindow, a Window for its routes.
+    Commands received from the connection:
+        add .- Add car data, send new minutes, late cars and newest minute
+        pop_until .- Send the windows removed until a minute
+        get_data .- Send the windows
+        set_data .- Replace the windows
+        get_bytes .- Send the bytes of the windows
+        stop .- End the worker
+    :param connection: multiprocessing connection
     :return:
     """
-    def filter_time(row):
-        return row["T_Time"][:5]
-    df["T_Time"] = df.apply(filter_time, axis=1)
-    for time in df.T_Time.unique():
-        window_add_dataframe_time(date,
-                                  time,
-                                  df.loc[df["T_Time"] == time])
+    window_worker = Window()
+    while True:
+        command = connection.recv()
+        if command[0] == "add":
+            _, df, window_worker.closed, window_worker.drop_late = command
+            n_late = window_worker.n_late
+            lst_new = window_worker.add(df)
+            connection.send((lst_new,
+                             window_worker.n_late - n_late,
+                             window_worker.newest))
+        elif command[0] == "pop_until":
+            connection.send(window_worker.pop_until(command[1]))
+        elif command[0] == "get_data":
+            connection.send(window_worker.data)
+        elif command[0] == "set_data":
+            window_worker.set_data(command[1])
+        elif command[0] == "get_bytes":
+            connection.send(window_worker.get_bytes())
+        else:
+            break
+
+
+class Rollup:
+    """
+    Merge minute windows in windows of resolution minutes, using
+    the accumulators of the minute windows.
+    data: Dictionary: key first minute of the window
+        Value : Dictionary: key route (station, source, destination)
+                Value: accumulator, list [AHT, Travel_Time, sketch]
+    minutes: heap with the minutes in data, the older is the first
+    add .- Add minute windows
+    pop_closed .- Remove the windows closed
+    get_bytes .- Bytes in memory
+    """
+    def __init__(self, resolution):
+        """
+        :param resolution: window size in minutes
+        """
+        self.resolution = resolution
+        self.data = {}
+        self.minutes = []
+
+    def __setstate__(self, state):
+        """ Windows pickled without sketches get empty sketches, without
+        station get LEGACY_STATION"""
+        self.__dict__.update(state)
+        add_sketches(self.data)
+        add_stations(self.data)
+
+    def add(self, lst_minutes):
+        """
+        Add minute windows
+        :param lst_minutes: list of (minute, accumulators by route)
+        :return:
+        """
+        for minute, routes in lst_minutes:
+            first_minute = minute - minute % self.resolution
+            rollup_routes = self.data.get(first_minute)
+            if rollup_routes is None:
+                rollup_routes = self.data[first_minute] = {}
+                heapq.heappush(self.minutes, first_minute)
+            for route, acc in routes.items():
+                if route in rollup_routes:
+                    accumulator_merge(rollup_routes[route], acc)
+                else:
+                    rollup_routes[route] = accumulator_copy(acc)
 
+    def pop_closed(self, open_minute):
+        """
+        Remove the windows that can not get more minutes
+        :param open_minute: older minute still open, None if all
+            minutes are closed
+        :return: list of (first minute, accumulators by route), older first
+        """
+        lst = []
+        while len(self.minutes) > 0 and \
+                (open_minute is None or
+                 self.minutes[0] + self.resolution <= open_minute):
+            minute = heapq.heappop(self.minutes)
+            lst.append((minute, self.data.pop(minute)))
+        return lst
 
-def window_add_dataframe_time(date, time, df):
+    def get_bytes(self):
+        """
+        :return: bytes in memory of the windows, few windows, measured now
+        """
+        return sum(get_routes_bytes(routes) for routes in self.data.values()) + \
+            sys.getsizeof(self.data) + sys.getsizeof(self.minutes)
+
+
+def get_routes_bytes(routes):
+    """
+    :param routes: accumulators by route of a window
+    :return: bytes in memory of the window: dictionary, route tuples,
+        accumulator lists, their numbers and sketches (dictionary and counts)
     """
-    Add data from a dataframe
-    All data on the dataframe mush have the same date and the same time (in hour and minutes)
-    :param date: day
-    :param time: hour and minutes
-    :param df:data
+    return sys.getsizeof(routes) + \
+        sum(sys.getsizeof(route) + sys.getsizeof(acc) +
+            sys.getsizeof(acc[ACC_AHT]) + sys.getsizeof(acc[ACC_TRAVEL_TIME]) +
+            sketch.get_sketch_bytes(acc[ACC_SKETCH])
+            for route, acc in routes.items())
+
+
+def get_dataframe_from_minutes(lst_minutes):
+    """
+    :param lst_minutes: list of (minute, accumulators by route)
     :return:
+        None .- No window
+        Dataframe with the windows data, ordered by window,
+            station, source and destination
+            Columns: AGGR_COLUMNS
+    """
+    if len(lst_minutes) == 0:
+        return None
+    rows = []
+    for minute, routes in lst_minutes:
+        date, time = get_date_time_from_minute(minute)
+        for station, source, destination in sorted(routes.keys()):
+            acc = routes[(station, source, destination)]
+            rows.append((source, destination,
+                         acc[ACC_AHT], acc[ACC_TRAVEL_TIME],
+                         date, time, sketch.get_sketch_string(acc[ACC_SKETCH]),
+                         station))
+    return pd.DataFrame(rows, columns=AGGR_COLUMNS)
+
+
+def get_minutes_from_strings(minutes):
+    """
+    :param minutes: list of strings "YYYY-MM-DD HH:MM"
+    :return: list of minutes from 1970-01-01, None if the string is not valid
+    """
+    timestamps = pd.to_datetime(pd.Series(minutes), format="%Y-%m-%d %H:%M",
+                                errors="coerce")
+    return [None if pd.isnull(timestamp) else
+            get_minute_from_datetime(timestamp)
+            for timestamp in timestamps]
+
+
+def get_minute_from_datetime(timestamp):
+    """
+    :param timestamp: datetime
+    :return: minutes from 1970-01-01
+    """
+    return int((timestamp - EPOCH).total_seconds()) // 60
+
+
+def get_date_time_from_minute(minute):
+    """
+    :param minute: minutes from 1970-01-01
+    :return: date string YYYY-MM-DD, time string HH:MM
+    """
+    timestamp = EPOCH + datetime.timedelta(minutes=minute)
+    return timestamp.strftime("%Y-%m-%d"), timestamp.strftime("%H:%M")
+
+
+def accumulator_merge(acc, other):
+    """
+    Merge an accumulator into other in place
+        AHT .- Sum
+        Travel_Time .- Min, 0 is no travel time
+        Sketch .- Cars by travel time bucket are added
+    :param acc: accumulator to update
+    :param other: accumulator to merge
+    :return: acc
+    """
+    acc[ACC_AHT] += other[ACC_AHT]
+    if acc[ACC_TRAVEL_TIME] == 0 or \
+            0 < other[ACC_TRAVEL_TIME] < acc[ACC_TRAVEL_TIME]:
+        acc[ACC_TRAVEL_TIME] = other[ACC_TRAVEL_TIME]
+    sketch.merge_sketch(acc[ACC_SKETCH], other[ACC_SKETCH])
+    return acc
+
+
+def accumulator_copy(acc):
+    """
+    :param acc: accumulator
+    :return: a copy of the accumulator, the sketch is copied too
+    """
+    return [acc[ACC_AHT], acc[ACC_TRAVEL_TIME], dict(acc[ACC_SKETCH])]
+
+
+def add_sketches(data):
+    """
+    Add an empty sketch to the accumulators saved before the sketches,
+    e.g. a checkpoint of an older loader
+    :param data: Dictionary: key minute, value accumulators by route
+    :return: True if any accumulator is changed
+    """
+    changed = False
+    for routes in data.values():
+        for acc in routes.values():
+            if len(acc) <= ACC_SKETCH:
+                acc.append({})
+                changed = True
+    return changed
+
+
+def add_stations(data):
+    """
+    Add the station to the routes saved before the stations,
+    (source, destination), e.g. a checkpoint of an older loader.
+    Their station is big_query.LEGACY_STATION
+    :param data: Dictionary: key minute, value accumulators by route
+    :return: True if any route is changed
+    """
+    changed = False
+    for minute, routes in data.items():
+        if any(len(route) == 2 for route in routes):
+            data[minute] = {(route if len(route) == 3 else (bq.LEGACY_STATION,) + route): acc
+                            for route, acc in routes.items()}
+            changed = True
+    return changed
+
+
+def aggregate_columns(codes, station, source, destination, travel_time):
+    """
+    Calculate aggregate data for car data in columns, vectorized
+        IMH.- Average Hourly Traffic AHT
+        Travel_Time .- Min travel time greater than 0, 0 if there is not any
+        Sketch .- Cars with travel time by bucket, dictionary, see sketch.py
+    :param codes: window code of every car
+    :param station: toll station of every car
+    :param source: path origin of every car
+    :param destination: path destination of every car
+    :param travel_time: travel time in seconds of every car
+    :return: Dataframe ordered by window, station, source and destination
+            Columns: Window, Station, Source, Destination, AHT, Travel_Time, Sketch
+    """
+    df = pd.DataFrame({"Window": codes,
+                       "Station": station,
+                       "Source": source,
+                       "Destination": destination,
+                       # Cars without travel time do not count for the min
+                       "Travel_Time": np.where(travel_time > 0,
+                                               travel_time,
+                                               np.nan)})
+    df_group = df.groupby(["Window", "Station", "Source", "Destination"])
+    df_aggr = df_group["Travel_Time"].\
+        agg(["size", "min"]).\
+        rename(columns={"size": "AHT", "min": "Travel_Time"}).\
+        reset_index()
+    df_aggr["AHT"] = df_aggr["AHT"].astype(int)
+    df_aggr["Travel_Time"] = df_aggr["Travel_Time"].fillna(0).astype(int)
+    # Sketches, cars by group (row of df_aggr) and travel time bucket,
+    # counted with a key group * SKETCH_BUCKETS + bucket
+    valid = travel_time > 0
+    keys, cars = np.unique(df_group.ngroup().values[valid] * sketch.SKETCH_BUCKETS +
+                           sketch.get_buckets(travel_time[valid]), return_counts=True)
+    sketches = [{} for _ in range(len(df_aggr))]
+    for key, n_cars in zip(keys.tolist(), cars.tolist()):
+        sketches[key // sketch.SKETCH_BUCKETS][key % sketch.SKETCH_BUCKETS] = n_cars
+    df_aggr["Sketch"] = sketches
+    return df_aggr
+
+
+# Store data
+window_data = Window()
+# Rollup windows by resolution
+window_rollups = {resolution: Rollup(resolution)
+                  for resolution in ROLLUP_MINUTES}
+
+
+def window_init(drop_late=False, n_partition=0):
+    """
+    Init data
+    :param drop_late: discard car data for windows already got
+    :param n_partition: if more than 1, routes are partitioned between
+        n_partition worker processes
+    """
+    window_set_state(window_new_state(drop_late, n_partition))
+
+
+def window_new_state(drop_late=False, n_partition=0):
     """
-    if date not in window_data:
-        window_data[date] = {}
-    if time not in window_data[date]:
-        window_data[date][time] = pd.DataFrame()
-    window_data[date][time] = window_data[date][time].append(df)
+    New empty windows, the windows in use do not change
+    :param drop_late: discard car data for windows already got
+    :param n_partition: if more than 1, routes are partitioned between
+        n_partition worker processes
+    :return: window state, see window_get_state
+    """
+    if n_partition > 1:
+        data = PartitionedWindow(n_partition, drop_late=drop_late)
+    else:
+        data = Window(drop_late=drop_late)
+    return {"window_data": data,
+            "window_rollups": {resolution: Rollup(resolution)
+                               for resolution in ROLLUP_MINUTES}}
+
+
+def window_get_state():
+    """
+    :return: window state (window_data and rollup windows), it can be pickled
+    """
+    return {"window_data": window_data, "window_rollups": window_rollups}
+
+
+def window_set_state(state, close=True):
+    """
+    Restore a window state got with window_get_state.
+    The worker processes of the windows in use are stopped, e.g. a state
+    restored from a checkpoint starts its own workers.
+    :param state:
+    :param close: False to keep the windows in use, e.g. the state of
+        other toll station
+    """
+    global window_data, window_rollups
+    if close and window_data is not state["window_data"]:
+        window_close_state(window_get_state())
+    window_data = state["window_data"]
+    window_rollups = state["window_rollups"]
+
+
+def window_close_state(state):
+    """
+    Stop the worker processes of a window state, if it has
+    :param state: window state, see window_get_state
+    """
+    if isinstance(state["window_data"], PartitionedWindow):
+        state["window_data"].close()
+
+
+def window_add_dataframe(df):
+    """ Add data from a dataframe do window_data
+
+    """
+    with metrics.timer("stage_seconds", stage="window"):
+        window_data.add(df)
+    metrics.count("rows_window", len(df))
+    metrics.set_gauge("open_windows", len(window_data))
 
 
 def window_is_window_ready(max_window):
@@ -71,39 +767,36 @@ def window_is_window_ready(max_window):
     :param max_window:
     :return: true .- there is more than max_window windows
     """
-    n_window = 0
-    for data in window_data:
-        n_window += len(window_data[data])
-    return n_window > max_window
+    return len(window_data) > max_window
+
+
+def window_pop_minutes(n_window):
+    """
+    Remove the n_window older windows from window_data
+    and add them to the rollup windows.
+    :param n_window:
+    :return: list of (minute, accumulators by route)
+    """
+    lst_minutes = window_data.pop_minutes(n_window)
+    for rollup in window_rollups.values():
+        rollup.add(lst_minutes)
+    metrics.count("windows_closed", len(lst_minutes))
+    metrics.set_gauge("open_windows", len(window_data))
+    return lst_minutes
 
 
 def window_get_older():
     """
     Get the older time window and remove from window_data.
-    If the date of the older window do not have more time,
-     date from window_data
     Calculate aggredate data from windows car:
         IMH.- Average Hourly Traffic AHT
         Travel_Time
     :return:
         None .- No window
         Dataframe with data from the older time windown
-            Columns; Date,Time,N_Orixen,N_Destino,Travel_Time,IMH
+            Columns; Source,Destination,AHT,Travel_Time,Date,Time,Travel_Time_Sketch,Station
     """
-    if len(window_data) == 0:
-        return None
-    date = sorted(window_data.keys())[0]
-    if len(window_data[date]) == 0:
-        window_data.pop(date, None)
-        return None
-    time = sorted(window_data[date].keys())[0]
-    df = window_get_aggr(window_data[date][time])
-    df["Date"] = date
-    df["Time"] = time
-    window_data[date].pop(time, None)
-    if len(window_data[date]) == 0:
-        window_data.pop(date, None)
-    return df
+    return get_dataframe_from_minutes(window_pop_minutes(1))
 
 
 def window_get_window_ready(max_window):
@@ -112,7 +805,7 @@ def window_get_window_ready(max_window):
     :return:
         None .- No more than max_window available
         Dataframe with data from the older time windown
-            Columns; Date,Time,N_Orixen,N_Destino,Travel_Time,IMH
+            Columns; Source,Destination,AHT,Travel_Time,Date,Time,Travel_Time_Sketch,Station
     """
     if window_is_window_ready(max_window):
         return window_get_older()
@@ -120,45 +813,132 @@ def window_get_window_ready(max_window):
         return None
 
 
+def window_get_windows_ready(max_window):
+    """
+    Get all the windows but the max_window newer in a dataframe,
+    and remove from window_data
+    :param max_window: windows to keep for future data
+    :return:
+        None .- No more than max_window available
+        Dataframe with data from the older time windows
+            Columns; Source,Destination,AHT,Travel_Time,Date,Time,Travel_Time_Sketch,Station
+    """
+    if window_is_window_ready(max_window):
+        return get_dataframe_from_minutes(
+            window_pop_minutes(len(window_data) - max_window))
+    else:
+        return None
+
+
+def window_get_watermark(now=None):
+    """
+    Event time watermark: newest minute added, or the minute of now
+    if it is newer.
+    :param now: datetime, wall clock. None to use only event time.
+    :return: minutes from 1970-01-01, None if there is not watermark
+    """
+    watermark = window_data.newest
+    if now is not None:
+        now_minute = get_minute_from_datetime(now)
+        if watermark is None or now_minute > watermark:
+            watermark = now_minute
+    return watermark
+
+
+def window_get_bytes():
+    """
+    :return: bytes in memory of window_data and the rollup windows
+    """
+    return window_data.get_bytes() + \
+        sum(rollup.get_bytes() for rollup in window_rollups.values())
+
+
+def window_get_windows_closed(allowed_lateness, now=None, max_window=None,
+                              max_bytes=None):
+    """
+    Get the windows closed by the watermark in a dataframe
+    and remove from window_data.
+    A window is closed when it is allowed_lateness minutes older than the
+    watermark minute. If there are more than max_window windows open,
+    the oldest ones are closed too. If the windows are more than max_bytes
+    in memory, the oldest ones are closed until they are not (e.g. a burst
+    of old rows), late data of them is a correction, see window_pop_bytes.
+    :param allowed_lateness: minutes to wait for late data
+    :param now: datetime, wall clock. None to use only event time.
+    :param max_window: max number of windows open, None for no limit
+    :param max_bytes: memory budget of window_data, None for no limit
+    :return:
+        None .- No window closed
+        Dataframe with data from the closed time windows
+            Columns; Source,Destination,AHT,Travel_Time,Date,Time,Travel_Time_Sketch,Station
+    """
+    lst_minutes = []
+    watermark = window_get_watermark(now)
+    if watermark is not None:
+        lst_minutes = window_data.pop_until(watermark - allowed_lateness - 1)
+    if max_window is not None and len(window_data) > max_window:
+        lst_minutes += window_data.pop_minutes(len(window_data) - max_window)
+    for rollup in window_rollups.values():
+        rollup.add(lst_minutes)
+    if max_bytes is not None:
+        lst_minutes += window_pop_bytes(max_bytes)
+    metrics.count("windows_closed", len(lst_minutes))
+    metrics.set_gauge("open_windows", len(window_data))
+    return get_dataframe_from_minutes(lst_minutes)
+
+
+def window_pop_bytes(max_bytes):
+    """
+    Remove the oldest windows of window_data, and add them to the rollup
+    windows, until window_data is not more than max_bytes. Rollup windows
+    are not in the budget, they are few and got with the windows closed.
+    :param max_bytes: memory budget of window_data
+    :return: list of (minute, accumulators by route), older first
+    """
+    lst_minutes = []
+    n_bytes = window_data.get_bytes()
+    while n_bytes > max_bytes and len(window_data) > 0:
+        # Windows to remove, by the mean bytes of a window
+        n_window = max(1, int((n_bytes - max_bytes) * len(window_data) / n_bytes))
+        lst_pop = window_data.pop_minutes(n_window)
+        for rollup in window_rollups.values():
+            rollup.add(lst_pop)
+        lst_minutes += lst_pop
+        n_bytes = window_data.get_bytes()
+    metrics.set_gauge("window_bytes", n_bytes)
+    if len(lst_minutes) > 0:
+        metrics.count("windows_forced", len(lst_minutes))
+    return lst_minutes
+
+
+def window_get_rollups_ready():
+    """
+    Get the rollup windows with all their minutes out of window_data,
+    and remove them. If window_data is empty all rollup windows are got.
+    :return: Dictionary key: resolution in minutes
+        Value: None .- No window closed
+               Dataframe with data of the rollup windows, Time is the first minute
+                    Columns; Source,Destination,AHT,Travel_Time,Date,Time,Travel_Time_Sketch,Station
+    """
+    open_minute = window_data.oldest()
+    return {resolution: get_dataframe_from_minutes(rollup.pop_closed(open_minute))
+            for resolution, rollup in window_rollups.items()}
+
+
 def window_get_aggr(df):
     """
     Calculate aggregate data for a window dataframe
         IMH.- Average Hourly Traffic AHT
         Travel_Time
+        Sketch
     :param df: Dataframe with data from the same date and time
     :return:
             Dataframe with data calculate from df
-            Columns; Date,Time,N_Orixen,N_Destino,Travel_Time,IMH
-    """
-
-    # Count car by path, with a column IMH
-    serie_aggr_imh = df.\
-        groupby(["N_Source", "N_Destination"])["N_Message"].count()
-    df_aggr_imh = serie_aggr_imh.to_frame().rename(
-        columns={"N_Message": "AHT", "N_Source" : "Source"})
-
-    # Get min time travel by path
-    serie_aggr_travel_time = df[df["Travel_Time_Second"] > 0].\
-        groupby(["N_Source", "N_Destination"])["Travel_Time_Second"].min()
-    df_aggr_travel_time = pd.DataFrame(serie_aggr_travel_time).rename(
-        columns={"Travel_Time_Second": "Travel_Time"})
-
-    # Source and destination are index, transform to column
-    df_aggr_imh = df_aggr_imh.reset_index(
-                    level=["N_Source", "N_Destination"])
-    df_aggr_travel_time = df_aggr_travel_time.reset_index(
-                    level=["N_Source", "N_Destination"])
-
-    # Merge both dataframe an rename columns
-    df_aggr = pd.merge(df_aggr_imh, df_aggr_travel_time, how='left',
-                       left_on=["N_Source", "N_Destination"],
-                       right_on=["N_Source", "N_Destination"])
-    df_aggr = pd.DataFrame(df_aggr).rename(
-            columns={"N_Source" : "Source", "N_Destination" : "Destination"})
-
-    df_aggr = df_aggr.fillna(0)
-    df_aggr[["Travel_Time"]] = df_aggr[["Travel_Time"]].astype(int)
-    return df_aggr
+            Columns; Station,Source,Destination,AHT,Travel_Time,Sketch
+    """
+    df_aggr = aggregate_columns(np.zeros(len(df), dtype=int),
+                                *[df[column].values for column in WINDOW_COLUMNS])
+    return df_aggr.drop(columns="Window")
 
 
 class TestWindow(unittest.TestCase):
@@ -176,6 +956,7 @@ class TestWindow(unittest.TestCase):
             return pd.DataFrame(lst,
                                 columns=columns_name)
 
+        window_init()
         df_test = window_create_df_test(bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
         window_add_dataframe(df_test)
         df_aggr = window_get_window_ready(1)
@@ -202,3 +983,292 @@ class TestWindow(unittest.TestCase):
         assert len(df_aggr) == 1
         assert df_aggr["AHT"][0] == 2
         assert df_aggr["Travel_Time"][0] == 0
+
+    def test_windows_ready(self):
+        def window_create_df_test(columns_name):
+            lst = [[0, 6, 2, "2018-01-02", "00:00:10", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 14],
+                   [1, 6, 2, "2018-01-02", "00:01:20", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0],
+                   [2, 6, 2, "2018-01-02", "00:00:30", "55555", 6, 1, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 10],
+                   [3, 6, 2, "2018-01-02", "00:00:40", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 12],
+                   [4, 6, 2, "2018-01-02", "00:02:50", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0]
+                   ]
+            return pd.DataFrame(lst,
+                                columns=columns_name)
+
+        window_init()
+        df_test = window_create_df_test(bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        # Add in two batches, the first minute is in both
+        window_add_dataframe(df_test.iloc[:2])
+        window_add_dataframe(df_test.iloc[2:])
+        df_aggr = window_get_windows_ready(1)
+        assert list(df_aggr.columns) == AGGR_COLUMNS
+        assert list(df_aggr["Time"]) == ["00:00", "00:00", "00:01"]
+        assert list(df_aggr["Destination"]) == [1, 7, 7]
+        assert list(df_aggr["AHT"]) == [1, 2, 1]
+        assert list(df_aggr["Travel_Time"]) == [10, 12, 0]
+        # Two cars with travel time in the sketch of route 6-7, none in 00:01
+        assert [sum(sketch.get_sketch_from_string(text).values())
+                for text in df_aggr["Travel_Time_Sketch"]] == [1, 2, 0]
+        assert df_aggr["Travel_Time_Sketch"].tolist()[2] == ""
+        assert window_get_windows_ready(1) is None
+
+        df_aggr = window_get_aggr(df_test)
+        assert list(df_aggr["AHT"]) == [1, 4]
+        assert list(df_aggr["Travel_Time"]) == [10, 12]
+
+    def test_accumulator_merge(self):
+        assert accumulator_merge([1, 0, {}], [2, 30, {1: 2}]) == [3, 30, {1: 2}]
+        assert accumulator_merge([1, 20, {0: 1}], [2, 0, {}]) == [3, 20, {0: 1}]
+        assert accumulator_merge([1, 20, {0: 1}], [2, 10, {0: 1, 3: 1}]) == [3, 10, {0: 2, 3: 1}]
+        assert accumulator_merge([1, 20, {}], [2, 30, {}]) == [3, 20, {}]
+        acc = [1, 20, {0: 1}]
+        accumulator_merge(accumulator_copy(acc), [1, 10, {0: 1}])
+        assert acc == [1, 20, {0: 1}]
+
+    def test_window_order(self):
+        lst = [[0, 6, 2, "2018-01-02", "00:05:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0],
+               [1, 6, 2, "2018-01-01", "23:59:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0],
+               [2, 6, 2, "0000-00-00", "00:00:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0]
+               ]
+        df_test = pd.DataFrame(lst, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        window_init()
+        window_add_dataframe(df_test.iloc[:1])
+        # Late data, older than the data in the window
+        window_add_dataframe(df_test.iloc[1:])
+        # Not valid date is discarded
+        assert window_is_window_ready(1)
+        assert not window_is_window_ready(2)
+        df_aggr = window_get_window_ready(0)
+        assert list(df_aggr["Date"]) == ["2018-01-01"]
+        assert list(df_aggr["Time"]) == ["23:59"]
+        df_aggr = window_get_window_ready(0)
+        assert list(df_aggr["Time"]) == ["00:05"]
+        assert window_get_window_ready(0) is None
+
+    def test_rollups(self):
+        lst = [[0, 6, 2, "2018-01-02", "00:03:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 20],
+               [1, 6, 2, "2018-01-02", "00:04:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0],
+               [2, 6, 2, "2018-01-02", "00:05:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 10],
+               [3, 6, 2, "2018-01-02", "00:16:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 30]
+               ]
+        df_test = pd.DataFrame(lst, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        window_init()
+        window_add_dataframe(df_test)
+        window_get_windows_ready(1)
+        dict_rollups = window_get_rollups_ready()
+        # 00:16 is open, 5 minutes windows 00:00 and 00:05 are closed
+        assert list(dict_rollups[5]["Time"]) == ["00:00", "00:05"]
+        assert list(dict_rollups[5]["AHT"]) == [2, 1]
+        assert list(dict_rollups[5]["Travel_Time"]) == [20, 10]
+        assert list(dict_rollups[15]["Time"]) == ["00:00"]
+        assert list(dict_rollups[15]["AHT"]) == [3]
+        assert list(dict_rollups[15]["Travel_Time"]) == [10]
+        assert dict_rollups[60] is None
+        window_get_windows_ready(0)
+        # window_data is empty, all rollup windows are closed
+        dict_rollups = window_get_rollups_ready()
+        assert list(dict_rollups[5]["Time"]) == ["00:15"]
+        assert list(dict_rollups[15]["Time"]) == ["00:15"]
+        assert list(dict_rollups[60]["AHT"]) == [4]
+        assert list(dict_rollups[60]["Travel_Time"]) == [10]
+        # The rollup sketch is the merge of the minute sketches
+        travel_sketch = sketch.get_sketch_from_string(dict_rollups[60]["Travel_Time_Sketch"][0])
+        assert travel_sketch == sketch.get_sketch(np.array([20, 10, 30]))
+        assert sketch.get_quantiles(travel_sketch, [1]) == [31]
+
+    def test_watermark(self):
+        lst = [[0, 6, 2, "2018-01-02", "00:00:10", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 20],
+               [1, 6, 2, "2018-01-02", "00:01:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0],
+               [2, 6, 2, "2018-01-02", "00:03:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 10],
+               [3, 6, 2, "2018-01-02", "00:00:50", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 5]
+               ]
+        df_test = pd.DataFrame(lst, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        window_init()
+        window_add_dataframe(df_test.iloc[:3])
+        # Watermark 00:03, with 1 minute of lateness 00:00 and 00:01 are closed
+        df_aggr = window_get_windows_closed(1)
+        assert list(df_aggr["Time"]) == ["00:00", "00:01"]
+        assert window_get_windows_closed(1) is None
+        # Late data, the window is created again as a correction
+        window_add_dataframe(df_test.iloc[3:])
+        df_aggr = window_get_windows_closed(1)
+        assert list(df_aggr["Time"]) == ["00:00"]
+        assert list(df_aggr["Travel_Time"]) == [5]
+        assert window_data.n_late == 1
+        # Wall clock closes the windows without new data
+        df_aggr = window_get_windows_closed(1, now=datetime.datetime(2018, 1, 2, 0, 5, 30))
+        assert list(df_aggr["Time"]) == ["00:03"]
+
+        window_init(drop_late=True)
+        window_add_dataframe(df_test.iloc[:3])
+        # Only 1 window open
+        df_aggr = window_get_windows_closed(5, max_window=1)
+        assert list(df_aggr["Time"]) == ["00:00", "00:01"]
+        window_add_dataframe(df_test.iloc[3:])
+        assert len(window_data) == 1
+        assert window_data.n_late == 1
+
+    def test_state(self):
+        lst = [[0, 6, 2, "2018-01-02", "00:00:10", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 20],
+               [1, 6, 2, "2018-01-02", "00:01:00", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0]
+               ]
+        df_test = pd.DataFrame(lst, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        window_init()
+        window_add_dataframe(df_test)
+        window_get_window_ready(1)
+        state = pickle.loads(pickle.dumps(window_get_state()))
+        window_init()
+        window_set_state(state)
+        assert window_data.closed == window_data.oldest() - 1
+        df_aggr = window_get_windows_ready(0)
+        assert list(df_aggr["Time"]) == ["00:01"]
+        assert list(window_get_rollups_ready()[5]["AHT"]) == [2]
+        # Windows saved before the sketches
+        window_add_dataframe(df_test)
+        window_get_window_ready(1)
+        state = window_get_state()
+        for routes in list(state["window_data"].data.values()) + \
+                list(state["window_rollups"][60].data.values()):
+            for acc in routes.values():
+                del acc[ACC_SKETCH]
+        window_set_state(pickle.loads(pickle.dumps(state)))
+        window_add_dataframe(df_test)
+        df_aggr = window_get_windows_ready(0)
+        assert df_aggr["AHT"].tolist() == [1, 2]
+        assert df_aggr["Travel_Time_Sketch"].tolist() == ["0:1", ""]
+        df_rollup = window_get_rollups_ready()[60]
+        assert df_rollup["AHT"].tolist() == [4]
+        assert df_rollup["Travel_Time_Sketch"].tolist() == ["0:1"]
+
+    def test_memory_budget(self):
+        lst = [[n, 6, 2, "2018-01-02", "{:02d}:{:02d}:00".format(n // 60, n % 60), "55555",
+                6 + n % 3, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, n * 10]
+               for n in range(100)]
+        df_test = pd.DataFrame(lst, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        window_init()
+        empty_bytes = window_data.get_bytes()
+        window_add_dataframe(df_test)
+        window_add_dataframe(df_test.iloc[:10])
+        # Bytes measured when windows change are the bytes of the windows now
+        assert window_data.n_bytes == sum(get_routes_bytes(routes)
+                                          for routes in window_data.data.values())
+        full_bytes = window_data.get_bytes()
+        assert full_bytes > empty_bytes + 100 * 200
+        assert window_get_bytes() > full_bytes
+        # Watermark do not close windows, the budget closes the oldest ones
+        max_bytes = full_bytes - (full_bytes - empty_bytes) // 2
+        df_aggr = window_get_windows_closed(1000, max_bytes=max_bytes)
+        assert window_data.get_bytes() <= max_bytes
+        assert df_aggr["Time"].tolist() == ["{:02d}:{:02d}".format(n // 60, n % 60)
+                                            for n in range(len(df_aggr))]
+        assert 40 < len(df_aggr) < 100 and df_aggr["AHT"].tolist()[:10] == [2] * 10
+        # Pickled windows keep their bytes, late data is a correction
+        state = pickle.loads(pickle.dumps(window_get_state()))
+        del state["window_data"].__dict__["window_bytes"]
+        state["window_data"].__setstate__(state["window_data"].__dict__)
+        window_set_state(state)
+        assert window_data.n_bytes == sum(get_routes_bytes(routes)
+                                          for routes in window_data.data.values())
+        window_add_dataframe(df_test.iloc[:1])
+        assert window_data.n_late == 1
+        assert get_date_time_from_minute(window_data.oldest()) == ("2018-01-02", "00:00")
+        window_init()
+
+    def test_stations(self):
+        # Two stations, same minute and route, a row by station
+        lst = [[0, 6, 2, "2018-01-02", "00:00:10", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 20],
+               [1, 7, 2, "2018-01-02", "00:00:20", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 30],
+               [2, 7, 2, "2018-01-02", "00:00:30", "55555", 6, 7, 8, 9, 10, 8, "2018-01-02", "01:00:00", 13, 0]
+               ]
+        df_test = pd.DataFrame(lst, columns=bq.get_columns_from_list(bq.TABLE_RAW_SCHEMA))
+        window_init()
+        window_add_dataframe(df_test)
+        df_aggr = window_get_windows_ready(0)
+        assert df_aggr[["Station", "Source", "AHT", "Travel_Time"]].values.tolist() == \
+            [[6, 6, 1, 20], [7, 6, 2, 30]]
+        assert window_get_rollups_ready()[5]["Station"].tolist() == [6, 7]
+        # Windows saved before the stations, routes (source, destination)
+        minute = get_minutes_from_strings(["2018-01-02 00:00"])[0]
+        for window_class, n_partition in [(Window, {}), (PartitionedWindow, {"n_partition": 2})]:
+            # As unpickled
+            data = window_class.__new__(window_class)
+            data.__setstate__(dict({"data": {minute: {(6, 7): [2, 20]}}, "minutes": [minute],
+                                    "newest": minute, "closed": None, "drop_late": False,
+                                    "n_late": 0}, **n_partition))
+            window_set_state({"window_data": data,
+                              "window_rollups": {resolution: Rollup(resolution)
+                                                 for resolution in ROLLUP_MINUTES}})
+            df_aggr = window_get_windows_ready(0)
+            assert df_aggr[["Station", "Source", "Destination", "AHT"]].values.tolist() == \
+                [[bq.LEGACY_STATION, 6, 7, 2]]
+        window_init()
+
+    def test_sketch_budget(self):
+        # Same cars and routes, without and with travel times
+        df_test = pd.DataFrame({
+            "N_Station": 6,
+            "N_Source": np.arange(3000) % 3 + 6,
+            "N_Destination": 1,
+            "D_Date": "2018-01-02",
+            "T_Time": ["00:{:02d}:00".format(minute % 20) for minute in range(3000)],
+            "Travel_Time_Second": 0})
+        df_travel = df_test.assign(Travel_Time_Second=np.arange(3000) * 7 % 20000 + 30)
+        for n_partition in [0, 2]:
+            window_init(n_partition=n_partition)
+            window_add_dataframe(df_test)
+            max_bytes = window_data.get_bytes() + 1000
+            assert window_get_windows_closed(1000, max_bytes=max_bytes) is None
+            # Sketches of many buckets, the windows are over the budget
+            window_add_dataframe(df_travel)
+            assert window_data.get_bytes() > max_bytes + 20 * 3 * 1000
+            df_aggr = window_get_windows_closed(1000, max_bytes=max_bytes)
+            assert window_data.get_bytes() <= max_bytes
+            assert 0 < len(df_aggr) < 60 and df_aggr["Time"].tolist()[0] == "00:00"
+            if n_partition == 0:
+                assert window_data.n_bytes == sum(get_routes_bytes(routes)
+                                                  for routes in window_data.data.values())
+        window_init()
+
+    def test_partitioned_window(self):
+        # Two stations, with the same routes
+        df_test = pd.DataFrame({
+            "N_Station": np.arange(200) % 2 + 6,
+            "N_Source": np.arange(200) % 7,
+            "N_Destination": np.arange(200) % 3,
+            "D_Date": "2018-01-02",
+            "T_Time": ["00:{:02d}:00".format(minute % 13) for minute in range(200)],
+            "Travel_Time_Second": np.arange(200) % 11})
+        window_init()
+        window_add_dataframe(df_test.iloc[:150])
+        df_aggr = window_get_windows_closed(2)
+        window_add_dataframe(df_test.iloc[150:])
+        df_aggr = pd.concat([df_aggr, window_get_windows_ready(0)])
+        n_late = window_data.n_late
+        window_init(n_partition=3)
+        window_add_dataframe(df_test.iloc[:150])
+        df_aggr_partitioned = window_get_windows_closed(2)
+        # Save and restore the workers windows, the old workers are stopped
+        window_partitioned = window_data
+        window_set_state(pickle.loads(pickle.dumps(window_get_state())))
+        assert window_partitioned.workers == [] and len(window_data.workers) == 3
+        window_add_dataframe(df_test.iloc[150:])
+        df_aggr_partitioned = pd.concat([df_aggr_partitioned, window_get_windows_ready(0)])
+        assert window_data.n_late == n_late
+        window_init()
+        assert df_aggr.reset_index(drop=True).equals(df_aggr_partitioned.reset_index(drop=True))
+
+    def test_partitioned_normalized(self):
+        # Rows of mysql, route columns are downcast to int8 by normalize
+        lst = [(0, 6, 2, datetime.date(2018, 1, 2), datetime.timedelta(minutes=minute % 5),
+                "55555", 6 + minute % 9, 1 + minute % 5, 8, 0, 5, 8, None,
+                datetime.timedelta(0), 13) for minute in range(100)]
+        df_test = normalize.normalize_mysql(pd.DataFrame(lst))
+        assert df_test["N_Source"].dtype == np.int8
+        window_init()
+        window_add_dataframe(df_test)
+        df_aggr = window_get_windows_ready(0)
+        window_init(n_partition=2)
+        window_add_dataframe(df_test)
+        df_aggr_partitioned = window_get_windows_ready(0)
+        window_init()
+        assert df_aggr.equals(df_aggr_partitioned) and df_aggr["AHT"].sum() == 100
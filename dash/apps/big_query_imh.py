@@ -1,7 +1,11 @@
 """
 Read data from bigquery, and create window rolling info
+If STORAGE_DIR environment variable is set, data is read from the local
+storage of big_query/storage.py in that directory, not from bigquery.
 """
 from pandas_gbq import read_gbq
+import os
+import sys
 import pandas as pd
 from datetime import datetime, timedelta
 
@@ -9,6 +13,13 @@ from datetime import datetime, timedelta
 PROJECT_ID = "audasa-154511"
 DATASET = "toll_data"
 TABLE_AGGR = "aggr"
+# Environment variable with the local storage directory
+STORAGE_DIR = "STORAGE_DIR"
+# Directory of big_query modules, the local storage
+BIG_QUERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "big_query")
+# Local storage, opened at the first read
+local_storage = None
 # Window rolling time in minutes
 WINDOW_ROLLING_IMH = 10
 WINDOW_ROLLING_TIME = 5
@@ -16,6 +27,32 @@ WINDOW_ROLLING_TIME = 5
 index = [x.time() for x in pd.date_range("00:11", "23:59", freq="min")]
 
 
+def read_sql(sql):
+    """
+    :param sql: select sentence
+    :return: Dataframe with the result, from bigquery or local storage
+    """
+    storage_dir = os.environ.get(STORAGE_DIR)
+    if not storage_dir:
+        return read_gbq(sql, PROJECT_ID, dialect='standard')
+    return get_local_storage(storage_dir).read_sql(sql)
+
+
+def get_local_storage(storage_dir):
+    """
+    :param storage_dir: local storage directory
+    :return: storage.LocalStorage of the directory, the same for all the reads
+    """
+    global local_storage
+    if local_storage is None:
+        # Only to run in local, big_query is not deployed with the dashboard
+        sys.path.append(BIG_QUERY_DIR)
+        import storage
+        local_storage = storage.LocalStorage(storage_dir)
+        local_storage.create_dataset(DATASET)
+    return local_storage
+
+
 class ImhDataCompare:
     """
     Load the data for the day, and the data for the same date
@@ -26,11 +63,12 @@ class ImhDataCompare:
     get_time_travel_path .- Return list of travil time.
     get_dates .- Dates used in calc
     """
-    def __init__(self, lst_path, date):
+    def __init__(self, lst_path, date, stations=None):
         """
 
         :param lst_path: list paths in for (source,destination)
         :param date:  datatime
+        :param stations: list of toll stations, None for all the stations
         """
         self.lst_path = lst_path
         self.dates = []
@@ -44,7 +82,7 @@ class ImhDataCompare:
         print(self.dates)
         # Create class to store data, no data loaded
         for date_calc in self.dates:
-            self.data.append(ImhData(lst_path, date_calc))
+            self.data.append(ImhData(lst_path, date_calc, stations))
 
     def load(self):
         """
@@ -106,22 +144,28 @@ class ImhData:
     get_time_travel_path .- Get time travel for a path
 
     """
-    def __init__(self, lst_path, date):
+    def __init__(self, lst_path, date, stations=None):
         """
         :param lst_path: list paths in for (source,destination)
         :param date:date string
+        :param stations: list of toll stations, None for all the stations.
+        A route can be in several stations, its rows are added by minute.
         """
         self.df = None
         self.lst_path = lst_path
         self.date = date
+        self.stations = stations
 
     def build_sql(self):
         """
         return: sql sentence to load the data
         """
-        sql = "SELECT Date,Time,Source,Destination,AHT,Travel_Time \
+        sql = "SELECT Date,Time,Station,Source,Destination,AHT,Travel_Time \
             FROM " + DATASET + "." + TABLE_AGGR + " where Date " \
-            "= \"" + self.date + "\" and Time > \"00:10\" "
+            "= '" + self.date + "' and Time > '00:10:00' "
+        if self.stations:
+            sql = sql + " and Station in (" + \
+                ",".join(str(station) for station in self.stations) + ") "
         sql = sql + " and ("
         for counter, (origin, destination) in enumerate(self.lst_path):
             if counter > 0:
@@ -136,8 +180,9 @@ class ImhData:
         Load data
         """
         sql = self.build_sql()
-        self.df = read_gbq(sql, PROJECT_ID, dialect='standard')
-        self.df["Time"] = self.df["Time"].apply(lambda time:  datetime.strptime(time, '%H:%M').time())
+        self.df = read_sql(sql)
+        # TIME column, datetime.time in bigquery, HH:MM:SS in local storage
+        self.df["Time"] = self.df["Time"].apply(lambda time:  datetime.strptime(str(time), '%H:%M:%S').time())
 
     def get_imh_all(self):
         """